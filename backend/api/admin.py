@@ -1,5 +1,11 @@
 from django.contrib import admin
-from api.models import GeneratedImage
+from api.models import Conversation, ConversationTurn, GeneratedImage, ImageJob, OutboxEmail, TTSAudio, UserQuota
 # Register your models here.
 
 admin.site.register(GeneratedImage)
+admin.site.register(TTSAudio)
+admin.site.register(ImageJob)
+admin.site.register(OutboxEmail)
+admin.site.register(UserQuota)
+admin.site.register(Conversation)
+admin.site.register(ConversationTurn)
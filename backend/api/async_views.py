@@ -0,0 +1,386 @@
+# async_views.py
+#
+# Native async versions of the chat, image and text-to-speech endpoints
+# (including the streaming chat and batch image ones), used when the app is
+# served over ASGI (see ASYNC_VIEWS in settings). Provider calls are awaited
+# instead of holding a worker thread, and the SDKs that only offer blocking
+# calls (Cloudinary, gTTS) run in a dedicated thread pool. Streamed responses
+# are async generators: Django under ASGI collects a sync iterator in full
+# before sending any of it. The DRF views in views.py remain the WSGI
+# implementation.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from .chat_cache import cache_key, chat_cache
+from . import conversations, images, tts
+from .jobs import QueueFull, image_jobs, job_payload
+from .models import ImageJob
+from . import resilience
+from .metrics import submit
+from .markdown import aclean_gemini_stream
+from .quotas import enforce_quota, quota_cost, refund_quota, resolve_user
+from .routing import router
+from .singleflight import chat_flight, image_flight
+from .views import (
+    batch_prompts, chat_model, clean_gemini_response, detect_custom_response, job_finished, queue_image_job,
+    sse_event, wants_job_stream,
+)
+
+logger = logging.getLogger(__name__)
+
+# Dedicated pool for blocking SDK calls, sized for many in-flight requests
+# rather than the small default executor.
+blocking_pool = ThreadPoolExecutor(
+    max_workers=getattr(settings, "ASYNC_BLOCKING_THREADS", 64),
+    thread_name_prefix="api-blocking",
+)
+
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_pool, functools.partial(func, *args, **kwargs))
+
+
+def read_json(request):
+    if request.content_type == "application/json":
+        try:
+            return json.loads(request.body or b"{}")
+        except ValueError:
+            return {}
+    return request.POST
+
+
+async def agenerate_chat_reply(user_message, is_code_mode):
+    response, route = await router.acall(user_message, is_code_mode, lambda name, timeout: chat_model(
+        is_code_mode, name).generate_content_async(user_message, request_options={"timeout": timeout}))
+    ai_response = response.text if hasattr(response, 'text') else "I couldn't generate a response."
+
+    if not is_code_mode:
+        ai_response = clean_gemini_response(ai_response)
+    await chat_cache.aset(user_message, is_code_mode, ai_response)
+    return ai_response, route
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatView(View):
+    @enforce_quota("chat")
+    async def post(self, request):
+        data = read_json(request)
+        user_message = data.get('message')
+        is_code_mode = data.get('code_mode', False)
+
+        if not user_message:
+            return JsonResponse({"error": "Message is required."}, status=400)
+
+        conversation_id = data.get('conversation_id')
+        if conversation_id or data.get('conversation'):
+            return await self.post_in_conversation(request, user_message, is_code_mode, conversation_id)
+
+        try:
+            custom_reply = detect_custom_response(user_message)
+            if custom_reply:
+                return JsonResponse({"bot_response": custom_reply})
+
+            cached = await chat_cache.aget(user_message, is_code_mode)
+            if cached is not None:
+                return JsonResponse({"bot_response": cached}, headers={"X-Cache": "HIT"})
+
+            if settings.COALESCE_CHAT:
+                ai_response, route = await chat_flight.ado(
+                    cache_key(user_message, is_code_mode),
+                    lambda: agenerate_chat_reply(user_message, is_code_mode),
+                )
+            else:
+                ai_response, route = await agenerate_chat_reply(user_message, is_code_mode)
+
+            return JsonResponse({"bot_response": ai_response}, headers={"X-Cache": "MISS", **route.headers()})
+
+        except resilience.ProviderError as e:
+            status_code, headers = resilience.error_status(e)
+            return JsonResponse({"error": str(e)}, status=status_code, headers=headers)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+
+    async def post_in_conversation(self, request, user_message, is_code_mode, conversation_id):
+        user = await sync_to_async(resolve_user)(request)
+        if conversation_id:
+            conversation = await sync_to_async(conversations.get_conversation)(conversation_id, user)
+            if conversation is None:
+                return JsonResponse({"error": "Conversation not found."}, status=404)
+        else:
+            conversation = await sync_to_async(conversations.start_conversation)(user)
+
+        try:
+            input_tokens = None
+            headers = {}
+            ai_response = detect_custom_response(user_message)
+            if ai_response:
+                await sync_to_async(conversations.record_exchange)(conversation, user_message, ai_response)
+            else:
+                ai_response, input_tokens, route = await conversations.areply(conversation, user_message, is_code_mode)
+                headers = route.headers()
+
+            return JsonResponse({
+                "bot_response": ai_response,
+                "conversation_id": str(conversation.id),
+                "input_tokens": input_tokens,
+            }, headers=headers)
+
+        except resilience.ProviderError as e:
+            status_code, headers = resilience.error_status(e)
+            return JsonResponse({"error": str(e)}, status=status_code, headers=headers)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+
+
+async def aiter_gemini_text(response):
+    async for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            yield text
+
+
+async def aiter_text(text):
+    yield text
+
+
+def event_stream(events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatStreamView(View):
+    """ChatStreamAPIView for ASGI: chunks are sent as Gemini produces them."""
+
+    @enforce_quota("chat")
+    async def post(self, request):
+        data = read_json(request)
+        user_message = data.get('message')
+        is_code_mode = data.get('code_mode', False)
+
+        if not user_message:
+            return JsonResponse({"error": "Message is required."}, status=400)
+        return event_stream(self.stream(user_message, is_code_mode))
+
+    async def stream(self, user_message, is_code_mode):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first_chunk_ms = None
+        parts = []
+        cacheable = False
+        route = None
+
+        try:
+            custom_reply = detect_custom_response(user_message)
+            cached = None if custom_reply else await chat_cache.aget(user_message, is_code_mode)
+            if custom_reply or cached is not None:
+                chunks = aiter_text(custom_reply or cached)
+            else:
+                cacheable = True
+                response, route = await router.acall(
+                    user_message, is_code_mode,
+                    lambda name, timeout: chat_model(is_code_mode, name).generate_content_async(
+                        user_message, stream=True, request_options={"timeout": timeout}),
+                    stream=True, hedge=False,
+                )
+                chunks = aiter_gemini_text(response)
+                if not is_code_mode:
+                    chunks = aclean_gemini_stream(chunks)
+
+            async for text in chunks:
+                if first_chunk_ms is None:
+                    first_chunk_ms = round((loop.time() - started) * 1000)
+                parts.append(text)
+                yield sse_event("chunk", {"text": text})
+
+        except Exception as e:
+            logger.exception("Streaming chat failed")
+            yield sse_event("error", {"error": str(e)})
+            return
+
+        bot_response = "".join(parts) or "I couldn't generate a response."
+        if cacheable and parts:
+            await chat_cache.aset(user_message, is_code_mode, bot_response)
+        yield sse_event("done", {
+            "bot_response": bot_response,
+            "chunks": len(parts),
+            "first_chunk_ms": first_chunk_ms,
+            "elapsed_ms": round((loop.time() - started) * 1000),
+            "model": route.model if route else None,
+            "route": route.reason if route else None,
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncGenerateImageView(View):
+    @enforce_quota("image")
+    async def post(self, request):
+        data = read_json(request)
+        prompt = data.get("prompt")
+        if not prompt:
+            return JsonResponse({"error": "Prompt is required."}, status=400)
+
+        if not data.get("fresh"):
+            reused = await sync_to_async(images.find_reusable_image)(prompt)
+            if reused:
+                return JsonResponse({"file_name": reused, "reused": True})
+
+        user = await sync_to_async(resolve_user)(request)
+        user_id = user.pk if user else None
+        if data.get("async"):
+            try:
+                return JsonResponse(await sync_to_async(queue_image_job)(request, prompt, user_id), status=202)
+            except QueueFull as e:
+                return JsonResponse({"error": str(e)}, status=503)
+
+        try:
+            if settings.COALESCE_IMAGES:
+                file_name = await image_flight.ado(
+                    images.prompt_key(prompt), lambda: images.acreate_image(prompt, user_id)
+                )
+            else:
+                file_name = await images.acreate_image(prompt, user_id)
+            if not file_name:
+                return JsonResponse({"error": "Image generation failed."}, status=400)
+
+            return JsonResponse({"file_name": file_name})
+
+        except resilience.ProviderError as e:
+            status_code, headers = resilience.error_status(e)
+            return JsonResponse({"error": str(e)}, status=status_code, headers=headers)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+
+
+def batch_units(request):
+    try:
+        return len(batch_prompts(read_json(request)))
+    except ValueError:
+        return 1
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncGenerateImageBatchView(View):
+    """GenerateImageBatchAPIView for ASGI: each result is sent as soon as it is ready."""
+
+    @enforce_quota("image", units=batch_units)
+    async def post(self, request):
+        try:
+            prompts = batch_prompts(read_json(request))
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        user = await sync_to_async(resolve_user)(request)
+        return event_stream(self.stream(prompts, user))
+
+    async def stream(self, prompts, user):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        failed = 0
+        async for index, url, error in images.agenerate_batch(prompts, user.pk if user else None):
+            failed += error is not None
+            yield sse_event("result", {"index": index, "prompt": prompts[index], "file_name": url, "error": error})
+
+        if failed and user is not None:
+            await sync_to_async(refund_quota)(user, quota_cost("image") * failed)
+        yield sse_event("done", {
+            "total": len(prompts),
+            "succeeded": len(prompts) - failed,
+            "failed": failed,
+            "elapsed_ms": round((loop.time() - started) * 1000),
+        })
+
+
+async def aimage_job_events(job_id):
+    """views.image_job_events for ASGI: a waiting subscriber costs no thread."""
+    last = None
+    deadline = time.monotonic() + getattr(settings, "IMAGE_JOB_SSE_TIMEOUT", 120)
+    while True:
+        job = await ImageJob.objects.filter(id=job_id).afirst()
+        if job is None:
+            return
+        payload = job_payload(job)
+        if payload != last:
+            yield sse_event("status", payload)
+            last = payload
+        if job_finished(job, deadline):
+            return
+        await asyncio.sleep(1)
+
+
+async def async_image_job_view(request, job_id):
+    """views.image_job_view for ASGI."""
+    job = await ImageJob.objects.filter(id=job_id).afirst()
+    if job is None:
+        raise Http404("Job not found")
+    if not image_jobs.threads:
+        await sync_to_async(image_jobs.start)()  # requeues stale jobs: a query
+
+    if wants_job_stream(request):
+        return event_stream(aimage_job_events(job_id))
+    return JsonResponse(job_payload(job))
+
+
+async def astream_audio(text, lang, key):
+    parts = []
+    for future in tts.submit_segments(tts.normalize_text(text), lang):
+        part = await asyncio.wrap_future(future)
+        parts.append(part)
+        yield part
+    submit(tts.synth_pool, tts.store_audio_in_background, b"".join(parts), key, lang)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncTextToSpeechView(View):
+    @enforce_quota("tts")
+    async def post(self, request):
+        data = read_json(request)
+        text = data.get("text")
+        lang = data.get("lang", "en")
+
+        if not text:
+            return JsonResponse({"error": "No text provided"}, status=400)
+
+        if lang not in tts.supported_langs():
+            return JsonResponse({"error": f"Language '{lang}' not supported."}, status=400)
+
+        key = tts.audio_key(text, lang)
+        url = tts.recent_audio.get(key) or await sync_to_async(tts.lookup_audio)(key)
+
+        if data.get("stream"):
+            if url is not None:
+                return HttpResponseRedirect(url)
+            return StreamingHttpResponse(astream_audio(text, lang, key), content_type="audio/mpeg")
+
+        if url is not None:
+            return JsonResponse({"audio_url": url, "cached": True})
+
+        try:
+            audio = await run_blocking(tts.synthesize_mp3, tts.normalize_text(text), lang)
+            url = await run_blocking(tts.upload_audio, audio, key)
+        except resilience.ProviderError as e:
+            status_code, headers = resilience.error_status(e)
+            return JsonResponse({"error": str(e)}, status=status_code, headers=headers)
+        except Exception as e:
+            return JsonResponse({"error": f"Text-to-speech failed: {str(e)}"}, status=500)
+
+        await sync_to_async(tts.record_audio)(key, lang, url)
+        return JsonResponse({"audio_url": url, "cached": False})
@@ -0,0 +1,148 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+def normalize_message(message):
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    return " ".join(message.lower().split()).rstrip(" ?!.")
+
+
+def cache_key(message, is_code_mode):
+    mode = "code" if is_code_mode else "chat"
+    digest = hashlib.sha256(normalize_message(message).encode("utf-8")).hexdigest()
+    return f"chat:{mode}:{digest}"
+
+
+class MemoryBackend:
+    """In-process LRU with a per-entry TTL."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value):
+        self.set(key, value)
+
+
+class DjangoCacheBackend:
+    """
+    Stores entries in one of Django's CACHES, so every worker shares them.
+    Eviction is left to the configured cache (locmem and Redis are LRU).
+    """
+
+    def __init__(self, alias, ttl):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=self.ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+    async def aget(self, key):
+        return await self.cache.aget(key)
+
+    async def aset(self, key, value):
+        await self.cache.aset(key, value, timeout=self.ttl)
+
+
+class ResponseCache:
+    """
+    Cache of cleaned Gemini answers keyed on (normalized message, code_mode).
+    Hit/miss counters are per process.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def count(self, value):
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def get(self, message, is_code_mode):
+        if self.backend is None:
+            return None
+        return self.count(self.backend.get(cache_key(message, is_code_mode)))
+
+    def set(self, message, is_code_mode, response):
+        if self.backend is not None:
+            self.backend.set(cache_key(message, is_code_mode), response)
+
+    async def aget(self, message, is_code_mode):
+        if self.backend is None:
+            return None
+        return self.count(await self.backend.aget(cache_key(message, is_code_mode)))
+
+    async def aset(self, message, is_code_mode, response):
+        if self.backend is not None:
+            await self.backend.aset(cache_key(message, is_code_mode), response)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+def build_backend():
+    backend = getattr(settings, "CHAT_CACHE_BACKEND", "memory")
+    ttl = getattr(settings, "CHAT_CACHE_TTL", 3600)
+
+    if backend == "memory":
+        return MemoryBackend(getattr(settings, "CHAT_CACHE_MAX_ENTRIES", 1024), ttl)
+    if backend == "django":
+        return DjangoCacheBackend(getattr(settings, "CHAT_CACHE_ALIAS", "default"), ttl)
+    if backend == "none":
+        return None
+    raise ValueError(f"Unknown CHAT_CACHE_BACKEND '{backend}'")
+
+
+chat_cache = ResponseCache(build_backend())
@@ -0,0 +1,206 @@
+# conversations.py
+#
+# Server-side memory for multi-turn chat. Each message in a conversation is
+# answered through a Gemini chat session whose history is:
+#
+#   - the rolling summary of older turns (if any), then
+#   - the most recent turns verbatim, newest first until
+#     CONVERSATION_TOKEN_BUDGET is used up.
+#
+# After a reply, turns that no longer fit the budget are folded into the
+# summary by a background summarization call, so the context sent per turn
+# stays roughly constant however long the conversation gets.
+
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from . import providers
+from .markdown import clean_gemini_response
+from .models import Conversation, ConversationTurn
+from .prompts import chat_mode
+from .routing import router
+
+logger = logging.getLogger(__name__)
+
+compaction_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="conversation-compaction")
+compacting = set()
+compacting_lock = threading.Lock()
+
+SUMMARY_PROMPT = """Update the running summary of a conversation between a user and an assistant.
+Keep every fact, decision, name and piece of code the user may refer back to.
+Write at most {words} words of plain text.
+
+Current summary:
+{summary}
+
+New exchanges:
+{exchanges}
+"""
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English; good enough for budgeting
+    return max(1, len(text) // 4)
+
+
+def token_budget():
+    return getattr(settings, "CONVERSATION_TOKEN_BUDGET", 2000)
+
+
+def get_conversation(conversation_id, user):
+    """The conversation if it exists and belongs to ``user`` (or to nobody), else None."""
+    try:
+        conversation_id = uuid.UUID(str(conversation_id))
+    except ValueError:
+        return None
+    conversation = Conversation.objects.filter(id=conversation_id).first()
+    if conversation is None:
+        return None
+    if conversation.user_id is not None and (user is None or conversation.user_id != user.pk):
+        return None
+    return conversation
+
+
+def start_conversation(user):
+    return Conversation.objects.create(user=user)
+
+
+def recent_turns(conversation):
+    """Unsummarized turns, newest first, that fit in the token budget (oldest first)."""
+    budget = token_budget()
+    kept = []
+    used = 0
+    turns = (
+        ConversationTurn.objects.filter(conversation=conversation, id__gt=conversation.summarized_until)
+        .order_by("-id")
+        .values("id", "role", "text", "tokens")
+    )
+    for turn in turns.iterator():
+        if kept and used + turn["tokens"] > budget:
+            break
+        kept.append(turn)
+        used += turn["tokens"]
+
+    kept.reverse()
+    # History has to start with a user turn
+    while kept and kept[0]["role"] != ConversationTurn.USER:
+        kept.pop(0)
+    return kept
+
+
+def build_history(conversation):
+    history = []
+    if conversation.summary:
+        history.append({"role": "user", "parts": [f"Summary of our conversation so far:\n{conversation.summary}"]})
+        history.append({"role": "model", "parts": ["Understood, I'll keep that in mind."]})
+    for turn in recent_turns(conversation):
+        history.append({"role": turn["role"], "parts": [turn["text"]]})
+    return history
+
+
+def record_exchange(conversation, user_message, reply):
+    ConversationTurn.objects.bulk_create([
+        ConversationTurn(conversation=conversation, role=ConversationTurn.USER,
+                         text=user_message, tokens=estimate_tokens(user_message)),
+        ConversationTurn(conversation=conversation, role=ConversationTurn.MODEL,
+                         text=reply, tokens=estimate_tokens(reply)),
+    ])
+    Conversation.objects.filter(id=conversation.id).update(updated_at=timezone.now())
+    schedule_compaction(conversation.id)
+
+
+def schedule_compaction(conversation_id):
+    with compacting_lock:
+        if conversation_id in compacting:
+            return
+        compacting.add(conversation_id)
+    compaction_pool.submit(compact_in_background, conversation_id)
+
+
+def compact_in_background(conversation_id):
+    try:
+        compact(conversation_id)
+    except Exception:
+        logger.exception("Compacting conversation %s failed", conversation_id)
+    finally:
+        with compacting_lock:
+            compacting.discard(conversation_id)
+        connection.close()
+
+
+def compact(conversation_id):
+    """Fold unsummarized turns that no longer fit the budget into the summary."""
+    conversation = Conversation.objects.get(id=conversation_id)
+    turns = list(
+        ConversationTurn.objects.filter(conversation=conversation, id__gt=conversation.summarized_until)
+        .order_by("id")
+    )
+
+    budget = token_budget()
+    min_recent = getattr(settings, "CONVERSATION_MIN_RECENT_TURNS", 4)
+    used = 0
+    split = len(turns)
+    while split > 0:
+        tokens = turns[split - 1].tokens
+        if len(turns) - split >= min_recent and used + tokens > budget:
+            break
+        used += tokens
+        split -= 1
+    split -= split % 2  # summarize whole user/model exchanges only
+    old = turns[:split]
+    if not old:
+        return
+
+    exchanges = "\n".join(f"{turn.role}: {turn.text}" for turn in old)
+    prompt = SUMMARY_PROMPT.format(
+        words=getattr(settings, "CONVERSATION_SUMMARY_WORDS", 250),
+        summary=conversation.summary or "(none yet)",
+        exchanges=exchanges,
+    )
+    # Not a chat request: kept out of the route counts and latency EWMAs
+    response, _ = router.call(prompt, False, lambda name, timeout: providers.get_chat_model(name).generate_content(
+        prompt, request_options={"timeout": timeout}), count=False)
+    summary = response.text.strip()
+
+    # Only apply if nobody else moved the summary on in the meantime
+    Conversation.objects.filter(id=conversation.id, summarized_until=conversation.summarized_until).update(
+        summary=summary, summarized_until=old[-1].id
+    )
+
+
+def usage_tokens(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "prompt_token_count", None) if usage else None
+
+
+def reply(conversation, user_message, is_code_mode):
+    """Answer ``user_message`` in the conversation; returns ``(reply, input_tokens, route)``."""
+    mode = chat_mode(is_code_mode)
+    history = build_history(conversation)
+    # A new session per attempt: a session appends to its history as it sends
+    response, route = router.call(user_message, is_code_mode, lambda name, timeout: providers.get_chat_model(
+        name, mode).start_chat(history=history).send_message(user_message, request_options={"timeout": timeout}))
+    text = response.text if hasattr(response, 'text') else "I couldn't generate a response."
+    if not is_code_mode:
+        text = clean_gemini_response(text)
+    record_exchange(conversation, user_message, text)
+    return text, usage_tokens(response), route
+
+
+async def areply(conversation, user_message, is_code_mode):
+    history = await sync_to_async(build_history)(conversation)
+    mode = chat_mode(is_code_mode)
+    response, route = await router.acall(user_message, is_code_mode, lambda name, timeout: providers.get_chat_model(
+        name, mode).start_chat(history=history).send_message_async(user_message, request_options={"timeout": timeout}))
+    text = response.text if hasattr(response, 'text') else "I couldn't generate a response."
+    if not is_code_mode:
+        text = clean_gemini_response(text)
+    await sync_to_async(record_exchange)(conversation, user_message, text)
+    return text, usage_tokens(response), route
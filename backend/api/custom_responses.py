@@ -0,0 +1,112 @@
+import json
+import os
+import re
+import threading
+import time
+import logging
+
+from django.conf import settings
+
+from .metrics import stage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CUSTOM_RESPONSES_FILE = os.path.join(os.path.dirname(__file__), "data", "custom_responses.json")
+
+
+class CustomResponseMatcher:
+    """
+    All keywords of the custom response table compiled into one regex.
+
+    The pattern is a zero-width lookahead, so ``finditer`` reports a match at
+    every word start where some keyword begins (overlapping matches are not
+    lost). Alternatives are ordered by category, so at a given position the
+    earliest category wins, and the lowest category over all positions is the
+    one the old per-keyword loop would have returned.
+    """
+
+    def __init__(self, table):
+        self.responses = []
+        self.keyword_category = {}
+
+        for index, data in enumerate(table.values()):
+            self.responses.append(data["response"])
+            for keyword in data["keywords"]:
+                # An earlier category keeps keywords listed twice
+                self.keyword_category.setdefault(keyword.lower(), index)
+
+        alternatives = "|".join(re.escape(keyword) for keyword in self.keyword_category)
+        self.pattern = re.compile(rf"\b(?=({alternatives})\b)") if alternatives else None
+
+    def match(self, user_message):
+        if self.pattern is None:
+            return None
+
+        best = None
+        for found in self.pattern.finditer(user_message.lower()):
+            index = self.keyword_category[found.group(1)]
+            if best is None or index < best:
+                best = index
+                if best == 0:
+                    break
+        return None if best is None else self.responses[best]
+
+
+def load_custom_responses(path=None):
+    path = path or getattr(settings, "CUSTOM_RESPONSES_FILE", DEFAULT_CUSTOM_RESPONSES_FILE)
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class ReloadingMatcher:
+    """
+    Holds the compiled matcher and rebuilds it when the data file changes.
+
+    The file's mtime is checked at most every ``CUSTOM_RESPONSES_RELOAD_INTERVAL``
+    seconds, so edits are picked up without a restart. A broken file keeps the
+    previous table in service.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.matcher = None
+        self.mtime = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def get_path(self):
+        return self.path or getattr(settings, "CUSTOM_RESPONSES_FILE", DEFAULT_CUSTOM_RESPONSES_FILE)
+
+    def reload(self, force=False):
+        path = self.get_path()
+        with self.lock:
+            try:
+                mtime = os.stat(path).st_mtime
+                if force or self.matcher is None or mtime != self.mtime:
+                    self.matcher = CustomResponseMatcher(load_custom_responses(path))
+                    self.mtime = mtime
+                    logger.info("Loaded custom responses from %s", path)
+            except (OSError, ValueError, KeyError):
+                if self.matcher is None:
+                    raise
+                logger.exception("Could not reload custom responses from %s", path)
+            self.checked_at = time.monotonic()
+        return self.matcher
+
+    def get(self):
+        interval = getattr(settings, "CUSTOM_RESPONSES_RELOAD_INTERVAL", 5)
+        if self.matcher is None or time.monotonic() - self.checked_at >= interval:
+            return self.reload()
+        return self.matcher
+
+
+custom_response_matcher = ReloadingMatcher()
+
+
+def detect_custom_response(user_message):
+    with stage("keywords"):
+        return custom_response_matcher.get().match(user_message)
+
+
+def reload_custom_responses():
+    return custom_response_matcher.reload(force=True)
@@ -0,0 +1,35 @@
+# derivatives.py
+#
+# Pillow work for generated images: a small WebP thumbnail for previews, a
+# full-size WebP, and optionally AVIF. render_variants() runs in worker
+# processes (images.derivative_pool), so decoding and encoding happen
+# outside the web process and its GIL. This module must stay free of Django
+# imports: spawned workers import it on their own.
+
+from io import BytesIO
+
+from PIL import Image, features
+
+
+def avif_supported():
+    return features.check("avif")
+
+
+def encode(image, format, **options):
+    buffer = BytesIO()
+    image.save(buffer, format=format, **options)
+    return buffer.getvalue()
+
+
+def render_variants(data, thumbnail_size=320, quality=80, avif=False):
+    """Returns ``{"thumbnail": webp bytes, "webp": webp bytes[, "avif": avif bytes]}``."""
+    with Image.open(BytesIO(data)) as source:
+        image = source.convert("RGBA" if "A" in source.getbands() else "RGB")
+
+    variants = {"webp": encode(image, "WEBP", quality=quality, method=4)}
+    if avif and avif_supported():
+        variants["avif"] = encode(image, "AVIF", quality=quality)
+
+    image.thumbnail((thumbnail_size, thumbnail_size))
+    variants["thumbnail"] = encode(image, "WEBP", quality=quality, method=4)
+    return variants
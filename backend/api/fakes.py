@@ -0,0 +1,275 @@
+# fakes.py
+#
+# In-process stand-ins for Gemini (chat and image generation), Cloudinary and
+# gTTS with configurable latency and payload size, so the request path can be
+# exercised and measured without network access or API keys:
+#
+#     with FakeProviders(latency=0.2, payload_bytes=64 * 1024):
+#         ...  # every provider call in api/ now hits the fakes
+#
+# The fakes return objects shaped like the SDK responses the views read
+# (``.text``, ``.usage_metadata``, ``candidates[0].content.parts[0].inline_data``,
+# ``{"secure_url": ...}``), nothing more. gtts itself must be importable,
+# since the fake is patched in as ``gtts.gTTS``.
+#
+# ``failure_rate`` and ``slow_rate`` make a share of calls fail with a 503 or
+# take ``slow_latency`` longer; a call slower than the timeout it was given
+# raises TimeoutError, as the SDKs do. That is enough to exercise
+# api/resilience.py (see ``manage.py bench_resilience``).
+
+import asyncio
+import math
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from contextlib import ExitStack
+from types import SimpleNamespace
+from unittest import mock
+
+
+class FakeProviderError(Exception):
+    """Shaped like the SDKs' server errors: carries an HTTP ``code``."""
+
+    code = 503
+
+
+class Faults:
+    def __init__(self, failure_rate=0.0, slow_rate=0.0, slow_latency=1.0, seed=None):
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.injected = {"failed": 0, "slow": 0}
+
+    def plan(self, latency, timeout):
+        """``(seconds to wait, error to raise after or None)`` for one call."""
+        with self.lock:
+            failed = self.random.random() < self.failure_rate
+            slow = not failed and self.random.random() < self.slow_rate
+            if failed or slow:
+                self.injected["failed" if failed else "slow"] += 1
+        if failed:
+            return 0, FakeProviderError("503 Service Unavailable (injected)")
+        if slow:
+            latency += self.slow_latency
+        if timeout is not None and latency > timeout:
+            return timeout, TimeoutError(f"No answer within {timeout:.2f}s")
+        return latency, None
+
+    def wait(self, latency, timeout=None):
+        seconds, error = self.plan(latency, timeout)
+        time.sleep(seconds)
+        if error:
+            raise error
+
+    async def await_(self, latency, timeout=None):
+        seconds, error = self.plan(latency, timeout)
+        await asyncio.sleep(seconds)
+        if error:
+            raise error
+
+
+def request_timeout(request_options):
+    return (request_options or {}).get("timeout")
+
+
+def make_response(text):
+    return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(prompt_token_count=len(text) // 4))
+
+
+class FakeChatSession:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, **kwargs):
+        return self.model.generate_content(content, **kwargs)
+
+    async def send_message_async(self, content, **kwargs):
+        return await self.model.generate_content_async(content, **kwargs)
+
+
+class FakeChatModel:
+    def __init__(self, latency, payload_bytes, chunks=8, faults=None):
+        self.latency = latency
+        self.faults = faults or Faults()
+        self.text = ("Fake **reply** text. " * (payload_bytes // 21 + 1))[:payload_bytes]
+        self.chunks = chunks
+        self.calls = 0
+
+    def stream(self):
+        size = max(1, len(self.text) // self.chunks)
+        for i in range(0, len(self.text), size):
+            time.sleep(self.latency / self.chunks)
+            yield SimpleNamespace(text=self.text[i:i + size])
+
+    def generate_content(self, content, stream=False, request_options=None, **kwargs):
+        self.calls += 1
+        if stream:
+            self.faults.wait(0, request_timeout(request_options))
+            return self.stream()
+        self.faults.wait(self.latency, request_timeout(request_options))
+        return make_response(self.text)
+
+    async def astream(self):
+        size = max(1, len(self.text) // self.chunks)
+        for i in range(0, len(self.text), size):
+            await asyncio.sleep(self.latency / self.chunks)
+            yield SimpleNamespace(text=self.text[i:i + size])
+
+    async def generate_content_async(self, content, stream=False, request_options=None, **kwargs):
+        self.calls += 1
+        if stream:
+            await self.faults.await_(0, request_timeout(request_options))
+            return self.astream()
+        await self.faults.await_(self.latency, request_timeout(request_options))
+        return make_response(self.text)
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+
+def fake_png(payload_bytes):
+    """A valid RGB PNG of roughly ``payload_bytes`` (noise doesn't compress)."""
+    side = max(1, int(math.sqrt(payload_bytes / 3)))
+    raw = b"".join(b"\0" + os.urandom(side * 3) for _ in range(side))
+
+    def chunk(kind, body):
+        return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+    header = struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+def image_chunk(data):
+    inline_data = SimpleNamespace(data=data, mime_type="image/png")
+    part = SimpleNamespace(inline_data=inline_data, text=None)
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+def config_timeout(request):
+    """Seconds of the ``http_options`` timeout (milliseconds) in an image request's config."""
+    http_options = getattr(request.get("config"), "http_options", None)
+    timeout = getattr(http_options, "timeout", None)
+    return timeout / 1000 if timeout else None
+
+
+class FakeImageModels:
+    def __init__(self, latency, payload_bytes, faults=None):
+        self.latency = latency
+        self.faults = faults or Faults()
+        self.data = fake_png(payload_bytes)
+        self.calls = 0
+
+    def generate_content_stream(self, **request):
+        self.calls += 1
+        self.faults.wait(self.latency, config_timeout(request))
+        yield image_chunk(self.data)
+
+
+class FakeAsyncImageModels:
+    def __init__(self, models):
+        self.models = models
+
+    async def generate_content_stream(self, **request):
+        self.models.calls += 1
+        await self.models.faults.await_(self.models.latency, config_timeout(request))
+
+        async def chunks():
+            yield image_chunk(self.models.data)
+
+        return chunks()
+
+
+class FakeGenaiClient:
+    def __init__(self, latency, payload_bytes, faults=None):
+        self.models = FakeImageModels(latency, payload_bytes, faults)
+        self.aio = SimpleNamespace(models=FakeAsyncImageModels(self.models))
+
+
+class FakeUploader:
+    def __init__(self, latency, faults=None):
+        self.latency = latency
+        self.faults = faults or Faults()
+        self.calls = 0
+
+    def upload(self, file, **options):
+        self.calls += 1
+        if hasattr(file, "read"):
+            file.read()
+        self.faults.wait(self.latency, options.get("timeout"))
+        return {"secure_url": self.asset_url(options.get("public_id", "fake")), "public_id": options.get("public_id")}
+
+    def asset_url(self, public_id, **options):
+        extension = f".{options['format']}" if options.get("format") else ""
+        return f"https://res.cloudinary.example/fake/{public_id}{extension}"
+
+
+class FakeTTS:
+    """Replacement for the gTTS class: same constructor, writes silence."""
+
+    latency = 0
+    payload_bytes = 0
+    faults = Faults()
+
+    def __init__(self, text, lang="en", timeout=None, **kwargs):
+        self.text = text
+        self.lang = lang
+        self.timeout = timeout
+
+    def write_to_fp(self, fp):
+        self.faults.wait(self.latency, self.timeout)
+        fp.write(b"\xff\xf3" + b"\0" * max(0, self.payload_bytes - 2))
+
+
+class FakeProviders:
+    """Context manager that routes api.providers and api.tts to the fakes."""
+
+    def __init__(self, latency=0.1, payload_bytes=4096, image_latency=None, image_bytes=None,
+                 upload_latency=None, tts_latency=None, tts_bytes=None,
+                 failure_rate=0.0, slow_rate=0.0, slow_latency=1.0, seed=None):
+        # One fault source for all fakes, so a seed reproduces a whole run
+        self.faults = Faults(failure_rate, slow_rate, slow_latency, seed)
+        self.chat_model = FakeChatModel(latency, payload_bytes, faults=self.faults)
+        self.genai_client = FakeGenaiClient(
+            latency if image_latency is None else image_latency,
+            payload_bytes if image_bytes is None else image_bytes,
+            self.faults,
+        )
+        self.uploader = FakeUploader(latency if upload_latency is None else upload_latency, self.faults)
+        self.tts_class = type("FakeTTS", (FakeTTS,), {
+            "latency": latency if tts_latency is None else tts_latency,
+            "payload_bytes": payload_bytes if tts_bytes is None else tts_bytes,
+            "faults": self.faults,
+        })
+        self.stack = None
+
+    def calls(self):
+        return {
+            "chat": self.chat_model.calls,
+            "image": self.genai_client.models.calls,
+            "upload": self.uploader.calls,
+        }
+
+    def __enter__(self):
+        from . import providers
+
+        manager = providers.providers
+        self.stack = ExitStack()
+        for name, value in (
+            ("get_chat_model", lambda name=None, mode=None: self.chat_model),
+            ("get_genai_client", lambda: self.genai_client),
+            ("upload", self.uploader.upload),
+            ("asset_url", self.uploader.asset_url),
+        ):
+            self.stack.enter_context(mock.patch.object(manager, name, value))
+        self.stack.enter_context(mock.patch("gtts.gTTS", self.tts_class))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stack.close()
+        self.stack = None
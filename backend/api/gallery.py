@@ -0,0 +1,60 @@
+# gallery.py
+#
+# Keyset pagination over GeneratedImage, newest first. A page is fetched with
+# "created_at, id below the last row of the previous page", which the
+# (created_at, id) and (user, created_at, id) indexes answer with a range
+# scan, so page N costs the same as page 1 however many rows there are
+# (unlike OFFSET, which reads and discards every earlier row). Rows come
+# straight from values(), without model instances or a serializer.
+
+import base64
+from datetime import datetime
+
+from django.db.models import Q, TextField
+from django.db.models.functions import Cast
+
+from .models import GeneratedImage
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(created_at, image_id):
+    raw = f"{created_at.isoformat()}|{image_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """``(created_at, id)`` of a cursor; raises ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, image_id = raw.split("|")
+        return datetime.fromisoformat(created_at), int(image_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError("Invalid cursor.") from e
+
+
+def gallery_page(cursor=None, limit=DEFAULT_PAGE_SIZE, user_id=None):
+    """Returns ``(rows, next_cursor)``; next_cursor is None on the last page."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    images = GeneratedImage.objects.all()
+    if user_id is not None:
+        images = images.filter(user_id=user_id)
+    if cursor:
+        created_at, image_id = decode_cursor(cursor)
+        images = images.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=image_id))
+
+    rows = list(
+        images.order_by("-created_at", "-id")
+        # The raw column: CloudinaryField would turn every value into a resource object
+        .values(
+            "id", "prompt", "created_at", "thumbnail_url", "webp_url", "avif_url",
+            image_url=Cast("file_name", output_field=TextField()),
+        )
+        [:limit + 1]
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+    return rows, next_cursor
@@ -0,0 +1,367 @@
+# images.py
+#
+# Image generation pipeline shared by the sync and async image views. Gemini's
+# image bytes stay in memory from the stream chunk to the Cloudinary upload,
+# and every image gets a unique public_id, so nothing touches the working
+# directory and concurrent requests can't collide.
+#
+# With IMAGE_REUSE, a prompt that (after normalization) was already generated
+# within IMAGE_REUSE_WINDOW seconds is answered with the stored URL instead;
+# the lookup is an index range scan on (prompt_hash, created_at).
+#
+# After the original is stored, a thumbnail and WebP (optionally AVIF)
+# variants are rendered in a process pool (api/derivatives.py), uploaded next
+# to the original and their URLs saved on the GeneratedImage row.
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+from datetime import timedelta
+import mimetypes
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.db.models import TextField
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from . import providers
+from . import resilience
+from .metrics import submit
+from .models import GeneratedImage
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FOLDER = "darkai/generated"
+
+upload_pool = ThreadPoolExecutor(
+    max_workers=getattr(settings, "IMAGE_UPLOAD_THREADS", 4),
+    thread_name_prefix="image-upload",
+)
+# Shared by all batch requests; each batch also caps its own fan-out
+batch_pool = ThreadPoolExecutor(
+    max_workers=getattr(settings, "IMAGE_BATCH_THREADS", 8),
+    thread_name_prefix="image-batch",
+)
+
+
+def image_request(prompt, timeout=None):
+    from google.genai import types
+
+    contents = [
+        types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=prompt)],
+        ),
+    ]
+
+    config = types.GenerateContentConfig(
+        temperature=1,
+        response_modalities=["IMAGE", "TEXT"],
+        http_options=types.HttpOptions(timeout=int(timeout * 1000)) if timeout else None,
+    )
+    return dict(model=providers.IMAGE_MODEL, contents=contents, config=config)
+
+
+def extract_image(chunk):
+    """Return the inline image blob of a stream chunk, or None."""
+    if not chunk.candidates:
+        return None
+    candidate = chunk.candidates[0]
+    if not candidate or not candidate.content or not candidate.content.parts:
+        return None
+
+    part = candidate.content.parts[0]
+    inline_data = part.inline_data if part else None
+    if inline_data and inline_data.data:
+        return inline_data
+    return None
+
+
+def generate_image(prompt):
+    """Run Gemini image generation and return the first image blob, or None."""
+    client = providers.get_genai_client()
+
+    def attempt(timeout):
+        for chunk in client.models.generate_content_stream(**image_request(prompt, timeout)):
+            inline_data = extract_image(chunk)
+            if inline_data:
+                return inline_data
+        return None
+
+    return resilience.call("gemini_image", attempt)
+
+
+async def agenerate_image(prompt):
+    client = providers.get_genai_client()
+
+    async def attempt(timeout):
+        stream = await client.aio.models.generate_content_stream(**image_request(prompt, timeout))
+        async for chunk in stream:
+            inline_data = extract_image(chunk)
+            if inline_data:
+                return inline_data
+        return None
+
+    return await resilience.acall("gemini_image", attempt)
+
+
+def prompt_key(prompt):
+    return " ".join(prompt.lower().split())
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt_key(prompt).encode()).hexdigest()
+
+
+def find_reusable_image(prompt):
+    """URL of the newest image for this prompt within the reuse window, or None."""
+    if not getattr(settings, "IMAGE_REUSE", False):
+        return None
+    since = timezone.now() - timedelta(seconds=getattr(settings, "IMAGE_REUSE_WINDOW", 86400))
+    return (
+        GeneratedImage.objects.filter(prompt_hash=prompt_hash(prompt), created_at__gte=since)
+        .order_by("-created_at")
+        .values_list(Cast("file_name", output_field=TextField()), flat=True)
+        .first()
+    )
+
+
+def new_public_id():
+    return f"{IMAGE_FOLDER}/generated_image_{uuid.uuid4().hex}"
+
+
+def upload_image(data, public_id):
+    return providers.upload(BytesIO(data), public_id=public_id, resource_type="image")["secure_url"]
+
+
+def image_row(prompt, url, user_id=None):
+    return GeneratedImage(prompt=prompt, prompt_hash=prompt_hash(prompt), file_name=url, user_id=user_id)
+
+
+def store_image(prompt, data, public_id, user_id=None):
+    """Upload image bytes from memory, record the GeneratedImage row and return the URL."""
+    url = upload_image(data, public_id)
+    image = image_row(prompt, url, user_id)
+    image.save()
+    schedule_derivatives(image.id, public_id, data)
+    return url
+
+
+class DerivativePool:
+    """
+    Lazily started process pool for Pillow work. Workers are spawned, not
+    forked, so they don't inherit this process's threads and sockets.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def get(self):
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(
+                        max_workers=getattr(settings, "IMAGE_DERIVATIVE_PROCESSES", 2),
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+        return self.pool
+
+    def submit(self, fn, *args):
+        try:
+            return self.get().submit(fn, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM on a huge image); start a fresh pool once
+            with self.lock:
+                self.pool = None
+            return self.get().submit(fn, *args)
+
+
+derivative_pool = DerivativePool()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=derivative_pool.reset)
+
+
+def schedule_derivatives(image_id, public_id, data):
+    if not getattr(settings, "IMAGE_DERIVATIVES", True):
+        return
+    from .derivatives import render_variants  # Pillow stays off the startup path
+
+    future = derivative_pool.submit(
+        render_variants,
+        data,
+        getattr(settings, "IMAGE_THUMBNAIL_SIZE", 320),
+        getattr(settings, "IMAGE_DERIVATIVE_QUALITY", 80),
+        getattr(settings, "IMAGE_DERIVATIVE_AVIF", False),
+    )
+    # Uploading is I/O; hand it back to a thread instead of the pool's manager thread
+    future.add_done_callback(lambda done: upload_pool.submit(store_derivatives, image_id, public_id, done))
+
+
+def store_derivatives(image_id, public_id, future):
+    try:
+        urls = {}
+        for name, data in future.result().items():
+            response = providers.upload(
+                BytesIO(data),
+                public_id=f"{public_id}_{name}",
+                resource_type="image",
+                format="avif" if name == "avif" else "webp",
+            )
+            urls[f"{name}_url"] = response["secure_url"]
+        GeneratedImage.objects.filter(id=image_id).update(**urls)
+    except Exception:
+        logger.exception("Building derivatives of %s failed", public_id)
+    finally:
+        connection.close()
+
+
+def store_image_in_background(prompt, data, public_id, user_id=None):
+    try:
+        store_image(prompt, data, public_id, user_id)
+    except Exception:
+        logger.exception("Background upload of %s failed", public_id)
+    finally:
+        # Pool threads outlive requests, so don't leave their connection open
+        connection.close()
+
+
+def save_image(prompt, inline_data, user_id=None):
+    """
+    Upload a generated image and return its public URL.
+
+    With IMAGE_UPLOAD_IN_BACKGROUND the URL is derived from the public_id up
+    front and the upload plus the GeneratedImage row happen on a pool
+    thread, so the response doesn't wait for Cloudinary.
+    """
+    extension = (mimetypes.guess_extension(inline_data.mime_type) or ".png").lstrip(".")
+    public_id = new_public_id()
+
+    if getattr(settings, "IMAGE_UPLOAD_IN_BACKGROUND", True):
+        submit(upload_pool, store_image_in_background, prompt, inline_data.data, public_id, user_id)
+        return providers.asset_url(public_id, format=extension)
+
+    return store_image(prompt, inline_data.data, public_id, user_id)
+
+
+def create_image(prompt, user_id=None):
+    """Generate and save an image; returns its URL, or None if Gemini returned no image."""
+    inline_data = generate_image(prompt)
+    return save_image(prompt, inline_data, user_id) if inline_data else None
+
+
+async def acreate_image(prompt, user_id=None):
+    inline_data = await agenerate_image(prompt)
+    return await sync_to_async(save_image)(prompt, inline_data, user_id) if inline_data else None
+
+
+def generate_and_upload(prompt):
+    """One batch item: returns ``(url, public_id, data)``; raises if there is no image."""
+    inline_data = generate_image(prompt)
+    if not inline_data:
+        raise ValueError("Image generation failed.")
+    public_id = new_public_id()
+    return upload_image(inline_data.data, public_id), public_id, inline_data.data
+
+
+async def agenerate_and_upload(prompt):
+    inline_data = await agenerate_image(prompt)
+    if not inline_data:
+        raise ValueError("Image generation failed.")
+    public_id = new_public_id()
+    url = await asyncio.wrap_future(submit(batch_pool, upload_image, inline_data.data, public_id))
+    return url, public_id, inline_data.data
+
+
+def store_batch(prompts, stored, user_id):
+    """Write the rows of a batch's successful items (``(index, url, public_id, data)``) at once."""
+    if not stored:
+        return
+    rows = GeneratedImage.objects.bulk_create([image_row(prompts[index], url, user_id) for index, url, _, _ in stored])
+    for row, (_, _, public_id, data) in zip(rows, stored):
+        if row.pk is not None:  # backends without RETURNING don't set it
+            schedule_derivatives(row.pk, public_id, data)
+
+
+def generate_batch(prompts, user_id=None, concurrency=None):
+    """
+    Generate ``prompts`` with at most ``concurrency`` in flight on batch_pool,
+    yielding ``(index, url, error)`` for each item as soon as it finishes.
+    The GeneratedImage rows of the successful items are written with one
+    bulk_create when the batch ends (or the client goes away).
+    """
+    concurrency = concurrency or getattr(settings, "IMAGE_BATCH_CONCURRENCY", 3)
+    pending = {}
+    queue = list(enumerate(prompts))
+    stored = []  # (index, url, public_id, data)
+
+    def top_up():
+        while queue and len(pending) < concurrency:
+            index, prompt = queue.pop(0)
+            pending[submit(batch_pool, generate_and_upload, prompt)] = index
+
+    try:
+        top_up()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    url, public_id, data = future.result()
+                except Exception as e:
+                    logger.warning("Batch item %d failed: %s", index, e)
+                    yield index, None, str(e)
+                else:
+                    stored.append((index, url, public_id, data))
+                    yield index, url, None
+            top_up()
+    finally:
+        for future in pending:
+            future.cancel()
+        store_batch(prompts, stored, user_id)
+
+
+async def agenerate_batch(prompts, user_id=None, concurrency=None):
+    """generate_batch for async views: the items are tasks on the event loop."""
+    concurrency = concurrency or getattr(settings, "IMAGE_BATCH_CONCURRENCY", 3)
+    pending = {}
+    queue = list(enumerate(prompts))
+    stored = []
+
+    def top_up():
+        while queue and len(pending) < concurrency:
+            index, prompt = queue.pop(0)
+            pending[asyncio.ensure_future(agenerate_and_upload(prompt))] = index
+
+    try:
+        top_up()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = pending.pop(task)
+                try:
+                    url, public_id, data = task.result()
+                except Exception as e:
+                    logger.warning("Batch item %d failed: %s", index, e)
+                    yield index, None, str(e)
+                else:
+                    stored.append((index, url, public_id, data))
+                    yield index, url, None
+            top_up()
+    finally:
+        for task in pending:
+            task.cancel()
+        await sync_to_async(store_batch)(prompts, stored, user_id)
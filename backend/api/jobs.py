@@ -0,0 +1,151 @@
+# jobs.py
+#
+# Database-backed queue for image generation. POST /api/generate-image/ with
+# "async": true stores an ImageJob and returns its id right away; a small pool
+# of worker threads in each server process claims queued jobs with an atomic
+# UPDATE, runs the generation and records the URL or the error. Because the
+# queue lives in the database, queued jobs survive a restart, and jobs left
+# "running" by a dead process are put back in the queue by the workers of the
+# other processes, which look for them every IMAGE_JOB_REQUEUE_INTERVAL.
+# `manage.py process_image_jobs` runs the same workers as a standalone process.
+
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from . import images
+from .models import ImageJob
+from .quotas import quota_cost, refund_quota
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ImageJobQueue:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.next_requeue = 0.0  # monotonic time of the next stale-job sweep
+
+    def enqueue(self, prompt, user_id=None):
+        max_queued = getattr(settings, "IMAGE_JOB_MAX_QUEUED", 100)
+        if ImageJob.objects.filter(status=ImageJob.QUEUED).count() >= max_queued:
+            raise QueueFull(f"The image queue is full ({max_queued} jobs waiting).")
+
+        job = ImageJob.objects.create(prompt=prompt, user_id=user_id)
+        self.start()
+        self.wakeup.set()
+        return job
+
+    def start(self, workers=None):
+        """Start the worker threads of this process (no-op if already running)."""
+        if self.threads:
+            return
+        with self.lock:
+            if self.threads:
+                return
+            workers = workers or getattr(settings, "IMAGE_JOB_WORKERS", 2)
+            for index in range(workers):
+                thread = threading.Thread(target=self.work, name=f"image-job-{index}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            logger.info("Started %d image job workers", workers)
+
+    def requeue_stale_periodically(self):
+        """requeue_stale() at most every IMAGE_JOB_REQUEUE_INTERVAL seconds per process."""
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next_requeue:
+                return
+            self.next_requeue = now + getattr(settings, "IMAGE_JOB_REQUEUE_INTERVAL", 60)
+        self.requeue_stale()
+
+    def requeue_stale(self):
+        cutoff = timezone.now() - timedelta(seconds=getattr(settings, "IMAGE_JOB_STALE_AFTER", 300))
+        count = ImageJob.objects.filter(status=ImageJob.RUNNING, started_at__lt=cutoff).update(
+            status=ImageJob.QUEUED, started_at=None
+        )
+        if count:
+            logger.warning("Re-queued %d stale image jobs", count)
+
+    def claim(self):
+        """Atomically move the oldest queued job to running, or return None."""
+        for job_id in ImageJob.objects.filter(status=ImageJob.QUEUED).order_by("created_at").values_list("id", flat=True)[:5]:
+            claimed = ImageJob.objects.filter(id=job_id, status=ImageJob.QUEUED).update(
+                status=ImageJob.RUNNING, started_at=timezone.now()
+            )
+            if claimed:
+                return ImageJob.objects.get(id=job_id)
+        return None
+
+    def work(self):
+        poll_interval = getattr(settings, "IMAGE_JOB_POLL_INTERVAL", 2)
+        while not self.stopping.is_set():
+            try:
+                # Jobs of a process that died at any time, not only before we started
+                self.requeue_stale_periodically()
+                job = self.claim()
+            except Exception:
+                logger.exception("Could not claim an image job")
+                job = None
+
+            if job is None:
+                connection.close()
+                self.wakeup.wait(poll_interval)
+                self.wakeup.clear()
+                continue
+
+            self.run(job)
+
+    def run(self, job):
+        try:
+            inline_data = images.generate_image(job.prompt)
+            if not inline_data:
+                raise ValueError("Image generation failed.")
+            job.result_url = images.store_image(job.prompt, inline_data.data, images.new_public_id(), job.user_id)
+            job.status = ImageJob.DONE
+        except Exception as e:
+            logger.exception("Image job %s failed", job.id)
+            job.status = ImageJob.FAILED
+            job.error = str(e)
+            if job.user_id is not None:
+                # Charged when the job was queued (a 202, so never refunded by the view)
+                refund_quota(job.user_id, quota_cost("image"))
+        job.finished_at = timezone.now()
+        job.save(update_fields=["status", "result_url", "error", "finished_at"])
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+
+
+image_jobs = ImageJobQueue()
+
+if hasattr(os, "register_at_fork"):
+    # Worker threads don't survive a fork; the child starts its own
+    os.register_at_fork(after_in_child=image_jobs.reset)
+
+
+def job_payload(job):
+    return {
+        "job_id": str(job.id),
+        "status": job.status,
+        "file_name": job.result_url or None,
+        "error": job.error or None,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
@@ -0,0 +1,63 @@
+import random
+import re
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from api.custom_responses import CustomResponseMatcher, load_custom_responses
+
+
+def legacy_detect_custom_response(table, user_message):
+    """The original per-keyword loop, kept here as the baseline."""
+    user_message_lower = user_message.lower()
+
+    for category, data in table.items():
+        for keyword in data['keywords']:
+            if re.search(rf'\b{re.escape(keyword)}\b', user_message_lower):
+                return data['response']
+    return None
+
+
+FILLER = (
+    "explain how a hash map handles collisions and why the load factor matters "
+    "for lookups in python dictionaries and java hashmaps "
+).split()
+
+
+class Command(BaseCommand):
+    help = "Compare the compiled custom-response matcher with the original keyword loop."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--words", type=int, default=2000, help="Words per generated message.")
+        parser.add_argument("--number", type=int, default=200, help="Timed calls per case.")
+        parser.add_argument("--file", help="Custom responses JSON file (defaults to the configured one).")
+
+    def handle(self, *args, **options):
+        table = load_custom_responses(options["file"])
+        matcher = CustomResponseMatcher(table)
+        rng = random.Random(42)
+
+        def message(suffix=""):
+            words = [rng.choice(FILLER) for _ in range(options["words"])]
+            return " ".join(words) + suffix
+
+        cases = {
+            "no match": message(),
+            "match at end": message(" so who is the owner of dark ai"),
+            "short greeting": "hi there",
+            "short identity": "hey, what's your name?",
+        }
+
+        for name, text in cases.items():
+            expected = legacy_detect_custom_response(table, text)
+            if matcher.match(text) != expected:
+                raise AssertionError(f"Matcher disagrees with the legacy loop on {name!r}")
+
+            legacy = timeit.timeit(lambda: legacy_detect_custom_response(table, text), number=options["number"])
+            compiled = timeit.timeit(lambda: matcher.match(text), number=options["number"])
+            per_call = 1e6 / options["number"]
+            self.stdout.write(
+                f"{name:<16} legacy {legacy * per_call:9.1f} us  "
+                f"compiled {compiled * per_call:9.1f} us  "
+                f"speedup {legacy / compiled:5.1f}x"
+            )
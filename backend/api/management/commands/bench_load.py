@@ -0,0 +1,285 @@
+import asyncio
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from itertools import count
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.urls import clear_url_caches
+
+from api.fakes import FakeProviders
+from api.quotas import limiter
+
+HOST = "testserver"
+BENCH_EMAIL = "bench@example.com"
+BENCH_PASSWORD = "bench-password-123"
+
+ENDPOINTS = {
+    "chat": ("/api/chat/", lambda i: {"message": f"Benchmark question number {i}?"}),
+    "image": ("/api/generate-image/", lambda i: {"prompt": f"A benchmark landscape, variant {i}"}),
+    "tts": ("/api/text-to-speech/", lambda i: {"text": f"Benchmark sentence number {i}.", "lang": "en"}),
+    "auth": ("/api/auth/", lambda i: {"action": "signin", "email": BENCH_EMAIL, "password": BENCH_PASSWORD}),
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+
+    def ms(seconds):
+        return round(seconds * 1000, 2) if seconds is not None else None
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "mean_ms": ms(statistics.fmean(latencies)) if latencies else None,
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+    }
+
+
+def wsgi_environ(path, body):
+    return {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": HOST,
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": HOST,
+        "REMOTE_ADDR": "127.0.0.1",
+        "CONTENT_TYPE": "application/json",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+
+
+def run_wsgi(application, path, payload, total, concurrency, numbers):
+    latencies = []
+    errors = 0
+
+    def call():
+        status = []
+        started = time.perf_counter()
+        body = application(
+            wsgi_environ(path, json.dumps(payload(next(numbers))).encode()),
+            lambda status_line, headers, exc_info=None: status.append(int(status_line.split()[0])),
+        )
+        try:
+            for _ in body:
+                pass
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+        return time.perf_counter() - started, status[0]
+
+    def worker(n):
+        nonlocal errors
+        for _ in range(n):
+            latency, status = call()
+            latencies.append(latency)
+            if status >= 400:
+                errors += 1
+        connection.close()
+
+    shares = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker, n) for n in shares]:
+            future.result()
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def asgi_call(application, path, body):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", HOST.encode()),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": (HOST, 80),
+    }
+    sent_body = False
+    status = []
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # The client never disconnects; Django cancels this wait once it has responded
+        await asyncio.Future()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await application(scope, receive, send)
+    return status[0]
+
+
+def run_asgi(application, path, payload, total, concurrency, numbers):
+    latencies = []
+    errors = 0
+
+    async def worker(n):
+        nonlocal errors
+        for _ in range(n):
+            started = time.perf_counter()
+            status = await asgi_call(application, path, json.dumps(payload(next(numbers))).encode())
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors += 1
+
+    async def main():
+        shares = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+        await asyncio.gather(*(worker(n) for n in shares))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def use_async_views(enabled):
+    """Re-import the URLconfs so api/urls.py picks the sync or async views."""
+    settings.ASYNC_VIEWS = enabled
+    importlib.reload(importlib.import_module("api.urls"))
+    importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+    clear_url_caches()
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the chat, image, TTS and auth endpoints under WSGI and ASGI against local "
+        "provider fakes, and write p50/p95/p99 latency and requests/second to a JSON file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--servers", default="wsgi,asgi", help="Comma-separated: wsgi, asgi.")
+        parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="Comma-separated: " + ", ".join(ENDPOINTS))
+        parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels.")
+        parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint and level.")
+        parser.add_argument("--latency", type=float, default=0.1, help="Fake provider latency in seconds.")
+        parser.add_argument("--payload-bytes", type=int, default=4096, help="Fake reply/image/audio size.")
+        parser.add_argument(
+            "--output",
+            default=os.path.join(tempfile.gettempdir(), "load_bench.json"),
+            help="Where to write the JSON results (default: the system temp directory).",
+        )
+
+    def handle(self, *args, **options):
+        servers = options["servers"].split(",")
+        endpoints = options["endpoints"].split(",")
+        levels = [int(level) for level in options["concurrency"].split(",")]
+        unknown = [name for name in endpoints if name not in ENDPOINTS] + [s for s in servers if s not in ("wsgi", "asgi")]
+        if unknown:
+            raise CommandError(f"Unknown server or endpoint: {', '.join(unknown)}")
+
+        # Same isolation as the test runner: locmem email, a throwaway database
+        setup_test_environment()
+        db = connections["default"]
+        if db.vendor == "sqlite":
+            # A file, not shared-cache memory, so concurrent writers wait instead of failing
+            fd, db.settings_dict["TEST"]["NAME"] = tempfile.mkstemp(prefix="bench-", suffix=".sqlite3")
+            os.close(fd)
+        old_name = db.creation.create_test_db(verbosity=0, autoclobber=True)
+        async_views = settings.ASYNC_VIEWS
+
+        results = []
+        try:
+            User.objects.create_user(username="bench", email=BENCH_EMAIL, password=BENCH_PASSWORD, is_active=True)
+            fakes = FakeProviders(latency=options["latency"], payload_bytes=options["payload_bytes"])
+            unthrottled = [
+                mock.patch.object(limiter, "rate", float("inf")),
+                mock.patch.object(limiter, "burst", float("inf")),
+            ]
+            quiet = override_settings(DEBUG=False, EMAIL_OUTBOX_IN_BACKGROUND=False)
+            # One sequence for the whole run: payloads restarting at 0 for every
+            # server and level would be answered from the chat and TTS caches
+            numbers = count()
+            with fakes, unthrottled[0], unthrottled[1], quiet:
+                for server in servers:
+                    use_async_views(server == "asgi")
+                    application = get_asgi_application() if server == "asgi" else get_wsgi_application()
+                    run = run_asgi if server == "asgi" else run_wsgi
+                    for name in endpoints:
+                        path, payload = ENDPOINTS[name]
+                        for level in levels:
+                            result = run(application, path, payload, options["requests"], level, numbers)
+                            result.update(server=server, endpoint=name, concurrency=level)
+                            results.append(result)
+                            self.stdout.write(
+                                f"{server:<4} {name:<6} c={level:<4} {result['rps']:>9} rps  "
+                                f"p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms  "
+                                f"p99 {result['p99_ms']:>8} ms  errors {result['errors']}"
+                            )
+                provider_calls = fakes.calls()
+        finally:
+            use_async_views(async_views)
+            db.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "config": {
+                "requests": options["requests"],
+                "latency_s": options["latency"],
+                "payload_bytes": options["payload_bytes"],
+            },
+            "provider_calls": provider_calls,
+            "results": results,
+        }
+        with open(options["output"], "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(f"Wrote {len(results)} results to {options['output']}")
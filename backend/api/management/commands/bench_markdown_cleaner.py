@@ -0,0 +1,93 @@
+import json
+import os
+import random
+import re
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.markdown import MarkdownCleaner, clean_gemini_response
+
+GOLDEN_FILE = os.path.join(os.path.dirname(__file__), "..", "..", "data", "markdown_golden.json")
+
+
+def legacy_clean_gemini_response(text):
+    """The original three-pass regex cleaner, kept here as the baseline."""
+    cleaned = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+    cleaned = re.sub(r'\*(.*?)\*', r'\1', cleaned)
+    cleaned = re.sub(r'^\s+', '', cleaned, flags=re.MULTILINE)
+    return cleaned.strip()
+
+
+def split_chunks(text, rng):
+    chunks = []
+    i = 0
+    while i < len(text):
+        size = rng.randint(1, 16)
+        chunks.append(text[i:i + size])
+        i += size
+    return chunks
+
+
+def clean_chunks(chunks):
+    cleaner = MarkdownCleaner()
+    out = [cleaner.feed(chunk) for chunk in chunks]
+    out.append(cleaner.flush())
+    return "".join(out)
+
+
+def clean_in_chunks(text, rng):
+    return clean_chunks(split_chunks(text, rng))
+
+
+SECTION = """## Section {n}
+
+Here is **important** text with *some emphasis*, a `code_span()` and more words to read.
+  - first point with **bold**
+  - second point
+
+```python
+def step_{n}(x):
+    return x * 2
+```
+
+"""
+
+
+class Command(BaseCommand):
+    help = "Check the markdown cleaner against its golden outputs and benchmark it against the old regex cleaner."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="4,64,512", help="Comma-separated answer sizes in KB.")
+        parser.add_argument("--number", type=int, default=20, help="Timed calls per size.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+
+        with open(GOLDEN_FILE, encoding="utf-8") as f:
+            golden = json.load(f)
+        for case in golden:
+            for mode, got in (
+                ("whole", clean_gemini_response(case["input"])),
+                ("chunked", clean_in_chunks(case["input"], rng)),
+            ):
+                if got != case["expected"]:
+                    raise CommandError(f"Golden case {case['name']!r} ({mode}) returned {got!r}")
+        self.stdout.write(f"{len(golden)} golden cases OK")
+
+        for size in (int(kb) for kb in options["sizes"].split(",")):
+            text = ""
+            while len(text) < size * 1024:
+                text += SECTION.format(n=len(text))
+
+            legacy = timeit.timeit(lambda: legacy_clean_gemini_response(text), number=options["number"])
+            single = timeit.timeit(lambda: clean_gemini_response(text), number=options["number"])
+            # Split beforehand so that only the cleaner is timed
+            chunks = split_chunks(text, rng)
+            chunked = timeit.timeit(lambda: clean_chunks(chunks), number=options["number"])
+            per_call = 1000 / options["number"]
+            self.stdout.write(
+                f"{size:>5} KB  legacy {legacy * per_call:8.2f} ms  "
+                f"single-pass {single * per_call:8.2f} ms  "
+                f"chunked {chunked * per_call:8.2f} ms"
+            )
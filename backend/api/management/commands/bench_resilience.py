@@ -0,0 +1,120 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from api import resilience
+from api.fakes import FakeChatModel, Faults
+from api.metrics import registry
+
+from .bench_load import summarize
+
+PROVIDER = "bench"
+
+MODES = {
+    "plain": {"PROVIDER_RETRIES": 0, "PROVIDER_HEDGE": False},
+    "retries": {"PROVIDER_HEDGE": False},
+    "retries+hedge": {"PROVIDER_HEDGE": True},
+}
+
+
+def events():
+    return {event: count for (provider, event), count in registry.upstream_events.items() if provider == PROVIDER}
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive api/resilience.py against a flaky fake Gemini (injected 503s and slow calls) "
+        "without and with retries and hedging, then trip the circuit breaker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=400)
+        parser.add_argument("--concurrency", type=int, default=16)
+        parser.add_argument("--latency", type=float, default=0.05, help="Normal fake latency, seconds.")
+        parser.add_argument("--failure-rate", type=float, default=0.05)
+        parser.add_argument("--slow-rate", type=float, default=0.03)
+        parser.add_argument("--slow-latency", type=float, default=1.0)
+        parser.add_argument("--timeout", type=float, default=2.0, help="PROVIDER_TIMEOUT for the run.")
+        parser.add_argument("--deadline", type=float, default=5.0, help="REQUEST_DEADLINE for the run.")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--output", help="Also write the results to this JSON file.")
+
+    def run_mode(self, options, overrides):
+        faults = Faults(options["failure_rate"], options["slow_rate"], options["slow_latency"], options["seed"])
+        model = FakeChatModel(options["latency"], 256, faults=faults)
+
+        def one_request(i):
+            token = resilience.deadline.set(time.monotonic() + options["deadline"])
+            started = time.monotonic()
+            try:
+                resilience.call(PROVIDER, lambda timeout: model.generate_content(
+                    f"question {i}", request_options={"timeout": timeout}))
+                return time.monotonic() - started, None
+            except Exception as e:
+                return time.monotonic() - started, type(e).__name__
+            finally:
+                resilience.deadline.reset(token)
+
+        resilience.policies.reset()
+        before = events()
+        with override_settings(PROVIDER_TIMEOUT=options["timeout"], PROVIDER_BREAKER_FAILURES=10 ** 6, **overrides):
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+                results = list(pool.map(one_request, range(options["requests"])))
+            elapsed = time.monotonic() - started
+
+        latencies = [seconds for seconds, error in results if error is None]
+        errors = {}
+        for _, error in results:
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+        report = summarize(latencies, sum(errors.values()), elapsed)
+        report["success_rate"] = round(len(latencies) / len(results), 4)
+        report["error_types"] = errors
+        report["provider_calls"] = model.calls
+        report["injected"] = dict(faults.injected)
+        report["events"] = {k: v - before.get(k, 0) for k, v in events().items() if v - before.get(k, 0)}
+        return report
+
+    def run_breaker(self, options):
+        """A provider that always fails: how many calls reach it before the breaker opens."""
+        model = FakeChatModel(0, 16, faults=Faults(failure_rate=1.0, seed=options["seed"]))
+        resilience.policies.reset()
+        before = events()
+        outcomes = {}
+        with override_settings(PROVIDER_RETRIES=0, PROVIDER_HEDGE=False,
+                               PROVIDER_BREAKER_FAILURES=5, PROVIDER_BREAKER_RESET=60):
+            for i in range(50):
+                try:
+                    resilience.call(PROVIDER, lambda timeout: model.generate_content(
+                        "question", request_options={"timeout": timeout}))
+                except Exception as e:
+                    outcomes[type(e).__name__] = outcomes.get(type(e).__name__, 0) + 1
+        return {
+            "requests": 50,
+            "provider_calls": model.calls,
+            "error_types": outcomes,
+            "events": {k: v - before.get(k, 0) for k, v in events().items() if v - before.get(k, 0)},
+        }
+
+    def handle(self, *args, **options):
+        results = {name: self.run_mode(options, overrides) for name, overrides in MODES.items()}
+        for name, report in results.items():
+            self.stdout.write(
+                f"{name:>14}: {report['success_rate'] * 100:.1f}% ok, p50 {report['p50_ms']} ms, "
+                f"p95 {report['p95_ms']} ms, p99 {report['p99_ms']} ms, "
+                f"{report['provider_calls']} provider calls, events {report['events']}"
+            )
+
+        results["breaker"] = breaker = self.run_breaker(options)
+        self.stdout.write(
+            f"{'breaker':>14}: {breaker['provider_calls']} of {breaker['requests']} calls reached a dead "
+            f"provider, the rest failed fast ({breaker['error_types']})"
+        )
+
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
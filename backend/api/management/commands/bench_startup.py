@@ -0,0 +1,119 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Must never be imported to answer ping or auth
+FORBIDDEN = ("google.generativeai", "google.genai", "gtts", "PIL")
+# Reported for information
+HEAVY = FORBIDDEN + ("cloudinary.uploader", "httpx")
+
+# Runs in a fresh interpreter: load the real WSGI entry point, answer a ping
+# and a signin, then import the provider SDKs to show what was deferred.
+CHILD = r"""
+import importlib, io, json, os, sys, time
+
+started = time.perf_counter()
+from backend.wsgi import application
+ready = time.perf_counter() - started
+
+def call(method, path, body=b""):
+    status = []
+    environ = {
+        "REQUEST_METHOD": method, "PATH_INFO": path, "QUERY_STRING": "",
+        "SERVER_NAME": "localhost", "SERVER_PORT": "80", "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": "localhost", "REMOTE_ADDR": "127.0.0.1",
+        "CONTENT_TYPE": "application/json", "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0), "wsgi.url_scheme": "http", "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr, "wsgi.multithread": True, "wsgi.multiprocess": False, "wsgi.run_once": False,
+    }
+    b"".join(application(environ, lambda s, h, e=None: status.append(int(s.split()[0]))))
+    return status[0]
+
+heavy = json.loads(os.environ["BENCH_HEAVY_MODULES"])
+loaded = lambda: [name for name in heavy if name in sys.modules]
+
+ping_status = call("GET", "/api/ping/")
+first_ping = time.perf_counter() - started
+after_ping = loaded()
+
+auth_status = call("POST", "/api/auth/", json.dumps({"action": "signin", "email": "nobody@example.com", "password": "x"}).encode())
+after_auth = loaded()
+
+sdk_started = time.perf_counter()
+for name in heavy:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        pass
+sdk_import = time.perf_counter() - sdk_started
+
+print(json.dumps({
+    "ready_s": ready, "first_ping_s": first_ping, "sdk_import_s": sdk_import,
+    "ping_status": ping_status, "auth_status": auth_status,
+    "loaded_after_ping": after_ping, "loaded_after_auth": after_auth,
+}))
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure cold start: time until the WSGI app is ready and has answered /api/ping/ in a "
+        "fresh process, and check that ping and auth don't import the provider SDKs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5, help="Fresh processes to start.")
+        parser.add_argument("--output", help="Also write the results to this JSON file.")
+
+    def run_child(self):
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE=os.environ.get("DJANGO_SETTINGS_MODULE", "backend.settings"),
+            BENCH_HEAVY_MODULES=json.dumps(HEAVY),
+            # Only the request path is being measured
+            PROVIDER_WARMUP="False",
+            IMAGE_JOB_WORKERS_AUTOSTART="False",
+            EMAIL_OUTBOX_IN_BACKGROUND="False",
+        )
+        child = subprocess.run(
+            [sys.executable, "-c", CHILD], cwd=settings.BASE_DIR, env=env, capture_output=True, text=True
+        )
+        if child.returncode != 0:
+            raise CommandError(f"Startup probe failed:\n{child.stderr}")
+        return json.loads(child.stdout.strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        runs = [self.run_child() for _ in range(options["runs"])]
+
+        def median_ms(key):
+            return round(statistics.median(run[key] for run in runs) * 1000, 1)
+
+        report = {
+            "runs": len(runs),
+            "ready_ms": median_ms("ready_s"),
+            "first_ping_ms": median_ms("first_ping_s"),
+            "deferred_sdk_import_ms": median_ms("sdk_import_s"),
+            "loaded_after_ping": runs[-1]["loaded_after_ping"],
+            "loaded_after_auth": runs[-1]["loaded_after_auth"],
+            "ping_status": runs[-1]["ping_status"],
+            "auth_status": runs[-1]["auth_status"],
+        }
+        self.stdout.write(
+            f"ready {report['ready_ms']} ms, first ping {report['first_ping_ms']} ms "
+            f"(median of {len(runs)}); SDK imports deferred off that path: {report['deferred_sdk_import_ms']} ms"
+        )
+        self.stdout.write(f"loaded after ping: {', '.join(report['loaded_after_ping']) or 'none'}")
+        self.stdout.write(f"loaded after auth: {', '.join(report['loaded_after_auth']) or 'none'}")
+
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+
+        leaked = sorted(set(FORBIDDEN) & set(report["loaded_after_ping"] + report["loaded_after_auth"]))
+        if leaked:
+            raise CommandError(f"Ping/auth imported provider SDKs: {', '.join(leaked)}")
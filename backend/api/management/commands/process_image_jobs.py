@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.jobs import image_jobs
+
+
+class Command(BaseCommand):
+    help = "Run image generation job workers in a standalone process."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, help="Worker threads (defaults to IMAGE_JOB_WORKERS).")
+
+    def handle(self, *args, **options):
+        image_jobs.start(options["workers"])
+        self.stdout.write(f"Processing image jobs with {len(image_jobs.threads)} workers (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            image_jobs.stop()
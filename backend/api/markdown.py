@@ -0,0 +1,250 @@
+import re
+
+from .metrics import stage
+
+FENCES = ("```", "~~~")
+SPECIAL = re.compile(r"[`*]")
+# Well-formed emphasis pairs on one line with no stars or backticks inside: a
+# stricter version of the rules in strip_emphasis, applied in C (see there).
+# Every pattern below starts with a literal so that re can skip ahead to it.
+SIMPLE_EMPHASIS = re.compile(
+    r"\*(?:(?<![*\w]\*)(?=[^\s*])([^*`\n]*[^\s*`])\*(?![*\w])"
+    r"|(?<!\*\*)(\*\*?)(?=[^\s*])([^*`\n]*[^\s*`])\*\2(?!\*))"
+)
+SIMPLE_CODE_SPAN = re.compile(r"`[^`*\n]+`")
+# For whole texts (clean_text): a fenced block from the newline before it, and
+# the whitespace (blank lines included) at the start of a line
+FENCED_BLOCK = re.compile(
+    r"\n[^\S\n]*((```|~~~)[^\n]*)"              # opening line
+    r"(?:((?:\n[^\n]*)*?)\n[^\S\n]*(\2[^\n]*)"  # code, closing line
+    r"|(\n[\s\S]*)?\Z)"                        # or code up to the end
+)
+LEADING_WHITESPACE = re.compile(r"\n\s+")
+STAR_LINE = re.compile(r"^[^\n]*\*[^\n]*", re.MULTILINE)
+
+
+class MarkdownCleaner:
+    """
+    Single-pass cleaner for Gemini markdown that accepts text in chunks.
+
+    Outside fenced code blocks it removes paired bold/italic markers, strips
+    leading whitespace and drops blank lines (the behaviour of the old regex
+    cleaner). Fenced blocks and inline code spans are left untouched, and a
+    ``*`` followed by whitespace (list bullets, ``a * b``) is never treated as
+    emphasis. Each line is scanned once, so the cost is linear in the input;
+    whole texts go through ``clean_text``, which does the same with regexes.
+
+    Usage::
+
+        cleaner = MarkdownCleaner()
+        for chunk in chunks:
+            out = cleaner.feed(chunk)
+        out = cleaner.flush()
+    """
+
+    def __init__(self):
+        self.partial = ""      # text after the last newline
+        self.in_fence = None   # fence marker while inside a code block
+        self.started = False   # whether any line has been emitted
+        self.pending = ""      # trailing whitespace/blank lines held back
+
+    def feed(self, chunk):
+        self.partial += chunk
+        if "\n" not in chunk:
+            return ""
+        *lines, self.partial = self.partial.split("\n")
+        return self.process_lines(lines)
+
+    def flush(self):
+        out = self.process_lines([self.partial])
+        self.partial = ""
+        self.pending = ""
+        return out
+
+    def clean(self, text):
+        if not (self.partial or self.started):
+            return clean_text(text)
+        return self.feed(text) + self.flush()
+
+    def process_lines(self, lines):
+        # One loop with the state in locals: per-line method calls and
+        # attribute updates used to cost more than the cleaning itself
+        out = []
+        in_fence, started, pending = self.in_fence, self.started, self.pending
+
+        for line in lines:
+            stripped = line.lstrip()
+
+            if in_fence is not None:
+                if stripped.startswith(in_fence):
+                    in_fence = None
+                    content = stripped
+                elif not stripped:
+                    # Keep blank lines inside code, but only once more code follows
+                    if started:
+                        pending += "\n" + line
+                    continue
+                else:
+                    content = line
+            elif not stripped:
+                continue
+            elif stripped[:3] in FENCES:
+                in_fence = stripped[:3]
+                content = stripped
+            elif "*" in stripped:
+                content = strip_emphasis(stripped)
+            else:
+                content = stripped
+
+            # Trailing whitespace is held back until another line follows
+            body = content.rstrip()
+            if started:
+                out.append(pending + "\n" + body)
+            else:
+                out.append(body)
+                started = True
+            pending = content[len(body):] if len(body) != len(content) else ""
+
+        self.in_fence, self.started, self.pending = in_fence, started, pending
+        return "".join(out)
+
+
+def strip_emphasis(line):
+    """Remove paired ``*``/``**``/``***`` markers from one line, skipping code spans."""
+    if "*" not in line:
+        return line
+    if simple_code_spans(line):
+        # Common case: only simple pairs. If they account for every star, the
+        # full scan below would remove exactly the same markers.
+        simple = SIMPLE_EMPHASIS.sub(simple_pair_content, line)
+        if "*" not in simple:
+            return simple
+
+    out = []
+    openers = []  # (run length, index in out) of unmatched opening markers
+    i = 0
+    length = len(line)
+
+    while i < length:
+        char = line[i]
+
+        if char == "`":
+            run = 1
+            while i + run < length and line[i + run] == "`":
+                run += 1
+            end = line.find("`" * run, i + run)
+            if end == -1:
+                out.append(line[i:i + run])
+                i += run
+            else:
+                out.append(line[i:end + run])
+                i = end + run
+            continue
+
+        if char == "*":
+            run = 1
+            while i + run < length and line[i + run] == "*":
+                run += 1
+            before = line[i - 1] if i else ""
+            after = line[i + run] if i + run < length else ""
+            # Single stars must not touch a word on the outside, so "2*3*4"
+            # stays as written; bold may sit inside a word.
+            can_open = bool(after) and not after.isspace() and (run > 1 or not before.isalnum())
+            can_close = bool(before) and not before.isspace() and (run > 1 or not after.isalnum())
+
+            if run <= 3 and can_close and openers and openers[-1][0] == run:
+                _, index = openers.pop()
+                out[index] = ""
+            elif run <= 3 and can_open:
+                openers.append((run, len(out)))
+                out.append(line[i:i + run])
+            else:
+                out.append(line[i:i + run])
+            i += run
+            continue
+
+        found = SPECIAL.search(line, i)
+        end = found.start() if found else length
+        out.append(line[i:end])
+        i = end
+
+    return "".join(out)
+
+
+def simple_code_spans(line):
+    """Whether the code spans of ``line`` are single-backtick pairs without stars."""
+    if "`" not in line:
+        return True
+    parts = line.split("`")
+    spans = parts[1::2]
+    return len(parts) % 2 == 1 and all(span and "*" not in span for span in spans)
+
+
+def simple_pair_content(match):
+    return match[1] or match[3]
+
+
+def clean_prose(text):
+    """Lines outside code blocks: leading whitespace, blank lines and emphasis removed."""
+    text = LEADING_WHITESPACE.sub("\n", text.lstrip()).rstrip("\n")
+    if "*" not in text:
+        return text
+    # Same shortcut as in strip_emphasis, for all lines at once
+    simple = SIMPLE_EMPHASIS.sub(simple_pair_content, text)
+    if "*" not in simple and "`" not in SIMPLE_CODE_SPAN.sub("", text):
+        return simple
+    return STAR_LINE.sub(lambda match: strip_emphasis(match.group()), text)
+
+
+def clean_text(text):
+    """MarkdownCleaner().clean(text), mostly in C: prose in bulk, code blocks copied as they are."""
+    # Prose, then the five groups of FENCED_BLOCK for each block
+    parts = FENCED_BLOCK.split("\n" + text)
+    prose = parts[::6]
+    code = [
+        opening + (lines or rest or "") + ("\n" + closing if closing is not None else "")
+        for opening, _, lines, closing, rest, _ in zip(*[iter(parts[1:])] * 6)
+    ]
+
+    if "\0" in text:
+        prose = [clean_prose(part) for part in prose]
+    else:
+        # Clean all prose in one go, with a NUL line where each code block was
+        prose = [part.strip("\n") for part in clean_prose("\n\0\n".join(prose)).split("\0")]
+
+    blocks = []
+    for i, part in enumerate(prose):
+        if part:
+            blocks.append(part)
+        if i < len(code):
+            blocks.append(code[i])
+    return "\n".join(blocks).rstrip()
+
+
+def clean_gemini_response(text):
+    if not isinstance(text, str):
+        return text
+    with stage("markdown"):
+        return clean_text(text)
+
+
+def clean_gemini_stream(chunks):
+    cleaner = MarkdownCleaner()
+    for chunk in chunks:
+        out = cleaner.feed(chunk)
+        if out:
+            yield out
+    out = cleaner.flush()
+    if out:
+        yield out
+
+
+async def aclean_gemini_stream(chunks):
+    cleaner = MarkdownCleaner()
+    async for chunk in chunks:
+        out = cleaner.feed(chunk)
+        if out:
+            yield out
+    out = cleaner.flush()
+    if out:
+        yield out
@@ -0,0 +1,311 @@
+# metrics.py
+#
+# Low-overhead request metrics, exposed in Prometheus text format on
+# /api/metrics/.
+#
+# metrics_middleware times every request and records it per endpoint (URL
+# name) and status. Inside a request, ``stage("markdown")`` and
+# ``upstream("gemini")`` blocks note how long each stage took in a small
+# per-request list (a contextvar, so it works for threads and coroutines);
+# the middleware folds that list into the histograms once, under one lock,
+# when the response is ready. Work that finishes after the response (pool
+# threads started with ``submit``, the body of a streaming response, which
+# the middleware runs in the request's context) is recorded directly. Database time is
+# collected by an execute wrapper on every connection.
+#
+# Counters live in this process; with several workers each reports its own,
+# which Prometheus sums per label.
+
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.requests = {}         # endpoint -> Histogram
+        self.stages = {}           # (endpoint, stage) -> Histogram
+        self.responses = {}        # (endpoint, status) -> count
+        self.upstream_calls = {}   # provider -> count
+        self.upstream_errors = {}  # provider -> count
+        self.upstream_events = {}  # (provider, event) -> count, e.g. retries (api/resilience.py)
+        self.chat_routes = {}      # (model, reason) -> count (api/routing.py)
+        self.chat_models = {}      # model -> ({shape: latency EWMA}, error rate EWMA)
+
+    def histogram(self, table, key):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram()
+        return histogram
+
+    def observe_request(self, timings, status, seconds):
+        endpoint = timings.endpoint
+        with self.lock:
+            self.histogram(self.requests, endpoint).observe(seconds)
+            self.responses[(endpoint, status)] = self.responses.get((endpoint, status), 0) + 1
+            for name, stage_seconds in timings.stages:
+                self.histogram(self.stages, (endpoint, name)).observe(stage_seconds)
+            timings.done = True
+
+    def observe_stage(self, endpoint, name, seconds):
+        with self.lock:
+            self.histogram(self.stages, (endpoint, name)).observe(seconds)
+
+    def count_upstream(self, provider, failed):
+        with self.lock:
+            self.upstream_calls[provider] = self.upstream_calls.get(provider, 0) + 1
+            if failed:
+                self.upstream_errors[provider] = self.upstream_errors.get(provider, 0) + 1
+
+    def count_event(self, provider, event):
+        with self.lock:
+            self.upstream_events[(provider, event)] = self.upstream_events.get((provider, event), 0) + 1
+
+    def count_route(self, model, reason):
+        with self.lock:
+            self.chat_routes[(model, reason)] = self.chat_routes.get((model, reason), 0) + 1
+
+    def set_model_stats(self, model, latencies, error_rate):
+        with self.lock:
+            self.chat_models[model] = (latencies, error_rate)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            render_histograms(lines, "darkai_request_seconds", "Request latency per endpoint.",
+                              ("endpoint",), {(k,): v for k, v in self.requests.items()})
+            render_histograms(lines, "darkai_stage_seconds", "Time spent per stage of a request.",
+                              ("endpoint", "stage"), self.stages)
+            render_counter(lines, "darkai_responses_total", "Responses per endpoint and status code.",
+                           ("endpoint", "status"), self.responses)
+            render_counter(lines, "darkai_upstream_calls_total", "Calls to external providers.",
+                           ("provider",), {(k,): v for k, v in self.upstream_calls.items()})
+            render_counter(lines, "darkai_upstream_errors_total", "Failed calls to external providers.",
+                           ("provider",), {(k,): v for k, v in self.upstream_errors.items()})
+            render_counter(lines, "darkai_upstream_events_total", "Retries, hedges and circuit breaker events.",
+                           ("provider", "event"), self.upstream_events)
+            render_counter(lines, "darkai_chat_routes_total", "Chat requests answered per model and routing reason.",
+                           ("model", "reason"), self.chat_routes)
+            render_gauge(lines, "darkai_chat_model_latency_seconds", "EWMA latency of each chat model per call shape.",
+                         ("model", "shape"),
+                         {(k, shape): latency for k, v in self.chat_models.items() for shape, latency in v[0].items()})
+            render_gauge(lines, "darkai_chat_model_error_rate", "EWMA error rate of each chat model.",
+                         ("model",), {(k,): v[1] for k, v in self.chat_models.items()})
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def label_string(names, values, le=None):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def render_histograms(lines, name, help_text, label_names, table):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for key, histogram in sorted(table.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{label_string(label_names, key, bound)} {cumulative}")
+        lines.append(f"{name}_bucket{label_string(label_names, key, '+Inf')} {histogram.count}")
+        lines.append(f"{name}_sum{label_string(label_names, key)} {histogram.total}")
+        lines.append(f"{name}_count{label_string(label_names, key)} {histogram.count}")
+
+
+def render_counter(lines, name, help_text, label_names, table):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} counter")
+    for key, value in sorted(table.items()):
+        lines.append(f"{name}{label_string(label_names, key)} {value}")
+
+
+def render_gauge(lines, name, help_text, label_names, table):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} gauge")
+    for key, value in sorted(table.items()):
+        lines.append(f"{name}{label_string(label_names, key)} {value}")
+
+
+registry = Registry()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=registry.reset)
+
+
+class RequestTimings:
+    __slots__ = ("endpoint", "stages", "done")
+
+    def __init__(self):
+        self.endpoint = None
+        self.stages = []
+        self.done = False
+
+    def record(self, name, seconds):
+        with registry.lock:
+            if not self.done:
+                self.stages.append((name, seconds))
+                return
+        # Still running after the response went out (streaming, pool threads)
+        registry.observe_stage(self.endpoint, name, seconds)
+
+
+current = contextvars.ContextVar("request_timings", default=None)
+
+
+def record_stage(name, seconds):
+    timings = current.get()
+    if timings is None:
+        registry.observe_stage("background", name, seconds)
+    else:
+        timings.record(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+@contextmanager
+def upstream(provider):
+    """Time a provider call as stage ``provider`` and count it (and its failure)."""
+    started = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        record_stage(provider, time.perf_counter() - started)
+        registry.count_upstream(provider, failed)
+
+
+def submit(pool, fn, *args):
+    """``pool.submit`` that keeps the caller's request context for stage timings."""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+def time_query(execute, sql, params, many, context):
+    with stage("db"):
+        return execute(sql, params, many, context)
+
+
+def install_query_timer(sender, connection, **kwargs):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+connection_created.connect(install_query_timer, dispatch_uid="api.metrics.install_query_timer")
+
+
+def begin():
+    timings = RequestTimings()
+    return timings, current.set(timings), time.perf_counter()
+
+
+def with_timings(iterator, timings):
+    """Run each step of a streaming body with ``timings`` as the current request."""
+    iterator = iter(iterator)
+    while True:
+        token = current.set(timings)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            current.reset(token)
+        yield chunk
+
+
+async def awith_timings(iterator, timings):
+    iterator = aiter(iterator)
+    while True:
+        token = current.set(timings)
+        try:
+            chunk = await anext(iterator)
+        except StopAsyncIteration:
+            return
+        finally:
+            current.reset(token)
+        yield chunk
+
+
+def finish(request, response, timings, token, started):
+    seconds = time.perf_counter() - started
+    current.reset(token)
+    match = getattr(request, "resolver_match", None)
+    # URL names, not paths, keep the label set small
+    timings.endpoint = (match.url_name or match.view_name) if match else "unmatched"
+    status = response.status_code if response is not None else 500
+    if response is not None and response.streaming:
+        # The server iterates the body after we return, outside this context
+        wrap = awith_timings if response.is_async else with_timings
+        response.streaming_content = wrap(response.streaming_content, timings)
+    registry.observe_request(timings, status, seconds)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            timings, token, started = begin()
+            response = None
+            try:
+                response = await get_response(request)
+                return response
+            finally:
+                finish(request, response, timings, token, started)
+    else:
+        def middleware(request):
+            timings, token, started = begin()
+            response = None
+            try:
+                response = get_response(request)
+                return response
+            finally:
+                finish(request, response, timings, token, started)
+    return middleware
+
+
+def metrics_view(request):
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponse(status=401)
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_conversation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generatedimage',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='imagejob',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=models.Index(fields=['created_at', 'id'], name='api_genimage_created_id'),
+        ),
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='api_genimage_user_created_id'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:00
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def backfill_prompt_hashes(apps, schema_editor):
+    # Same normalization as api.images.prompt_key, frozen here
+    GeneratedImage = apps.get_model('api', 'GeneratedImage')
+    batch = []
+    for image in GeneratedImage.objects.filter(prompt_hash='').only('id', 'prompt').iterator(chunk_size=2000):
+        image.prompt_hash = hashlib.sha256(" ".join(image.prompt.lower().split()).encode()).hexdigest()
+        batch.append(image)
+        if len(batch) >= 2000:
+            GeneratedImage.objects.bulk_update(batch, ['prompt_hash'])
+            batch = []
+    if batch:
+        GeneratedImage.objects.bulk_update(batch, ['prompt_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_gallery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generatedimage',
+            name='prompt_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=models.Index(fields=['prompt_hash', 'created_at'], name='api_genimage_hash_created'),
+        ),
+        migrations.RunPython(backfill_prompt_hashes, migrations.RunPython.noop),
+    ]
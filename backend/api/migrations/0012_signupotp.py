@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_generatedimage_derivatives'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SignupOTP',
+            fields=[
+                ('email', models.EmailField(max_length=254, primary_key=True, serialize=False)),
+                ('otp', models.CharField(max_length=12)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('issued_at', models.DateTimeField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
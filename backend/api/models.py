@@ -1,12 +1,163 @@
 # models.py
+import datetime
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from cloudinary.models import CloudinaryField
 class GeneratedImage(models.Model):
     prompt = models.TextField()
     file_name = CloudinaryField('image')
     created_at = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    # sha256 of the normalized prompt (images.prompt_hash), for reusing recent results
+    prompt_hash = models.CharField(max_length=64, blank=True, default="")
+    # Derivatives stored next to the original (images.store_derivatives); empty until built
+    thumbnail_url = models.URLField(max_length=500, blank=True)
+    webp_url = models.URLField(max_length=500, blank=True)
+    avif_url = models.URLField(max_length=500, blank=True)
+
+    class Meta:
+        # Keyset pagination for the gallery walks these newest first
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="api_genimage_created_id"),
+            models.Index(fields=["user", "created_at", "id"], name="api_genimage_user_created_id"),
+            models.Index(fields=["prompt_hash", "created_at"], name="api_genimage_hash_created"),
+        ]
 
     def __str__(self):
         return self.prompt
 
 
+class UserQuota(models.Model):
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    # Generations used since last_reset (reset lazily on the first request of a day)
+    daily_quota = models.IntegerField(default=0)
+    last_reset = models.DateField(default=datetime.date.today)
+
+    def __str__(self):
+        return f"{self.user} ({self.daily_quota} used on {self.last_reset})"
+
+
+
+
+class TTSAudio(models.Model):
+    # sha256 of language + normalized text, also used as the Cloudinary public_id
+    text_hash = models.CharField(max_length=64, unique=True)
+    lang = models.CharField(max_length=16)
+    audio_url = models.URLField(max_length=500)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.lang}:{self.text_hash}"
+
+
+class ImageJob(models.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    prompt = models.TextField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    result_url = models.URLField(max_length=500, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="api_imagejob_status_created"),
+        ]
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+
+class OutboxEmail(models.Model):
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    DEAD = "dead"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (SENDING, "Sending"),
+        (SENT, "Sent"),
+        (DEAD, "Dead"),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    to = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"], name="api_outbox_status_next"),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {', '.join(self.to)} ({self.status})"
+
+
+class SignupOTP(models.Model):
+    """Pending signup OTP of the "database" OTP store (api/otp.py)."""
+
+    email = models.EmailField(primary_key=True)
+    otp = models.CharField(max_length=12)
+    attempts = models.PositiveIntegerField(default=0)
+    issued_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.email
+
+
+class Conversation(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE)
+    # Rolling summary of every turn up to and including summarized_until
+    summary = models.TextField(blank=True)
+    summarized_until = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class ConversationTurn(models.Model):
+    USER = "user"
+    MODEL = "model"
+    ROLE_CHOICES = [(USER, "User"), (MODEL, "Model")]
+
+    conversation = models.ForeignKey(Conversation, related_name="turns", on_delete=models.CASCADE)
+    role = models.CharField(max_length=5, choices=ROLE_CHOICES)
+    text = models.TextField()
+    tokens = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [
+            models.Index(fields=["conversation", "id"], name="api_turn_conversation_id"),
+        ]
+
+    def __str__(self):
+        return f"{self.role}: {self.text[:50]}"
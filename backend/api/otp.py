@@ -0,0 +1,172 @@
+# otp.py
+#
+# Storage for signup OTPs with expiry and a per-email attempt counter.
+# "database" (the default) keeps them in the SignupOTP table and "cache" in
+# one of Django's CACHES (Redis, Memcached or the database cache), so any
+# worker can verify an OTP issued by another one; "memory" keeps them in this
+# process and only suits a single worker.
+#
+# issue() refuses a new OTP for an email that got one less than
+# OTP_RESEND_INTERVAL seconds ago, so resends can't be used to flood a mailbox.
+
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+OTP_OK = "ok"
+OTP_INVALID = "invalid"
+OTP_LOCKED = "locked"
+
+
+class MemoryOTPStore:
+    """
+    Entries live in an OrderedDict in issue order. Every OTP has the same TTL,
+    so expired entries are always at the front and the sweep on each call
+    only touches entries that have actually expired.
+    """
+
+    def __init__(self, ttl, max_attempts, resend_interval=0):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.resend_interval = resend_interval
+        self.entries = OrderedDict()  # email -> [otp, expires_at, attempts]
+        self.lock = threading.Lock()
+
+    def sweep(self, now):
+        while self.entries:
+            email, entry = next(iter(self.entries.items()))
+            if entry[1] > now:
+                break
+            del self.entries[email]
+
+    def issue(self, email, otp):
+        """Store ``otp`` for ``email``; False if the last one is too recent to replace."""
+        with self.lock:
+            now = time.monotonic()
+            self.sweep(now)
+            entry = self.entries.get(email)
+            if entry is not None and entry[1] - self.ttl + self.resend_interval > now:
+                return False
+            self.entries.pop(email, None)
+            self.entries[email] = [otp, now + self.ttl, 0]
+            return True
+
+    def verify(self, email, otp):
+        with self.lock:
+            self.sweep(time.monotonic())
+            entry = self.entries.get(email)
+            if entry is None:
+                return OTP_INVALID
+            if entry[2] >= self.max_attempts:
+                return OTP_LOCKED
+            if otp is not None and hmac.compare_digest(entry[0].encode(), str(otp).encode()):
+                del self.entries[email]
+                return OTP_OK
+            entry[2] += 1
+            return OTP_LOCKED if entry[2] >= self.max_attempts else OTP_INVALID
+
+
+class CacheOTPStore:
+    """OTPs in a Django cache; the attempt counter uses the cache's atomic incr."""
+
+    def __init__(self, alias, ttl, max_attempts, resend_interval=0):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.resend_interval = resend_interval
+
+    def keys(self, email):
+        return f"otp:{email}", f"otp-attempts:{email}"
+
+    def issue(self, email, otp):
+        # add() is atomic: only one of several concurrent resends gets through
+        if self.resend_interval and not self.cache.add(f"otp-issued:{email}", 1, timeout=self.resend_interval):
+            return False
+        otp_key, attempts_key = self.keys(email)
+        self.cache.set_many({otp_key: otp, attempts_key: 0}, timeout=self.ttl)
+        return True
+
+    def verify(self, email, otp):
+        otp_key, attempts_key = self.keys(email)
+        stored = self.cache.get(otp_key)
+        if stored is None:
+            return OTP_INVALID
+        if (self.cache.get(attempts_key) or 0) >= self.max_attempts:
+            return OTP_LOCKED
+        if otp is not None and hmac.compare_digest(stored.encode(), str(otp).encode()):
+            self.cache.delete_many([otp_key, attempts_key])
+            return OTP_OK
+        try:
+            attempts = self.cache.incr(attempts_key)
+        except ValueError:
+            # Counter expired or was evicted; start over
+            self.cache.set(attempts_key, 1, timeout=self.ttl)
+            attempts = 1
+        return OTP_LOCKED if attempts >= self.max_attempts else OTP_INVALID
+
+
+class DatabaseOTPStore:
+    """
+    OTPs in the SignupOTP table. Wrong guesses are counted with a conditional
+    UPDATE before the comparison, so concurrent guesses can't exceed the
+    limit; expired rows are deleted whenever a new OTP is issued.
+    """
+
+    def __init__(self, ttl, max_attempts, resend_interval=0):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.resend_interval = resend_interval
+
+    def issue(self, email, otp):
+        from .models import SignupOTP
+
+        now = timezone.now()
+        SignupOTP.objects.filter(expires_at__lte=now).delete()
+        if SignupOTP.objects.filter(email=email, issued_at__gt=now - timedelta(seconds=self.resend_interval)).exists():
+            return False
+        SignupOTP.objects.update_or_create(email=email, defaults={
+            "otp": otp, "attempts": 0, "issued_at": now, "expires_at": now + timedelta(seconds=self.ttl),
+        })
+        return True
+
+    def verify(self, email, otp):
+        from .models import SignupOTP
+
+        live = SignupOTP.objects.filter(email=email, expires_at__gt=timezone.now())
+        if not live.filter(attempts__lt=self.max_attempts).update(attempts=F("attempts") + 1):
+            return OTP_LOCKED if live.exists() else OTP_INVALID
+
+        row = live.values_list("otp", "attempts").first()
+        if row is None:
+            return OTP_INVALID
+        stored, attempts = row
+        if otp is not None and hmac.compare_digest(stored.encode(), str(otp).encode()):
+            live.delete()
+            return OTP_OK
+        return OTP_LOCKED if attempts >= self.max_attempts else OTP_INVALID
+
+
+def build_otp_store():
+    backend = getattr(settings, "OTP_STORE_BACKEND", "database")
+    ttl = getattr(settings, "OTP_TTL", 600)
+    max_attempts = getattr(settings, "OTP_MAX_ATTEMPTS", 5)
+    resend_interval = getattr(settings, "OTP_RESEND_INTERVAL", 60)
+
+    if backend == "database":
+        return DatabaseOTPStore(ttl, max_attempts, resend_interval)
+    if backend == "memory":
+        return MemoryOTPStore(ttl, max_attempts, resend_interval)
+    if backend == "cache":
+        return CacheOTPStore(getattr(settings, "OTP_CACHE_ALIAS", "default"), ttl, max_attempts, resend_interval)
+    raise ValueError(f"Unknown OTP_STORE_BACKEND '{backend}'")
+
+
+otp_store = build_otp_store()
@@ -0,0 +1,156 @@
+# outbox.py
+#
+# Outgoing mail goes through an OutboxEmail table instead of being sent inside
+# the request. A background sender thread claims due messages in batches,
+# sends each batch over one SMTP connection (kept open while there is more
+# work), retries failures with exponential backoff and marks a message "dead"
+# after EMAIL_OUTBOX_MAX_ATTEMPTS, keeping the last error as a dead-letter
+# record. The sender uses get_connection(), so tests can run it against the
+# locmem email backend and drain the queue with ``email_outbox.send_pending()``.
+
+import logging
+import os
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection as db_connection
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+
+class EmailOutbox:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def enqueue(self, subject, body, from_email, to):
+        email = OutboxEmail.objects.create(subject=subject, body=body, from_email=from_email, to=list(to))
+        if getattr(settings, "EMAIL_OUTBOX_IN_BACKGROUND", True):
+            self.start()
+            self.wakeup.set()
+        else:
+            self.send_pending()
+        return email
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.requeue_stale()
+            self.thread = threading.Thread(target=self.work, name="email-outbox", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+
+    def requeue_stale(self):
+        cutoff = timezone.now() - timedelta(seconds=getattr(settings, "EMAIL_OUTBOX_STALE_AFTER", 300))
+        OutboxEmail.objects.filter(status=OutboxEmail.SENDING, next_attempt_at__lt=cutoff).update(
+            status=OutboxEmail.PENDING
+        )
+
+    def claim_batch(self):
+        """Atomically move up to EMAIL_OUTBOX_BATCH_SIZE due messages to "sending"."""
+        now = timezone.now()
+        ids = list(
+            OutboxEmail.objects.filter(status=OutboxEmail.PENDING, next_attempt_at__lte=now)
+            .order_by("next_attempt_at")
+            .values_list("id", flat=True)[:getattr(settings, "EMAIL_OUTBOX_BATCH_SIZE", 50)]
+        )
+        if not ids:
+            return []
+        claimed = []
+        for email_id in ids:
+            # next_attempt_at doubles as the claim time for requeue_stale()
+            if OutboxEmail.objects.filter(id=email_id, status=OutboxEmail.PENDING).update(
+                status=OutboxEmail.SENDING, next_attempt_at=now
+            ):
+                claimed.append(email_id)
+        return list(OutboxEmail.objects.filter(id__in=claimed))
+
+    def send_batch(self, batch, smtp):
+        for email in batch:
+            message = EmailMessage(email.subject, email.body, email.from_email, email.to, connection=smtp)
+            try:
+                message.send(fail_silently=False)
+            except Exception as e:
+                self.failed(email, e)
+                try:
+                    # The connection may be broken; reopen it for the rest
+                    smtp.close()
+                    smtp.open()
+                except Exception:
+                    logger.exception("Could not reopen the SMTP connection")
+            else:
+                email.status = OutboxEmail.SENT
+                email.sent_at = timezone.now()
+                email.attempts += 1
+                email.save(update_fields=["status", "sent_at", "attempts"])
+
+    def failed(self, email, error):
+        email.attempts += 1
+        email.last_error = str(error)
+        if email.attempts >= getattr(settings, "EMAIL_OUTBOX_MAX_ATTEMPTS", 5):
+            email.status = OutboxEmail.DEAD
+            logger.error("Giving up on outbox email %s after %d attempts: %s", email.id, email.attempts, error)
+        else:
+            email.status = OutboxEmail.PENDING
+            backoff = getattr(settings, "EMAIL_OUTBOX_RETRY_BACKOFF", 30) * 2 ** (email.attempts - 1)
+            email.next_attempt_at = timezone.now() + timedelta(seconds=backoff)
+        email.save(update_fields=["status", "attempts", "last_error", "next_attempt_at"])
+
+    def send_pending(self):
+        """Send every due message over a single connection; returns how many were attempted."""
+        batch = self.claim_batch()
+        if not batch:
+            return 0
+
+        smtp = get_connection(fail_silently=False)
+        try:
+            smtp.open()
+        except Exception as e:
+            # Could not even connect; count it as a failed attempt for the batch
+            for email in batch:
+                self.failed(email, e)
+            return len(batch)
+
+        sent = 0
+        try:
+            while batch:
+                self.send_batch(batch, smtp)
+                sent += len(batch)
+                batch = self.claim_batch()
+        finally:
+            smtp.close()
+        return sent
+
+    def work(self):
+        poll_interval = getattr(settings, "EMAIL_OUTBOX_POLL_INTERVAL", 5)
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            try:
+                self.send_pending()
+            except Exception:
+                logger.exception("Email outbox run failed")
+            finally:
+                db_connection.close()
+            self.wakeup.wait(poll_interval)
+
+
+email_outbox = EmailOutbox()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=email_outbox.reset)
@@ -0,0 +1,218 @@
+# providers.py
+#
+# Process-wide owner of the external provider clients: the Gemini chat models
+# (google.generativeai, one per chat mode with its instructions set as the
+# system instruction), the google-genai client used for image generation and
+# the Cloudinary uploader. Clients are built once on first use and reused by
+# every view, so requests don't pay client construction or a new TLS
+# handshake. After a fork (e.g. gunicorn --preload) the child drops inherited
+# clients and builds its own, since pooled sockets and gRPC channels can't be
+# shared across processes.
+#
+# The provider SDKs are imported on first use, not when this module is, so a
+# cold process can answer /api/ping/ and auth without loading them;
+# ``warm_up_in_background()`` loads them after the server is ready.
+
+import os
+import threading
+import logging
+import time
+from datetime import timedelta
+
+from decouple import config
+from django.conf import settings
+
+from . import resilience
+from .prompts import SYSTEM_INSTRUCTIONS
+from .routing import chat_models
+
+logger = logging.getLogger(__name__)
+
+CHAT_MODEL = "gemini-2.5-flash"
+IMAGE_MODEL = "gemini-2.0-flash-preview-image-generation"
+
+
+class ProviderManager:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.gemini_configured = False
+        self.cloudinary_configured = False
+        self.chat_models = {}
+        self.genai_client = None
+
+    def pool_limits(self):
+        import httpx
+
+        return httpx.Limits(
+            max_connections=getattr(settings, "PROVIDER_POOL_SIZE", 20),
+            max_keepalive_connections=getattr(settings, "PROVIDER_POOL_SIZE", 20),
+            keepalive_expiry=getattr(settings, "PROVIDER_KEEPALIVE_EXPIRY", 60),
+        )
+
+    def configure_gemini(self):
+        """Configure the module-level generativeai SDK once per process."""
+        import google.generativeai as generativeai
+
+        if not self.gemini_configured:
+            with self.lock:
+                if not self.gemini_configured:
+                    generativeai.configure(api_key=config("GOOGLE_API_KEY"))
+                    self.gemini_configured = True
+        return generativeai
+
+    def configure_cloudinary(self):
+        """Configure Cloudinary and its shared upload pool once per process."""
+        import cloudinary
+        import cloudinary.uploader
+        from cloudinary import utils as cloudinary_utils
+
+        if self.cloudinary_configured:
+            return
+        with self.lock:
+            if self.cloudinary_configured:
+                return
+
+            cloudinary.config(
+                cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
+                api_key=os.getenv("CLOUDINARY_API_KEY"),
+                api_secret=os.getenv("CLOUDINARY_API_SECRET"),
+                secure=True
+            )
+            # The uploader keeps one urllib3 pool for all uploads; size it so
+            # concurrent uploads reuse connections instead of discarding them.
+            cloudinary.uploader._http = cloudinary_utils.get_http_connector(
+                cloudinary.config(),
+                dict(cloudinary.CERT_KWARGS, maxsize=getattr(settings, "PROVIDER_POOL_SIZE", 20)),
+            )
+
+            self.cloudinary_configured = True
+
+    def get_chat_model(self, name=CHAT_MODEL, mode=None):
+        """
+        The model for ``name``; with a ``mode`` (prompts.CHAT / prompts.CODE)
+        that mode's instructions are its system instruction.
+        """
+        key = (name, mode)
+        entry = self.chat_models.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            # Before taking the lock: configure_gemini takes it too, and it isn't reentrant
+            generativeai = self.configure_gemini()
+            with self.lock:
+                entry = self.chat_models.get(key)
+                if entry is None or entry[1] < time.monotonic():
+                    entry = self.chat_models[key] = self.build_chat_model(generativeai, name, mode)
+        return entry[0]
+
+    def build_chat_model(self, generativeai, name, mode):
+        """Returns ``(model, rebuild_after)``."""
+        if mode is None:
+            return generativeai.GenerativeModel(name), float("inf")
+
+        instruction = SYSTEM_INSTRUCTIONS[mode]
+        if getattr(settings, "CHAT_CONTEXT_CACHE", False):
+            # Cached prefixes are billed at the reduced cached-token rate, but
+            # the API rejects prefixes below its minimum size; fall back then.
+            ttl = getattr(settings, "CHAT_CONTEXT_CACHE_TTL", 3600)
+            try:
+                cached = generativeai.caching.CachedContent.create(
+                    model=f"models/{name}",
+                    display_name=f"darkai-{mode}",
+                    system_instruction=instruction,
+                    ttl=timedelta(seconds=ttl),
+                )
+                model = generativeai.GenerativeModel.from_cached_content(cached_content=cached)
+                # Rebuild a little before the cache entry expires
+                return model, time.monotonic() + ttl * 0.9
+            except Exception as e:
+                logger.warning("Context caching unavailable for %s/%s, using a plain system instruction: %s",
+                               name, mode, e)
+
+        return generativeai.GenerativeModel(name, system_instruction=instruction), float("inf")
+
+    def get_genai_client(self):
+        if self.genai_client is None:
+            with self.lock:
+                if self.genai_client is None:
+                    from google import genai
+                    from google.genai import types
+
+                    limits = self.pool_limits()
+                    self.genai_client = genai.Client(
+                        api_key=config("GOOGLE_API_KEY"),
+                        http_options=types.HttpOptions(
+                            client_args={"limits": limits},
+                            async_client_args={"limits": limits},
+                        ),
+                    )
+        return self.genai_client
+
+    def upload(self, file, **options):
+        import cloudinary.uploader
+
+        self.configure_cloudinary()
+        return cloudinary.uploader.upload(file, **options)
+
+    def asset_url(self, public_id, **options):
+        """Delivery URL of an asset, known before its upload has finished."""
+        from cloudinary import utils as cloudinary_utils
+
+        self.configure_cloudinary()
+        url, _ = cloudinary_utils.cloudinary_url(public_id, secure=True, **options)
+        return url
+
+    def warm_up(self):
+        """Import and configure every SDK and build the clients the views use."""
+        from . import tts
+
+        tts.supported_langs()  # loads gtts
+        self.configure_cloudinary()
+        for name in chat_models():
+            for mode in SYSTEM_INSTRUCTIONS:
+                self.get_chat_model(name, mode)
+        self.get_genai_client()
+
+
+providers = ProviderManager()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=providers.reset)
+
+
+def warm_up_in_background():
+    def warm_up():
+        started = time.monotonic()
+        try:
+            providers.warm_up()
+        except Exception:
+            logger.exception("Provider warm-up failed; clients will be built on first use")
+        else:
+            logger.info("Provider SDKs warmed up in %.2fs", time.monotonic() - started)
+
+    thread = threading.Thread(target=warm_up, name="provider-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_chat_model(name=CHAT_MODEL, mode=None):
+    return providers.get_chat_model(name, mode)
+
+
+def get_genai_client():
+    return providers.get_genai_client()
+
+
+def upload(file, **options):
+    def attempt(timeout):
+        if hasattr(file, "seek"):
+            file.seek(0)  # a retry re-reads the file from the start
+        return providers.upload(file, timeout=timeout, **options)
+
+    # Retrying is safe since uploads name their public_id; two at once would share the file
+    return resilience.call("cloudinary", attempt, hedge=False)
+
+
+def asset_url(public_id, **options):
+    return providers.asset_url(public_id, **options)
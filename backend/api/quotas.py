@@ -0,0 +1,209 @@
+# quotas.py
+#
+# Per-user limits for the generation endpoints, checked in two steps before
+# any provider call:
+#
+# 1. An in-memory token bucket per user (or per IP for anonymous requests)
+#    absorbs bursts and rejects floods without touching the database.
+# 2. For signed-in users, a daily quota in UserQuota. The counter is only ever
+#    changed with conditional UPDATEs (F() increments, lazy reset when the day
+#    has changed), so concurrent requests can't race past the limit.
+#
+# Failed generations (4xx/5xx responses) are refunded. Every response carries
+# X-Quota-Limit / X-Quota-Remaining for signed-in users.
+
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F
+from django.http import JsonResponse
+from django.utils import timezone
+
+from .models import UserQuota
+
+DEFAULT_COSTS = {"chat": 1, "image": 5, "tts": 1}
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> [tokens, last refill]
+        self.lock = threading.Lock()
+
+    def take(self, key, cost=1):
+        """Take ``cost`` tokens; returns 0 on success or the seconds to wait."""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [float(self.burst), now]
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self.buckets.move_to_end(key)
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0
+            return (cost - bucket[0]) / self.rate
+
+
+limiter = TokenBucketLimiter(
+    rate=getattr(settings, "QUOTA_BUCKET_RATE", 0.5),
+    burst=getattr(settings, "QUOTA_BUCKET_BURST", 10),
+)
+
+
+def quota_cost(kind):
+    return getattr(settings, "QUOTA_COSTS", DEFAULT_COSTS).get(kind, 1)
+
+
+def daily_limit():
+    return getattr(settings, "QUOTA_DAILY_LIMIT", 100)
+
+
+def client_ip(request):
+    """
+    REMOTE_ADDR, or with QUOTA_TRUSTED_PROXY_HOPS = n, the address the
+    outermost of our n proxies saw: the n-th X-Forwarded-For entry from the
+    right. Entries left of it are whatever the client chose to send.
+    """
+    hops = getattr(settings, "QUOTA_TRUSTED_PROXY_HOPS", 0)
+    forwarded = [ip.strip() for ip in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",") if ip.strip()]
+    if hops and len(forwarded) >= hops:
+        return forwarded[-hops]
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def client_key(request, user):
+    if user is not None:
+        return f"user:{user.pk}"
+    return f"ip:{client_ip(request)}"
+
+
+def resolve_user(request):
+    """The authenticated user (JWT or session), or None."""
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return user
+
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework.exceptions import AuthenticationFailed
+
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+def consume_quota(user, cost):
+    """Atomically add ``cost`` to today's usage; returns the remaining quota or None if over."""
+    today = timezone.localdate()
+    limit = daily_limit()
+
+    def increment():
+        return UserQuota.objects.filter(
+            user=user, last_reset=today, daily_quota__lte=limit - cost
+        ).update(daily_quota=F("daily_quota") + cost)
+
+    updated = increment()
+    if not updated:
+        # First request ever or first one today: create or reset the row, then
+        # retry. Always retry: a concurrent request may have created or reset
+        # the row between our increment and get_or_create.
+        UserQuota.objects.get_or_create(user=user, defaults={"last_reset": today})
+        UserQuota.objects.filter(user=user, last_reset__lt=today).update(daily_quota=0, last_reset=today)
+        updated = increment()
+
+    used = UserQuota.objects.filter(user=user).values_list("daily_quota", flat=True).first() or 0
+    return max(limit - used, 0) if updated else None
+
+
+def refund_quota(user, cost):
+    UserQuota.objects.filter(
+        user=user, last_reset=timezone.localdate(), daily_quota__gte=cost
+    ).update(daily_quota=F("daily_quota") - cost)
+
+
+def rejected(message, headers):
+    return JsonResponse({"error": message}, status=429, headers=headers)
+
+
+def charge(request, cost, bucket_cost=None):
+    """
+    Returns ``(user, headers, None)`` when the request may go ahead, or
+    ``(user, headers, response)`` with a 429 response when it may not.
+    ``bucket_cost`` (default ``cost``) is what the request takes from the
+    token bucket; ``cost`` is charged to the daily quota.
+    """
+    user = resolve_user(request)
+
+    wait = limiter.take(client_key(request, user), cost if bucket_cost is None else bucket_cost)
+    if wait:
+        return user, {}, rejected("Too many requests. Please slow down.", {"Retry-After": str(int(wait) + 1)})
+
+    if user is None:
+        return None, {}, None
+
+    headers = {"X-Quota-Limit": str(daily_limit())}
+    remaining = consume_quota(user, cost)
+    if remaining is None:
+        headers["X-Quota-Remaining"] = "0"
+        return user, headers, rejected("Daily generation quota reached. Try again tomorrow.", headers)
+    headers["X-Quota-Remaining"] = str(remaining)
+    return user, headers, None
+
+
+def finish(response, user, cost, headers):
+    if user is not None and response.status_code >= 400:
+        refund_quota(user, cost)
+        if "X-Quota-Remaining" in headers:
+            headers["X-Quota-Remaining"] = str(int(headers["X-Quota-Remaining"]) + cost)
+    for name, value in headers.items():
+        response[name] = value
+    return response
+
+
+def enforce_quota(kind, units=None):
+    """
+    Decorator for a view's ``post`` (sync DRF or async Django) that charges
+    ``kind``; ``units(request)``, if given, says how many of them the request is.
+    The daily quota is charged per unit, the token bucket once per request: a
+    multi-unit request could otherwise cost more than the bucket ever holds.
+    """
+
+    def cost_of(request):
+        return quota_cost(kind) * (units(request) if units else 1)
+
+    def decorator(post):
+        if asyncio.iscoroutinefunction(post):
+            @functools.wraps(post)
+            async def async_wrapper(self, request, *args, **kwargs):
+                cost = cost_of(request)
+                user, headers, response = await sync_to_async(charge)(request, cost, quota_cost(kind))
+                if response is not None:
+                    return response
+                response = await post(self, request, *args, **kwargs)
+                return await sync_to_async(finish)(response, user, cost, headers)
+            return async_wrapper
+
+        @functools.wraps(post)
+        def wrapper(self, request, *args, **kwargs):
+            cost = cost_of(request)
+            user, headers, response = charge(request, cost, quota_cost(kind))
+            if response is not None:
+                return response
+            return finish(post(self, request, *args, **kwargs), user, cost, headers)
+        return wrapper
+
+    return decorator
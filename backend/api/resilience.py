@@ -0,0 +1,390 @@
+# resilience.py
+#
+# One wrapper for every provider call (Gemini chat and images, Cloudinary,
+# gTTS):
+#
+#     response = resilience.call("gemini", lambda timeout: model.generate_content(
+#         message, request_options={"timeout": timeout}))
+#
+# - Deadlines: deadline_middleware gives each request REQUEST_DEADLINE
+#   seconds, kept in a contextvar (and so carried into pool threads started
+#   with metrics.submit). Every attempt gets the smaller of PROVIDER_TIMEOUT
+#   and what is left, passed to ``fn`` so the SDK enforces it.
+# - Retries: idempotent calls that fail with a transient error (timeouts,
+#   connection errors, 429 and 5xx) are retried up to PROVIDER_RETRIES times
+#   with full-jitter exponential backoff, as long as the deadline allows.
+# - Hedging: with PROVIDER_HEDGE, a call still running after the provider's
+#   recent PROVIDER_HEDGE_PERCENTILE latency gets a second, identical request;
+#   the first success wins.
+# - Circuit breaker: after PROVIDER_BREAKER_FAILURES consecutive transient
+#   failures a provider is skipped for PROVIDER_BREAKER_RESET seconds, then
+#   one trial call decides whether it is healthy again. Calls fail fast with
+#   ProviderUnavailable meanwhile.
+#
+# api/fakes.py can inject failures and slow responses to exercise all of it
+# (see ``manage.py bench_resilience``).
+
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+from .metrics import registry, upstream
+
+
+class ProviderError(Exception):
+    pass
+
+
+class ProviderUnavailable(ProviderError):
+    """The provider's circuit is open; try again after ``retry_after`` seconds."""
+
+    def __init__(self, provider, retry_after):
+        super().__init__(f"{provider} is temporarily unavailable. Please try again shortly.")
+        self.retry_after = retry_after
+
+
+class ProviderTimeout(ProviderError):
+    """The request's deadline ran out before the provider answered."""
+
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# Transient errors of the SDKs and their HTTP clients, matched by name so
+# that none of them has to be imported here
+RETRYABLE_NAMES = {
+    "TimeoutError", "ConnectionError", "TimeoutException", "TransportError",
+    "DeadlineExceeded", "ServiceUnavailable", "InternalServerError", "TooManyRequests",
+    "ResourceExhausted", "ServerError", "ProtocolError", "MaxRetryError", "Timeout",
+}
+TIMEOUT_NAMES = {"TimeoutError", "TimeoutException", "DeadlineExceeded", "Timeout"}
+
+
+def is_retryable(error):
+    if isinstance(error, ProviderError):
+        return False
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    try:
+        if int(code) in RETRYABLE_STATUS:
+            return True
+    except (TypeError, ValueError):
+        pass
+    return any(cls.__name__ in RETRYABLE_NAMES for cls in type(error).__mro__)
+
+
+def give_up(error):
+    """The error to raise once retries are exhausted: timeouts become ProviderTimeout."""
+    if any(cls.__name__ in TIMEOUT_NAMES for cls in type(error).__mro__):
+        return ProviderTimeout("The AI provider took too long to answer. Please try again.")
+    return error
+
+
+def error_status(error):
+    """``(status, headers)`` of the response for a ProviderError."""
+    if isinstance(error, ProviderUnavailable):
+        return 503, {"Retry-After": str(max(1, round(error.retry_after)))}
+    return 504, {}
+
+
+# --- Deadlines ---
+
+deadline = contextvars.ContextVar("provider_deadline", default=None)
+
+
+def remaining():
+    """Seconds left before the current request's deadline, or None without one."""
+    at = deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def attempt_timeout():
+    timeout = getattr(settings, "PROVIDER_TIMEOUT", 30)
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise ProviderTimeout("The request took too long. Please try again.")
+    return min(timeout, left)
+
+
+@sync_and_async_middleware
+def deadline_middleware(get_response):
+    def begin():
+        return deadline.set(time.monotonic() + getattr(settings, "REQUEST_DEADLINE", 60))
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = begin()
+            try:
+                return await get_response(request)
+            finally:
+                deadline.reset(token)
+    else:
+        def middleware(request):
+            token = begin()
+            try:
+                return get_response(request)
+            finally:
+                deadline.reset(token)
+    return middleware
+
+
+# --- Circuit breaker and latency tracking ---
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+
+    def before_call(self):
+        """Raises ProviderUnavailable while open; returns whether this call is the half-open trial."""
+        reset_after = getattr(settings, "PROVIDER_BREAKER_RESET", 30)
+        with self.lock:
+            if self.state == self.CLOSED:
+                return False
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self.opened_at >= reset_after:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            retry_after = max(0.0, reset_after - (now - self.opened_at))
+        registry.count_event(self.name, "rejected")
+        raise ProviderUnavailable(self.name, retry_after)
+
+    def is_open(self):
+        """Whether calls are being turned away right now."""
+        reset_after = getattr(settings, "PROVIDER_BREAKER_RESET", 30)
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < reset_after
+
+    def release_trial(self):
+        """The call was abandoned (e.g. cancelled) without a verdict; let another one be the trial."""
+        with self.lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == self.OPEN:
+                return
+            if self.state == self.HALF_OPEN or self.failures >= getattr(settings, "PROVIDER_BREAKER_FAILURES", 5):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                opened = True
+            else:
+                opened = False
+        if opened:
+            registry.count_event(self.name, "breaker_open")
+
+
+class ProviderPolicy:
+    def __init__(self, name):
+        self.name = name
+        self.breaker = CircuitBreaker(name)
+        self.latencies = deque(maxlen=200)  # seconds of recent successful calls
+
+    def record_latency(self, seconds):
+        self.latencies.append(seconds)
+
+    def hedge_delay(self):
+        """The configured latency percentile, or None until there are enough samples."""
+        samples = sorted(self.latencies)
+        if len(samples) < 20:
+            return None
+        pct = getattr(settings, "PROVIDER_HEDGE_PERCENTILE", 95)
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+class Policies:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.policies = {}
+
+    def get(self, name):
+        policy = self.policies.get(name)
+        if policy is None:
+            with self.lock:
+                policy = self.policies.setdefault(name, ProviderPolicy(name))
+        return policy
+
+
+policies = Policies()
+# With hedging on, sync calls run here so the caller can wait on both requests
+hedge_pool = ThreadPoolExecutor(max_workers=getattr(settings, "PROVIDER_HEDGE_THREADS", 64),
+                                thread_name_prefix="provider-hedge")
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=policies.reset)
+
+
+def backoff(attempt):
+    base = getattr(settings, "PROVIDER_BACKOFF_BASE", 0.25)
+    cap = getattr(settings, "PROVIDER_BACKOFF_MAX", 4)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def should_hedge(hedge):
+    return hedge and getattr(settings, "PROVIDER_HEDGE", False)
+
+
+# --- Sync calls ---
+
+def run_hedged(policy, fn, timeout):
+    delay = policy.hedge_delay()
+    if delay is None or delay >= timeout:
+        return fn(timeout)
+
+    started = time.monotonic()
+    primary = hedge_pool.submit(contextvars.copy_context().run, fn, timeout)
+    try:
+        return primary.result(timeout=delay)
+    except FutureTimeout:
+        pass
+
+    registry.count_event(policy.name, "hedge")
+    left = timeout - (time.monotonic() - started)
+    pending = {primary, hedge_pool.submit(contextvars.copy_context().run, fn, left)}
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=timeout - (time.monotonic() - started), return_when=FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError(f"{policy.name} did not answer within {timeout:.1f}s")
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call(provider, fn, idempotent=True, hedge=True):
+    """
+    Run ``fn(timeout)`` against ``provider`` with the deadline, retry, hedging
+    and circuit breaker rules above. ``hedge=False`` for calls that can't run
+    twice at once (e.g. ones reading a shared file object).
+    """
+    policy = policies.get(provider)
+    attempts = 1 + (getattr(settings, "PROVIDER_RETRIES", 2) if idempotent else 0)
+
+    for attempt in range(attempts):
+        timeout = attempt_timeout()
+        trial = policy.breaker.before_call()
+        started = time.monotonic()
+        try:
+            with upstream(provider):
+                if idempotent and should_hedge(hedge):
+                    result = run_hedged(policy, fn, timeout)
+                else:
+                    result = fn(timeout)
+        except Exception as e:
+            if not is_retryable(e):
+                # The provider answered (e.g. a 400 or a safety block); it is healthy
+                policy.breaker.record_success()
+                raise
+            policy.breaker.record_failure()
+            pause = backoff(attempt)
+            left = remaining()
+            if attempt == attempts - 1 or (left is not None and pause >= left):
+                raise give_up(e) from e
+            registry.count_event(provider, "retry")
+            time.sleep(pause)
+        except BaseException:
+            if trial:
+                policy.breaker.release_trial()
+            raise
+        else:
+            policy.record_latency(time.monotonic() - started)
+            policy.breaker.record_success()
+            return result
+
+
+# --- Async calls ---
+
+async def arun_hedged(policy, coroutine_fn, timeout):
+    delay = policy.hedge_delay()
+    if delay is None or delay >= timeout:
+        return await asyncio.wait_for(coroutine_fn(timeout), timeout)
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    primary = asyncio.ensure_future(asyncio.wait_for(coroutine_fn(timeout), timeout))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+
+    registry.count_event(policy.name, "hedge")
+    left = timeout - (loop.time() - started)
+    pending = {primary, asyncio.ensure_future(asyncio.wait_for(coroutine_fn(left), left))}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def acall(provider, coroutine_fn, idempotent=True, hedge=True):
+    """``call`` for coroutines: ``await coroutine_fn(timeout)``, cancelled at the timeout."""
+    policy = policies.get(provider)
+    attempts = 1 + (getattr(settings, "PROVIDER_RETRIES", 2) if idempotent else 0)
+
+    for attempt in range(attempts):
+        timeout = attempt_timeout()
+        trial = policy.breaker.before_call()
+        started = time.monotonic()
+        try:
+            with upstream(provider):
+                if idempotent and should_hedge(hedge):
+                    result = await arun_hedged(policy, coroutine_fn, timeout)
+                else:
+                    result = await asyncio.wait_for(coroutine_fn(timeout), timeout)
+        except Exception as e:
+            if not is_retryable(e):
+                policy.breaker.record_success()
+                raise
+            policy.breaker.record_failure()
+            pause = backoff(attempt)
+            left = remaining()
+            if attempt == attempts - 1 or (left is not None and pause >= left):
+                raise give_up(e) from e
+            registry.count_event(provider, "retry")
+            await asyncio.sleep(pause)
+        except BaseException:
+            # Cancelled, e.g. the client went away: no verdict on the provider
+            if trial:
+                policy.breaker.release_trial()
+            raise
+        else:
+            policy.record_latency(time.monotonic() - started)
+            policy.breaker.record_success()
+            return result
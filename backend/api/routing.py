@@ -0,0 +1,198 @@
+# routing.py
+#
+# Picks the Gemini model for each chat request among CHAT_MODELS (listed
+# best first), from the request and from how each model has been doing:
+#
+#   - Short, non-code messages (up to CHAT_ROUTER_SHORT_CHARS) go to the model
+#     with the lowest latency EWMA; a model without samples yet is tried first
+#     so that every model gets measured. Latency is tracked per model and call
+#     shape (short/long/code, plain or streamed), so a fast streamed open or a
+#     slow long answer doesn't skew the numbers short requests are ranked by.
+#   - Code mode and longer messages go to the first model in CHAT_MODELS.
+#   - A model is degraded while its error rate EWMA is above
+#     CHAT_ROUTER_MAX_ERROR_RATE (until CHAT_ROUTER_RECOVERY seconds pass
+#     without calls to it) or while its circuit breaker is open. Degraded
+#     models are only used when nothing else is left.
+#   - When a call still fails after resilience.call's retries, the request
+#     falls back to the next model.
+#
+# Each model is its own provider for api/resilience.py ("gemini:<model>"),
+# so one model's failures don't open the breaker of the others. The chosen
+# model and the reason are returned as a Route (sent as X-Chat-Model and
+# X-Chat-Route), counted in darkai_chat_routes_total, and the EWMAs are
+# exported as gauges on /api/metrics/. Background calls (conversation
+# summaries) pass ``count=False``: they still fall back between models and
+# count against a failing one, but are neither counted as routes nor timed.
+
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from . import resilience
+from .metrics import registry
+
+DEFAULT_MODELS = ("gemini-2.5-flash",)
+
+
+class Route:
+    __slots__ = ("model", "reason")
+
+    def __init__(self, model, reason):
+        self.model = model
+        self.reason = reason  # "fastest", "code", "long", "fallback" or "degraded"
+
+    def headers(self):
+        return {"X-Chat-Model": self.model, "X-Chat-Route": self.reason}
+
+
+class ModelStats:
+    __slots__ = ("latency", "error_rate", "updated_at")
+
+    def __init__(self):
+        self.latency = {}  # shape -> seconds, EWMA of successful calls
+        self.error_rate = 0.0
+        self.updated_at = 0.0
+
+
+def provider_name(model):
+    return f"gemini:{model}"
+
+
+def call_shape(message, is_code_mode, stream=False):
+    """``short``, ``long`` or ``code``, with ``-stream`` for streamed calls."""
+    if is_code_mode:
+        shape = "code"
+    elif len(message) > getattr(settings, "CHAT_ROUTER_SHORT_CHARS", 120):
+        shape = "long"
+    else:
+        shape = "short"
+    return f"{shape}-stream" if stream else shape
+
+
+def chat_models():
+    return list(getattr(settings, "CHAT_MODELS", None) or DEFAULT_MODELS)
+
+
+class ChatRouter:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def get_stats(self, model):
+        stats = self.stats.get(model)
+        if stats is None:
+            with self.lock:
+                stats = self.stats.setdefault(model, ModelStats())
+        return stats
+
+    def observe(self, model, shape=None, seconds=None, failed=False):
+        """Record a call to ``model``; the latency of a success is kept under its ``shape``."""
+        alpha = getattr(settings, "CHAT_ROUTER_ALPHA", 0.2)
+        stats = self.get_stats(model)
+        with self.lock:
+            stats.error_rate += alpha * ((1.0 if failed else 0.0) - stats.error_rate)
+            if seconds is not None:
+                latency = stats.latency.get(shape)
+                stats.latency[shape] = seconds if latency is None else latency + alpha * (seconds - latency)
+            stats.updated_at = time.monotonic()
+            latencies = dict(stats.latency)
+        registry.set_model_stats(model, latencies, stats.error_rate)
+
+    def degraded(self, model):
+        stats = self.get_stats(model)
+        if resilience.policies.get(provider_name(model)).breaker.is_open():
+            return True
+        recent = time.monotonic() - stats.updated_at < getattr(settings, "CHAT_ROUTER_RECOVERY", 60)
+        return recent and stats.error_rate > getattr(settings, "CHAT_ROUTER_MAX_ERROR_RATE", 0.3)
+
+    def candidates(self, message, is_code_mode, stream=False):
+        """``[(model, reason), ...]`` in the order to try them."""
+        models = chat_models()
+        healthy = [model for model in models if not self.degraded(model)]
+        degraded = [(model, "degraded") for model in models if model not in healthy]
+
+        if is_code_mode:
+            return [(model, "code") for model in healthy] + degraded
+        if len(message) > getattr(settings, "CHAT_ROUTER_SHORT_CHARS", 120):
+            return [(model, "long") for model in healthy] + degraded
+
+        shape = call_shape(message, is_code_mode, stream)
+
+        def expected_latency(model):
+            latency = self.get_stats(model).latency.get(shape)
+            return -1 if latency is None else latency
+
+        return [(model, "fastest") for model in sorted(healthy, key=expected_latency)] + degraded
+
+    def failed(self, error):
+        """Whether ``error`` counts against the model (a breaker rejection or a 400 doesn't)."""
+        return isinstance(error, resilience.ProviderTimeout) or resilience.is_retryable(error)
+
+    def should_fall_back(self, error):
+        if isinstance(error, resilience.ProviderUnavailable):
+            return True
+        left = resilience.remaining()
+        if left is not None and left <= 0:
+            return False  # no time left for another model
+        return self.failed(error)
+
+    def finish(self, model, reason, attempt, shape, started, count):
+        route = Route(model, reason if attempt == 0 else "fallback")
+        if count:
+            self.observe(model, shape, time.monotonic() - started)
+            registry.count_route(route.model, route.reason)
+        else:
+            self.observe(model)
+        return route
+
+    def call(self, message, is_code_mode, fn, stream=False, count=True, **call_options):
+        """
+        ``fn(model, timeout)`` on the routed model, through resilience.call;
+        returns ``(result, Route)``. ``stream=True`` when ``fn`` only opens a
+        stream, ``count=False`` for calls that aren't chat requests.
+        """
+        shape = call_shape(message, is_code_mode, stream)
+        candidates = self.candidates(message, is_code_mode, stream)
+        for attempt, (model, reason) in enumerate(candidates):
+            started = time.monotonic()
+            try:
+                # model bound now: a hedged attempt may start after the loop moved on
+                result = resilience.call(
+                    provider_name(model), lambda timeout, model=model: fn(model, timeout), **call_options
+                )
+            except Exception as e:
+                if self.failed(e):
+                    self.observe(model, failed=True)
+                if attempt == len(candidates) - 1 or not self.should_fall_back(e):
+                    raise
+            else:
+                return result, self.finish(model, reason, attempt, shape, started, count)
+
+    async def acall(self, message, is_code_mode, coroutine_fn, stream=False, count=True, **call_options):
+        """``call`` for coroutines: awaits ``coroutine_fn(model, timeout)``."""
+        shape = call_shape(message, is_code_mode, stream)
+        candidates = self.candidates(message, is_code_mode, stream)
+        for attempt, (model, reason) in enumerate(candidates):
+            started = time.monotonic()
+            try:
+                result = await resilience.acall(
+                    provider_name(model), lambda timeout, model=model: coroutine_fn(model, timeout), **call_options
+                )
+            except Exception as e:
+                if self.failed(e):
+                    self.observe(model, failed=True)
+                if attempt == len(candidates) - 1 or not self.should_fall_back(e):
+                    raise
+            else:
+                return result, self.finish(model, reason, attempt, shape, started, count)
+
+
+router = ChatRouter()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=router.reset)
@@ -0,0 +1,71 @@
+# singleflight.py
+#
+# Request coalescing: while an upstream call for a key is in flight, other
+# requests with the same key wait for it and share its result (or error)
+# instead of starting their own. Works for threads (sync views) and for
+# coroutines on one event loop (async views).
+
+import asyncio
+import threading
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.executed = 0   # upstream calls actually made
+        self.coalesced = 0  # requests served by another request's call
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    async def ado(self, key, coroutine_fn):
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.ensure_future(coroutine_fn())
+            task.add_done_callback(lambda _: self.tasks.pop(key, None))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+        # A cancelled request must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {"executed": self.executed, "coalesced": self.coalesced}
+
+
+chat_flight = SingleFlight("chat")
+image_flight = SingleFlight("image")
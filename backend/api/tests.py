@@ -1,3 +1,1202 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO
+from smtplib import SMTPException
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail import get_connection
+from django.db.models import TextField
+from django.db.models.functions import Cast
+from django.http import StreamingHttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import async_views, conversations, derivatives, gallery, images, providers, resilience, tts, views
+from .chat_cache import MemoryBackend, ResponseCache, chat_cache
+from .custom_responses import CustomResponseMatcher, ReloadingMatcher
+from .fakes import FakeChatModel, FakeProviderError, FakeProviders, Faults, fake_png
+from .jobs import ImageJobQueue, image_jobs
+from .markdown import MarkdownCleaner, clean_gemini_response
+from .models import ConversationTurn, GeneratedImage, ImageJob, OutboxEmail, SignupOTP, TTSAudio, UserQuota
+from .outbox import email_outbox
+from .otp import OTP_INVALID, OTP_LOCKED, OTP_OK, DatabaseOTPStore, MemoryOTPStore
+from .prompts import CHAT_INSTRUCTION, CODE_INSTRUCTION
+from .metrics import metrics_middleware, registry, stage
+from .providers import ProviderManager
+from .quotas import client_key, consume_quota, limiter, refund_quota
+from .routing import ChatRouter
+from .singleflight import SingleFlight
+
+
+def auth_header(user):
+    return {"HTTP_AUTHORIZATION": f"Bearer {RefreshToken.for_user(user).access_token}"}
+
+
+def parse_sse(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def sse_events(response):
+    """``[(event, data), ...]`` of a text/event-stream response."""
+    return parse_sse(b"".join(response.streaming_content).decode())
+
+
+async def asse_events(response):
+    return parse_sse(b"".join([chunk async for chunk in response.streaming_content]).decode())
+
+
+# Batch items are generated on pool threads, which need their own connections
+# to see committed rows, hence TransactionTestCase
+@override_settings(IMAGE_UPLOAD_IN_BACKGROUND=False, IMAGE_DERIVATIVES=False, IMAGE_REUSE=False)
+class ImageBatchQuotaTests(TransactionTestCase):
+    def setUp(self):
+        limiter.buckets.clear()
+        self.providers = FakeProviders(latency=0, payload_bytes=1024)
+        self.providers.__enter__()
+        self.addCleanup(self.providers.__exit__, None, None, None)
+
+    def post_batch(self, body, **extra):
+        return self.client.post("/api/generate-image/batch/", body, content_type="application/json", **extra)
+
+    def test_full_batch_fits_the_rate_limit(self):
+        response = self.post_batch({"prompt": "a cat", "count": 8})
+        self.assertEqual(response.status_code, 200)
+        done = sse_events(response)[-1]
+        self.assertEqual(done[0], "done")
+        self.assertEqual(done[1]["succeeded"], 8)
+
+    def test_daily_quota_is_charged_per_image(self):
+        user = User.objects.create_user("batch", "batch@example.com", "password-123")
+        response = self.post_batch({"prompts": ["a", "b", "c"]}, **auth_header(user))
+        self.assertEqual(response.status_code, 200)
+        sse_events(response)
+        self.assertEqual(UserQuota.objects.get(user=user).daily_quota, 15)
+        self.assertEqual(response["X-Quota-Remaining"], "85")
+
+
+@override_settings(IMAGE_UPLOAD_IN_BACKGROUND=False, IMAGE_DERIVATIVES=False, IMAGE_REUSE=False)
+class ImagePipelineTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="artist", password="pw")
+        self.providers = FakeProviders(latency=0, payload_bytes=2048)
+        self.providers.__enter__()
+        self.addCleanup(self.providers.__exit__, None, None, None)
+        # Spy on the uploads; the fake still does the work
+        patcher = mock.patch.object(providers.providers, "upload", wraps=self.providers.uploader.upload)
+        self.upload = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_image_goes_from_memory_to_upload_and_row(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                url = images.create_image("A red fox", user_id=self.user.id)
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(os.listdir(directory), [])
+
+        file = self.upload.call_args.args[0]
+        self.assertIsInstance(file, BytesIO)
+        self.assertTrue(file.getvalue().startswith(b"\x89PNG"))
+        public_id = self.upload.call_args.kwargs["public_id"]
+        self.assertTrue(public_id.startswith(images.IMAGE_FOLDER + "/"))
+        self.assertEqual(url, self.providers.uploader.asset_url(public_id))
+
+        image = GeneratedImage.objects.annotate(url=Cast("file_name", output_field=TextField())).get()
+        self.assertEqual((image.prompt, image.url, image.user), ("A red fox", url, self.user))
+        self.assertEqual(image.prompt_hash, images.prompt_hash("a red  FOX"))
+
+    def test_every_image_gets_its_own_public_id(self):
+        urls = {images.create_image("Same prompt") for _ in range(3)}
+        self.assertEqual(len(urls), 3)
+        self.assertEqual(len({call.kwargs["public_id"] for call in self.upload.call_args_list}), 3)
+        self.assertEqual(GeneratedImage.objects.count(), 3)
+
+
+@override_settings(IMAGE_UPLOAD_IN_BACKGROUND=False, IMAGE_DERIVATIVES=False, IMAGE_REUSE=True,
+                   IMAGE_REUSE_WINDOW=3600, COALESCE_IMAGES=False, QUOTA_COSTS={"image": 1})
+class ImageReuseTests(TestCase):
+    def setUp(self):
+        limiter.buckets.clear()
+        resilience.policies.reset()
+        self.providers = FakeProviders(latency=0, payload_bytes=1024)
+        self.providers.__enter__()
+        self.addCleanup(self.providers.__exit__, None, None, None)
+
+    def post(self, body):
+        request = RequestFactory().post("/", json.dumps(body), content_type="application/json")
+        return views.GenerateImageAPIView.as_view()(request)
+
+    def test_repeated_prompt_reuses_the_stored_image(self):
+        first = self.post({"prompt": "A red fox"}).data
+        self.assertNotIn("reused", first)
+        # Same prompt after normalization
+        self.assertEqual(self.post({"prompt": "  a RED   fox"}).data, {"file_name": first["file_name"], "reused": True})
+        self.assertEqual(self.providers.calls()["image"], 1)
+        self.assertEqual(self.post({"prompt": "A blue fox"}).data.get("reused"), None)
+        self.assertEqual(self.providers.calls()["image"], 2)
+
+    def test_fresh_bypasses_reuse(self):
+        first = self.post({"prompt": "A red fox"}).data
+        fresh = self.post({"prompt": "A red fox", "fresh": True}).data
+        self.assertNotIn("reused", fresh)
+        self.assertNotEqual(fresh["file_name"], first["file_name"])
+        self.assertEqual(self.providers.calls()["image"], 2)
+        self.assertEqual(GeneratedImage.objects.count(), 2)
+
+        # Later requests reuse the newest image
+        self.assertEqual(self.post({"prompt": "A red fox"}).data["file_name"], fresh["file_name"])
+
+    def test_images_outside_the_window_are_not_reused(self):
+        first = self.post({"prompt": "A red fox"}).data
+        GeneratedImage.objects.update(created_at=timezone.now() - timedelta(hours=2))
+        second = self.post({"prompt": "A red fox"}).data
+        self.assertNotIn("reused", second)
+        self.assertNotEqual(second["file_name"], first["file_name"])
+
+
+class DerivativeTests(TransactionTestCase):
+    def encoded(self, mode, size):
+        buffer = BytesIO()
+        Image.new(mode, size, (10, 20, 30, 128)[:len(mode)]).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def decoded(self, data):
+        with Image.open(BytesIO(data)) as image:
+            return image.format, image.mode, image.size
+
+    def test_render_variants_sizes_and_formats(self):
+        variants = derivatives.render_variants(self.encoded("RGB", (800, 400)), thumbnail_size=320)
+        self.assertEqual(set(variants), {"webp", "thumbnail"})
+        self.assertEqual(self.decoded(variants["webp"]), ("WEBP", "RGB", (800, 400)))
+        # The thumbnail fits the box and keeps the aspect ratio
+        self.assertEqual(self.decoded(variants["thumbnail"]), ("WEBP", "RGB", (320, 160)))
+
+        # Transparency survives, and small images are not scaled up
+        variants = derivatives.render_variants(self.encoded("RGBA", (100, 50)), thumbnail_size=320)
+        self.assertEqual(self.decoded(variants["thumbnail"]), ("WEBP", "RGBA", (100, 50)))
+
+    def test_avif_only_when_asked_and_supported(self):
+        data = fake_png(3000)
+        with mock.patch("api.derivatives.avif_supported", return_value=False):
+            self.assertNotIn("avif", derivatives.render_variants(data, avif=True))
+        if derivatives.avif_supported():
+            self.assertNotIn("avif", derivatives.render_variants(data))
+            self.assertEqual(self.decoded(derivatives.render_variants(data, avif=True)["avif"])[0], "AVIF")
+
+    @override_settings(IMAGE_DERIVATIVES=True, IMAGE_THUMBNAIL_SIZE=64)
+    def test_schedule_derivatives_uploads_and_records_the_variants(self):
+        def run_inline(fn, *args):
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+
+        image = GeneratedImage.objects.create(prompt="A red fox", file_name="image/upload/fox.png")
+        with FakeProviders(latency=0) as fakes, mock.patch.object(images.derivative_pool, "submit", run_inline):
+            images.schedule_derivatives(image.id, "darkai/generated/fox", fake_png(3000))
+            # The uploads happen on an upload_pool thread
+            deadline = time.monotonic() + 5
+            while not GeneratedImage.objects.filter(id=image.id).exclude(thumbnail_url="").exists():
+                self.assertLess(time.monotonic(), deadline, "derivatives were not stored")
+                time.sleep(0.01)
+
+        image.refresh_from_db()
+        self.assertEqual(image.thumbnail_url, fakes.uploader.asset_url("darkai/generated/fox_thumbnail"))
+        self.assertEqual(image.webp_url, fakes.uploader.asset_url("darkai/generated/fox_webp"))
+        self.assertEqual(image.avif_url, "")
+
+    @override_settings(IMAGE_DERIVATIVES=False)
+    def test_nothing_is_scheduled_when_disabled(self):
+        with mock.patch.object(images.derivative_pool, "submit") as submit:
+            images.schedule_derivatives(1, "darkai/generated/fox", b"")
+        submit.assert_not_called()
+
+
+class TTSCacheTests(TestCase):
+    def setUp(self):
+        resilience.policies.reset()
+        tts.recent_audio.entries.clear()
+        self.providers = FakeProviders(latency=0, payload_bytes=256)
+        self.providers.__enter__()
+        self.addCleanup(self.providers.__exit__, None, None, None)
+
+    def test_identical_text_and_lang_hit_the_cache(self):
+        url, cached = tts.get_audio_url("Hello there. How are you?", "en")
+        self.assertFalse(cached)
+        self.assertEqual(tts.get_audio_url("  Hello there.\nHow are   you?", "en"), (url, True))
+        self.assertEqual(self.providers.uploader.calls, 1)
+        self.assertEqual(TTSAudio.objects.get().audio_url, url)
+        self.assertTrue(url.endswith(f"{tts.TTS_FOLDER}/{tts.audio_key('Hello there. How are you?', 'en')}"))
+
+    def test_different_text_or_lang_misses(self):
+        url, _ = tts.get_audio_url("Hello there.", "en")
+        other_lang, cached = tts.get_audio_url("Hello there.", "fr")
+        self.assertFalse(cached)
+        other_text, cached = tts.get_audio_url("Hello there!", "en")
+        self.assertFalse(cached)
+        self.assertEqual(len({url, other_lang, other_text}), 3)
+        self.assertEqual(self.providers.uploader.calls, 3)
+
+    def test_database_answers_when_the_memory_cache_is_cold(self):
+        url, _ = tts.get_audio_url("Hello there.", "en")
+        tts.recent_audio.entries.clear()  # e.g. another worker, or a restart
+        self.assertEqual(tts.get_audio_url("Hello there.", "en"), (url, True))
+        self.assertEqual(self.providers.uploader.calls, 1)
+        self.assertEqual(tts.recent_audio.get(tts.audio_key("Hello there.", "en")), url)
+
+
+class TTSSegmentTests(TestCase):
+    def test_split_segments_packs_whole_sentences(self):
+        self.assertEqual(tts.split_segments("One. Two! Three? Four.", max_chars=100), ["One. Two! Three? Four."])
+        # "Aaaa. Bbbb." is exactly 11 characters, so it still fits
+        self.assertEqual(tts.split_segments("Aaaa. Bbbb. Cccc.", max_chars=11), ["Aaaa. Bbbb.", "Cccc."])
+        self.assertEqual(tts.split_segments("Aaaa. Bbbb. Cccc.", max_chars=10), ["Aaaa.", "Bbbb.", "Cccc."])
+        # A sentence longer than the limit stays whole
+        self.assertEqual(tts.split_segments("Short. " + "x" * 20 + ". End.", max_chars=10),
+                         ["Short.", "x" * 20 + ".", "End."])
+        # Only punctuation followed by whitespace ends a sentence
+        self.assertEqual(tts.split_segments("Version 2.5 is out:yes", max_chars=5), ["Version 2.5 is out:yes"])
+        self.assertEqual(tts.split_segments("", max_chars=10), [])
+
+    def test_segments_are_joined_in_text_order(self):
+        def synthesize(segment, lang):
+            # Later segments finish first
+            time.sleep(0.01 * (5 - int(segment[-2])))
+            return segment.encode()
+
+        text = " ".join(f"Segment number {i}." for i in range(5))
+        with override_settings(TTS_SEGMENT_CHARS=20), mock.patch("api.tts.synthesize_segment", synthesize):
+            self.assertEqual(len(tts.split_segments(text)), 5)
+            self.assertEqual(tts.synthesize_mp3(text, "en").getvalue(), text.replace(". ", ".").encode())
+
+            stored = threading.Event()
+            with mock.patch("api.tts.store_audio_in_background", side_effect=lambda *args: stored.set()) as store:
+                parts = list(tts.stream_audio(text, "en", "key"))
+                self.assertTrue(stored.wait(5))
+            self.assertEqual(parts, [f"Segment number {i}.".encode() for i in range(5)])
+            store.assert_called_once_with(b"".join(parts), "key", "en")
+
+
+@override_settings(CONVERSATION_TOKEN_BUDGET=100, CONVERSATION_MIN_RECENT_TURNS=2)
+class ConversationCompactionTests(TestCase):
+    def setUp(self):
+        resilience.policies.reset()
+        self.providers = FakeProviders(latency=0, payload_bytes=64)
+        self.providers.__enter__()
+        self.addCleanup(self.providers.__exit__, None, None, None)
+        model = self.providers.chat_model
+        patcher = mock.patch.object(model, "generate_content", wraps=model.generate_content)
+        self.generate_content = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conversation = conversations.start_conversation(None)
+        self.turns = []
+
+    def add_exchanges(self, count):
+        for _ in range(count):
+            for role in (ConversationTurn.USER, ConversationTurn.MODEL):
+                text = f"turn {len(self.turns) + 1:02d} ".ljust(80, ".")  # 20 tokens each
+                self.turns.append(ConversationTurn.objects.create(
+                    conversation=self.conversation, role=role, text=text, tokens=conversations.estimate_tokens(text)))
+
+    def test_turns_over_the_budget_are_folded_into_the_summary(self):
+        self.add_exchanges(2)  # 80 tokens, under the budget
+        conversations.compact(self.conversation.id)
+        self.generate_content.assert_not_called()
+
+        self.add_exchanges(4)  # 240 tokens; the newest five turns fill the budget
+        conversations.compact(self.conversation.id)
+        self.generate_content.assert_called_once()
+        prompt = self.generate_content.call_args.args[0]
+        self.assertIn("(none yet)", prompt)
+        # Whole exchanges only: turns 1-6 are summarized, 7-12 kept verbatim
+        for turn in self.turns[:6]:
+            self.assertIn(f"{turn.role}: {turn.text}", prompt)
+        for turn in self.turns[6:]:
+            self.assertNotIn(turn.text, prompt)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary, self.providers.chat_model.text.strip())
+        self.assertEqual(self.conversation.summarized_until, self.turns[5].id)
+
+        history = conversations.build_history(self.conversation)
+        self.assertEqual(history[0]["parts"], [f"Summary of our conversation so far:\n{self.conversation.summary}"])
+        # What fits the budget, starting at a user turn
+        self.assertEqual([entry["parts"][0] for entry in history[2:]], [turn.text for turn in self.turns[8:]])
+
+        # The kept turns fit, so there is nothing more to fold
+        conversations.compact(self.conversation.id)
+        self.generate_content.assert_called_once()
+
+
+@override_settings(IMAGE_UPLOAD_IN_BACKGROUND=False, IMAGE_DERIVATIVES=False, IMAGE_REUSE=False)
+class AsyncStreamingTests(TransactionTestCase):
+    """The ASGI streaming views must return async iterators, or Django buffers the whole body."""
+
+    def setUp(self):
+        limiter.buckets.clear()
+        self.providers = FakeProviders(latency=0.01, payload_bytes=512)
+        self.providers.__enter__()
+        self.addCleanup(self.providers.__exit__, None, None, None)
+        self.factory = AsyncRequestFactory()
+
+    def post(self, view, body):
+        request = self.factory.post("/", json.dumps(body), content_type="application/json")
+        return view.as_view()(request)
+
+    async def test_chat_stream_sends_chunks_as_they_arrive(self):
+        response = await self.post(async_views.AsyncChatStreamView, {"message": "Hi there", "code_mode": True})
+        self.assertTrue(response.is_async)
+        events = await asse_events(response)
+        self.assertGreater(len([event for event, _ in events if event == "chunk"]), 1)
+        self.assertEqual(events[-1][0], "done")
+        self.assertEqual(events[-1][1]["bot_response"], self.providers.chat_model.text)
+
+    async def test_batch_stream_sends_a_result_per_item(self):
+        response = await self.post(async_views.AsyncGenerateImageBatchView, {"prompts": ["a", "b", "c", "d"]})
+        self.assertTrue(response.is_async)
+        events = await asse_events(response)
+        self.assertEqual(sorted(data["index"] for event, data in events if event == "result"), [0, 1, 2, 3])
+        self.assertEqual(events[-1][1]["succeeded"], 4)
+
+
+class ChatStreamTests(TestCase):
+    def setUp(self):
+        limiter.buckets.clear()
+        chat_cache.backend.clear()
+        self.providers = FakeProviders(latency=0.01, payload_bytes=512)
+        self.providers.__enter__()
+        self.addCleanup(self.providers.__exit__, None, None, None)
+
+    def post(self, body):
+        request = RequestFactory().post("/", json.dumps(body), content_type="application/json")
+        return views.ChatStreamAPIView.as_view()(request)
+
+    def test_chunks_are_framed_as_events_and_end_with_done(self):
+        response = self.post({"message": "Hi there", "code_mode": True})
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertFalse(response.is_async)
+        body = b"".join(response.streaming_content).decode()
+        self.assertTrue(body.endswith("\n\n"))
+        for block in body.strip().split("\n\n"):
+            self.assertRegex(block, r"^event: \w+\ndata: \{.*\}$")
+
+        events = parse_sse(body)
+        chunks = [data["text"] for event, data in events[:-1]]
+        self.assertEqual([event for event, _ in events[:-1]], ["chunk"] * len(chunks))
+        self.assertGreater(len(chunks), 1)
+        event, done = events[-1]
+        self.assertEqual(event, "done")
+        self.assertEqual(done["bot_response"], "".join(chunks))
+        self.assertEqual(done["bot_response"], self.providers.chat_model.text)
+        self.assertEqual(done["chunks"], len(chunks))
+        self.assertIsNotNone(done["model"])
+
+    def test_repeated_message_is_streamed_from_the_cache(self):
+        first = sse_events(self.post({"message": "Hi there"}))
+        second = sse_events(self.post({"message": "hi there?"}))
+        self.assertEqual(self.providers.chat_model.calls, 1)
+        self.assertEqual(second, [
+            ("chunk", {"text": first[-1][1]["bot_response"]}),
+            ("done", mock.ANY),
+        ])
+        self.assertEqual(first[-1][1]["bot_response"], clean_gemini_response(self.providers.chat_model.text))
+        self.assertIsNone(second[-1][1]["model"])
+
+
+class CustomResponseTests(TestCase):
+    TABLE = {
+        "greeting": {"keywords": ["hello", "hi there"], "response": "Hello!"},
+        "creator": {"keywords": ["who made you", "hello"], "response": "A developer."},
+        "weather": {"keywords": ["weather"], "response": "No forecasts here."},
+    }
+
+    def write_table(self, path, table, mtime):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(table, f)
+        os.utime(path, (mtime, mtime))
+
+    def test_first_matching_category_wins(self):
+        matcher = CustomResponseMatcher(self.TABLE)
+        # The weather keyword comes first in the message, but greeting is listed first
+        self.assertEqual(matcher.match("Weather today? Hi there"), "Hello!")
+        # "hello" is listed under both; the earlier category keeps it
+        self.assertEqual(matcher.match("hello, who made you?"), "Hello!")
+        self.assertEqual(matcher.match("So, WHO MADE YOU"), "A developer.")
+        # Keywords only match whole words
+        self.assertIsNone(matcher.match("Othello and weathered rocks"))
+
+    @override_settings(CUSTOM_RESPONSES_RELOAD_INTERVAL=0)
+    def test_reload_picks_up_changed_keywords(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "custom_responses.json")
+            self.write_table(path, self.TABLE, 1000)
+            matcher = ReloadingMatcher(path)
+            self.assertEqual(matcher.get().match("what's the weather"), "No forecasts here.")
+
+            table = dict(self.TABLE, weather={"keywords": ["forecast"], "response": "Still none."})
+            self.write_table(path, table, 2000)
+            self.assertIsNone(matcher.get().match("what's the weather"))
+            self.assertEqual(matcher.get().match("any forecast?"), "Still none.")
+
+            # A broken file keeps the previous table in service
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("{not json")
+            os.utime(path, (3000, 3000))
+            with self.assertLogs("api.custom_responses", "ERROR"):
+                self.assertEqual(matcher.get().match("any forecast?"), "Still none.")
+
+
+class ChatCacheTests(TestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        backend = MemoryBackend(max_entries=2, ttl=60)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        self.assertEqual(backend.get("a"), 1)  # "b" is now the oldest
+        backend.set("c", 3)
+        self.assertEqual(list(backend.entries), ["a", "c"])
+        self.assertIsNone(backend.get("b"))
+
+    def test_entries_expire_after_the_ttl(self):
+        backend = MemoryBackend(max_entries=10, ttl=60)
+        with mock.patch("api.chat_cache.time.monotonic", return_value=1000.0):
+            backend.set("a", 1)
+        with mock.patch("api.chat_cache.time.monotonic", return_value=1059.0):
+            self.assertEqual(backend.get("a"), 1)
+        with mock.patch("api.chat_cache.time.monotonic", return_value=1060.0):
+            self.assertIsNone(backend.get("a"))
+        self.assertEqual(backend.entries, {})
+
+    def test_hits_and_misses_are_counted(self):
+        cache = ResponseCache(MemoryBackend(max_entries=10, ttl=60))
+        self.assertIsNone(cache.get("Hi there", False))
+        cache.set("Hi there", False, "Hello!")
+        self.assertEqual(cache.get("  hi   THERE?", False), "Hello!")  # normalized
+        self.assertIsNone(cache.get("Hi there", True))  # code mode is cached apart
+        self.assertEqual(cache.stats(), {"backend": "MemoryBackend", "hits": 1, "misses": 2, "hit_rate": 0.3333})
+
+    async def test_async_lookups_share_the_counters(self):
+        cache = ResponseCache(MemoryBackend(max_entries=10, ttl=60))
+        await cache.aset("Hi there", False, "Hello!")
+        self.assertEqual(await cache.aget("hi there", False), "Hello!")
+        self.assertIsNone(await cache.aget("bye", False))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_disabled_cache_counts_nothing(self):
+        cache = ResponseCache(None)
+        cache.set("Hi there", False, "Hello!")
+        self.assertIsNone(cache.get("Hi there", False))
+        self.assertEqual(cache.stats(), {"backend": None, "hits": 0, "misses": 0, "hit_rate": 0.0})
+
+
+@override_settings(IMAGE_UPLOAD_IN_BACKGROUND=False, IMAGE_DERIVATIVES=False, PROVIDER_RETRIES=0)
+class ImageJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("jobs", "jobs@example.com", "password-123")
+
+    def test_finished_job_has_the_image_url(self):
+        job = ImageJob.objects.create(prompt="a lighthouse", user=self.user)
+        with FakeProviders(latency=0, payload_bytes=512):
+            image_jobs.run(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImageJob.DONE)
+        self.assertTrue(job.result_url.startswith("https://"))
+
+    def test_failed_job_refunds_the_image_quota(self):
+        UserQuota.objects.create(user=self.user, daily_quota=5, last_reset=timezone.localdate())
+        job = ImageJob.objects.create(prompt="a lighthouse", user=self.user)
+        with FakeProviders(latency=0, failure_rate=1.0), self.assertLogs("api.jobs", "ERROR"):
+            image_jobs.run(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImageJob.FAILED)
+        self.assertEqual(UserQuota.objects.get(user=self.user).daily_quota, 0)
+
+    @override_settings(IMAGE_JOB_STALE_AFTER=300, IMAGE_JOB_REQUEUE_INTERVAL=60)
+    def test_workers_requeue_jobs_orphaned_while_they_run(self):
+        queue = ImageJobQueue()
+        long_ago = timezone.now() - timedelta(minutes=10)
+
+        def orphan():
+            return ImageJob.objects.create(prompt="a lighthouse", status=ImageJob.RUNNING, started_at=long_ago)
+
+        def stop_after_one_pass():
+            queue.stopping.set()
+
+        first = orphan()
+        with mock.patch.object(queue, "claim", side_effect=stop_after_one_pass):
+            queue.work()
+        first.refresh_from_db()
+        self.assertEqual(first.status, ImageJob.QUEUED)
+
+        # A worker dies later: the next sweep, not only the one at start, picks it up
+        second = orphan()
+        queue.requeue_stale_periodically()
+        self.assertEqual(ImageJob.objects.get(id=second.id).status, ImageJob.RUNNING)
+        queue.next_requeue = 0
+        queue.requeue_stale_periodically()
+        self.assertEqual(ImageJob.objects.get(id=second.id).status, ImageJob.QUEUED)
+
+    def test_events_stop_once_the_job_is_done(self):
+        job = ImageJob.objects.create(prompt="a lighthouse", status=ImageJob.DONE, result_url="https://x/y")
+        events = parse_sse("".join(views.image_job_events(job.id)))
+        self.assertEqual(events, [("status", views.job_payload(job))])
+
+    async def test_async_events_stop_once_the_job_is_done(self):
+        job = await ImageJob.objects.acreate(prompt="a lighthouse", status=ImageJob.DONE, result_url="https://x/y")
+        events = parse_sse("".join([event async for event in async_views.aimage_job_events(job.id)]))
+        self.assertEqual(events, [("status", views.job_payload(job))])
+
+    async def test_asgi_view_streams_from_an_async_generator(self):
+        job = await ImageJob.objects.acreate(prompt="a lighthouse", status=ImageJob.DONE, result_url="https://x/y")
+        with mock.patch.object(image_jobs, "threads", [None]):
+            response = await async_views.async_image_job_view(AsyncRequestFactory().get("/", {"stream": 1}), job.id)
+        self.assertTrue(response.is_async)
+        self.assertEqual([event for event, _ in await asse_events(response)], ["status"])
+
+    def test_wsgi_stream_sends_the_status_before_the_job_is_done(self):
+        job = ImageJob.objects.create(prompt="a lighthouse")
+        with mock.patch.object(image_jobs, "threads", [None]):  # no workers: the job stays queued
+            response = self.client.get(f"/api/generate-image/jobs/{job.id}/", {"stream": 1})
+        self.assertFalse(response.is_async)
+        event, data = parse_sse(next(iter(response.streaming_content)).decode())[0]
+        self.assertEqual((event, data["status"]), ("status", ImageJob.QUEUED))
+        response.close()
+
+
+class OTPStoreTests(TestCase):
+    def test_database_store_locks_after_max_attempts(self):
+        store = DatabaseOTPStore(ttl=600, max_attempts=3)
+        self.assertTrue(store.issue("a@example.com", "123456"))
+        self.assertEqual(store.verify("a@example.com", "000000"), OTP_INVALID)
+        self.assertEqual(store.verify("a@example.com", "000001"), OTP_INVALID)
+        self.assertEqual(store.verify("a@example.com", "000002"), OTP_LOCKED)
+        # Locked: even the right OTP is refused
+        self.assertEqual(store.verify("a@example.com", "123456"), OTP_LOCKED)
+
+    def test_database_store_expires_and_is_single_use(self):
+        store = DatabaseOTPStore(ttl=600, max_attempts=3)
+        store.issue("a@example.com", "123456")
+        self.assertEqual(store.verify("a@example.com", "123456"), OTP_OK)
+        self.assertEqual(store.verify("a@example.com", "123456"), OTP_INVALID)
+
+        store.issue("b@example.com", "123456")
+        SignupOTP.objects.filter(email="b@example.com").update(expires_at=timezone.now())
+        self.assertEqual(store.verify("b@example.com", "123456"), OTP_INVALID)
+
+    def test_resend_interval(self):
+        for store in (DatabaseOTPStore(600, 3, resend_interval=60), MemoryOTPStore(600, 3, resend_interval=60)):
+            self.assertTrue(store.issue("a@example.com", "111111"))
+            self.assertFalse(store.issue("a@example.com", "222222"))
+            self.assertEqual(store.verify("a@example.com", "111111"), OTP_OK)
+
+        store = DatabaseOTPStore(600, 3, resend_interval=60)
+        store.issue("b@example.com", "111111")
+        SignupOTP.objects.filter(email="b@example.com").update(issued_at=timezone.now() - timedelta(seconds=61))
+        self.assertTrue(store.issue("b@example.com", "222222"))
+        self.assertEqual(store.verify("b@example.com", "111111"), OTP_INVALID)
+        self.assertEqual(store.verify("b@example.com", "222222"), OTP_OK)
+
+
+@override_settings(EMAIL_OUTBOX_IN_BACKGROUND=False)
+class SignupOTPTests(TestCase):
+    def auth(self, **body):
+        return self.client.post("/api/auth/", body, content_type="application/json")
+
+    def last_otp(self):
+        return OutboxEmail.objects.latest("id").body.rsplit(" ", 1)[-1]
+
+    def expire_resend_interval(self):
+        SignupOTP.objects.update(issued_at=timezone.now() - timedelta(hours=1))
+
+    def test_resend_issues_a_new_otp(self):
+        response = self.auth(action="signup", username="new", email="new@example.com", password="password-123")
+        self.assertEqual(response.status_code, 201)
+        first = self.last_otp()
+
+        self.assertEqual(self.auth(action="resend", email="new@example.com").status_code, 429)
+        self.expire_resend_interval()
+        self.assertEqual(self.auth(action="resend", email="new@example.com").status_code, 200)
+        second = self.last_otp()
+
+        if first != second:
+            self.assertEqual(self.auth(action="verify", email="new@example.com", otp=first).status_code, 400)
+        self.assertEqual(self.auth(action="verify", email="new@example.com", otp=second).status_code, 200)
+        self.assertTrue(User.objects.get(email="new@example.com").is_active)
+
+    def test_signing_up_again_does_not_touch_a_pending_account(self):
+        self.auth(action="signup", username="new", email="new@example.com", password="password-123")
+        self.expire_resend_interval()
+        response = self.auth(action="signup", username="other", email="new@example.com", password="password-456")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+        self.assertTrue(User.objects.get(email="new@example.com").check_password("password-123"))
+
+    def test_resend_does_not_reveal_unknown_or_active_emails(self):
+        User.objects.create_user("active", "active@example.com", "password-123")
+        for email in ("active@example.com", "nobody@example.com"):
+            self.assertEqual(self.auth(action="resend", email=email).status_code, 200)
+        self.assertFalse(OutboxEmail.objects.exists())
+        self.assertEqual(
+            self.auth(action="signup", username="x", email="active@example.com", password="p").status_code, 400
+        )
+
+
+class QuotaTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("quota", "quota@example.com", "password-123")
+
+    @override_settings(QUOTA_DAILY_LIMIT=10)
+    def test_daily_quota(self):
+        self.assertEqual(consume_quota(self.user, 4), 6)
+        self.assertEqual(consume_quota(self.user, 6), 0)
+        self.assertIsNone(consume_quota(self.user, 1))
+        refund_quota(self.user, 4)
+        self.assertEqual(consume_quota(self.user, 1), 3)
+
+    @override_settings(QUOTA_DAILY_LIMIT=10)
+    def test_quota_resets_on_a_new_day(self):
+        UserQuota.objects.create(user=self.user, daily_quota=10, last_reset=timezone.localdate() - timedelta(days=1))
+        self.assertEqual(consume_quota(self.user, 3), 7)
+
+    def test_row_created_by_a_concurrent_request_is_still_charged(self):
+        get_or_create = UserQuota.objects.get_or_create
+
+        def concurrent_get_or_create(**kwargs):
+            # Another request creates today's row between our increment and get_or_create
+            UserQuota.objects.create(user=self.user, daily_quota=0, last_reset=timezone.localdate())
+            return get_or_create(**kwargs)
+
+        with mock.patch.object(UserQuota.objects, "get_or_create", concurrent_get_or_create):
+            self.assertIsNotNone(consume_quota(self.user, 1))
+        self.assertEqual(UserQuota.objects.get(user=self.user).daily_quota, 1)
+
+    def test_client_key_ignores_forwarded_for_by_default(self):
+        request = RequestFactory().post("/", HTTP_X_FORWARDED_FOR="1.2.3.4", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(client_key(request, None), "ip:10.0.0.1")
+        self.assertEqual(client_key(request, self.user), f"user:{self.user.pk}")
+
+    @override_settings(QUOTA_TRUSTED_PROXY_HOPS=1)
+    def test_client_key_uses_the_address_seen_by_the_trusted_proxy(self):
+        request = RequestFactory().post("/", HTTP_X_FORWARDED_FOR="6.6.6.6, 1.2.3.4", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(client_key(request, None), "ip:1.2.3.4")
+
+
+class MarkdownGoldenTests(TestCase):
+    """The cases of data/markdown_golden.json, cleaned whole and fed in random chunks."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with open(os.path.join(os.path.dirname(__file__), "data", "markdown_golden.json"), encoding="utf-8") as f:
+            cls.golden = json.load(f)
+
+    def test_whole(self):
+        for case in self.golden:
+            with self.subTest(case["name"]):
+                self.assertEqual(clean_gemini_response(case["input"]), case["expected"])
+
+    def test_chunked(self):
+        rng = random.Random(42)
+        for case in self.golden:
+            for _ in range(20):
+                cleaner = MarkdownCleaner()
+                text, out = case["input"], []
+                i = 0
+                while i < len(text):
+                    size = rng.randint(1, 16)
+                    out.append(cleaner.feed(text[i:i + size]))
+                    i += size
+                out.append(cleaner.flush())
+                with self.subTest(case["name"]):
+                    self.assertEqual("".join(out), case["expected"])
+
+
+@override_settings(EMAIL_OUTBOX_IN_BACKGROUND=False, EMAIL_OUTBOX_RETRY_BACKOFF=30, EMAIL_OUTBOX_MAX_ATTEMPTS=3)
+class EmailOutboxTests(TestCase):
+    def queue(self, n):
+        return [
+            OutboxEmail.objects.create(subject=f"Mail {i}", body="Body", from_email="noreply@darkai.com", to=[f"u{i}@example.com"])
+            for i in range(n)
+        ]
+
+    def test_enqueue_sends_right_away_without_the_background_sender(self):
+        email = email_outbox.enqueue("Subject", "Body", "noreply@darkai.com", ["a@example.com"])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["a@example.com"])
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.SENT, 1))
+        self.assertIsNotNone(email.sent_at)
+
+    @override_settings(EMAIL_OUTBOX_BATCH_SIZE=2)
+    def test_batches_share_one_connection(self):
+        self.queue(5)
+        with mock.patch("api.outbox.get_connection", wraps=get_connection) as connect:
+            self.assertEqual(email_outbox.send_pending(), 5)
+        connect.assert_called_once()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(OutboxEmail.objects.filter(status=OutboxEmail.SENT).count(), 5)
+
+    def test_failures_are_retried_with_backoff_then_dead_lettered(self):
+        email, = self.queue(1)
+        with mock.patch("api.outbox.EmailMessage.send", side_effect=SMTPException("mailbox unavailable")):
+            for attempt, backoff in ((1, 30), (2, 60)):
+                before = timezone.now()
+                email_outbox.send_pending()
+                email.refresh_from_db()
+                self.assertEqual((email.status, email.attempts), (OutboxEmail.PENDING, attempt))
+                self.assertGreaterEqual(email.next_attempt_at, before + timedelta(seconds=backoff))
+                # Not due yet: nothing is claimed
+                self.assertEqual(email_outbox.send_pending(), 0)
+                OutboxEmail.objects.filter(id=email.id).update(next_attempt_at=timezone.now())
+
+            with self.assertLogs("api.outbox", "ERROR"):
+                email_outbox.send_pending()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.DEAD, 3))
+        self.assertEqual(email.last_error, "mailbox unavailable")
+        self.assertEqual(email_outbox.send_pending(), 0)
+        self.assertEqual(mail.outbox, [])
+
+    def test_connection_failure_counts_as_an_attempt(self):
+        self.queue(2)
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.open", side_effect=SMTPException("refused")):
+            self.assertEqual(email_outbox.send_pending(), 2)
+        self.assertEqual(
+            list(OutboxEmail.objects.values_list("status", "attempts")), [(OutboxEmail.PENDING, 1)] * 2
+        )
+
+
+class SingleFlightTests(TestCase):
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight("test")
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return "result"
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(flight.do, "key", fn) for _ in range(4)]
+            while flight.executed + flight.coalesced < 4:
+                threading.Event().wait(0.01)
+            release.set()
+            self.assertEqual([future.result() for future in futures], ["result"] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats(), {"executed": 1, "coalesced": 3})
+
+        # The key is free again once the call is done
+        self.assertEqual(flight.do("key", lambda: "again"), "again")
+
+    def test_errors_are_shared_too(self):
+        flight = SingleFlight("test")
+        release = threading.Event()
+
+        def fn():
+            release.wait(5)
+            raise RuntimeError("upstream failed")
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [pool.submit(flight.do, "key", fn) for _ in range(2)]
+            while flight.executed + flight.coalesced < 2:
+                threading.Event().wait(0.01)
+            release.set()
+            for future in futures:
+                with self.assertRaisesMessage(RuntimeError, "upstream failed"):
+                    future.result()
+
+    async def test_coroutines_share_one_task(self):
+        flight = SingleFlight("test")
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*(flight.ado("key", fn) for _ in range(5)))
+        self.assertEqual(results, ["result"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.tasks, {})
+
+
+class GalleryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("gallery", "gallery@example.com", "password-123")
+        now = timezone.now()
+        GeneratedImage.objects.bulk_create(
+            GeneratedImage(prompt=f"image {i}", file_name=f"image/upload/{i}.png", user=self.user if i % 2 else None)
+            for i in range(7)
+        )
+        # Two pairs share a timestamp, so pages must break ties by id
+        for i, image in enumerate(GeneratedImage.objects.order_by("id")):
+            GeneratedImage.objects.filter(id=image.id).update(created_at=now - timedelta(minutes=i // 2))
+
+    def expected(self, images):
+        return list(images.order_by("-created_at", "-id").values_list("id", flat=True))
+
+    def test_cursor_roundtrip(self):
+        created_at = timezone.now()
+        self.assertEqual(gallery.decode_cursor(gallery.encode_cursor(created_at, 42)), (created_at, 42))
+
+    def test_invalid_cursor(self):
+        for cursor in ("not-a-cursor", "%%%", gallery.encode_cursor(timezone.now(), 1)[:-3]):
+            with self.subTest(cursor), self.assertRaises(ValueError):
+                gallery.decode_cursor(cursor)
+        response = self.client.get("/api/gallery/", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_pages_cover_every_image_once_in_order(self):
+        seen, cursor = [], None
+        while True:
+            rows, cursor = gallery.gallery_page(cursor, limit=2)
+            seen += [row["id"] for row in rows]
+            if cursor is None:
+                break
+        self.assertEqual(seen, self.expected(GeneratedImage.objects.all()))
+        self.assertEqual(rows[-1]["image_url"], "image/upload/6.png")
+
+    def test_mine_lists_only_the_users_images(self):
+        response = self.client.get("/api/gallery/", {"mine": 1, "limit": 100}, **auth_header(self.user))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [row["id"] for row in response.json()["results"]],
+            self.expected(GeneratedImage.objects.filter(user=self.user)),
+        )
+        self.assertIsNone(response.json()["next_cursor"])
+        self.assertEqual(self.client.get("/api/gallery/", {"mine": 1}).status_code, 401)
+
+
+@override_settings(PROVIDER_RETRIES=2, PROVIDER_BACKOFF_BASE=0, PROVIDER_HEDGE=False,
+                   PROVIDER_BREAKER_FAILURES=3, PROVIDER_BREAKER_RESET=60)
+class ResilienceTests(TestCase):
+    def setUp(self):
+        resilience.policies.reset()
+        limiter.buckets.clear()
+
+    def chat(self, model):
+        return lambda timeout: model.generate_content("question", request_options={"timeout": timeout})
+
+    def test_transient_errors_are_retried(self):
+        errors = [FakeProviderError("503"), FakeProviderError("503")]
+
+        def fn(timeout):
+            if errors:
+                raise errors.pop()
+            return "answer"
+
+        self.assertEqual(resilience.call("test", fn), "answer")
+        self.assertEqual(errors, [])
+
+    def test_other_errors_are_not_retried(self):
+        calls = []
+
+        def fn(timeout):
+            calls.append(timeout)
+            raise ValueError("bad request")
+
+        with self.assertRaises(ValueError):
+            resilience.call("test", fn)
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(resilience.policies.get("test").breaker.is_open())
+
+    def test_breaker_opens_after_consecutive_failures(self):
+        model = FakeChatModel(0, 16, faults=Faults(failure_rate=1.0))
+        with self.assertRaises(FakeProviderError):
+            resilience.call("test", self.chat(model))
+        self.assertEqual(model.calls, 3)
+
+        with self.assertRaises(resilience.ProviderUnavailable) as raised:
+            resilience.call("test", self.chat(model))
+        self.assertEqual(model.calls, 3)
+        status_code, headers = resilience.error_status(raised.exception)
+        self.assertEqual(status_code, 503)
+        self.assertGreaterEqual(int(headers["Retry-After"]), 59)
+
+    @override_settings(PROVIDER_BREAKER_RESET=0)
+    def test_one_trial_call_closes_the_breaker(self):
+        breaker = resilience.policies.get("test").breaker
+        for _ in range(3):
+            breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertEqual(resilience.call("test", self.chat(FakeChatModel(0, 16))).text[:4], "Fake")
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    @override_settings(PROVIDER_BREAKER_RESET=0)
+    async def test_cancelled_trial_call_does_not_wedge_the_breaker(self):
+        breaker = resilience.policies.get("test").breaker
+        for _ in range(3):
+            breaker.record_failure()
+
+        trial = asyncio.ensure_future(resilience.acall("test", lambda timeout: asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        self.assertTrue(breaker.trial_running)
+        trial.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await trial
+
+        self.assertFalse(breaker.trial_running)
+        self.assertEqual(await resilience.acall("test", lambda timeout: asyncio.sleep(0, "ok")), "ok")
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    @override_settings(PROVIDER_TIMEOUT=0.05, PROVIDER_RETRIES=0)
+    def test_slow_provider_times_out(self):
+        with self.assertRaises(resilience.ProviderTimeout) as raised:
+            resilience.call("test", self.chat(FakeChatModel(0.2, 16)))
+        self.assertEqual(resilience.error_status(raised.exception), (504, {}))
+
+    def test_no_call_once_the_deadline_has_passed(self):
+        model = FakeChatModel(0, 16)
+        token = resilience.deadline.set(time.monotonic() - 1)
+        try:
+            with self.assertRaises(resilience.ProviderTimeout):
+                resilience.call("test", self.chat(model))
+        finally:
+            resilience.deadline.reset(token)
+        self.assertEqual(model.calls, 0)
+
+    async def test_async_calls_time_out(self):
+        with override_settings(PROVIDER_TIMEOUT=0.05, PROVIDER_RETRIES=0):
+            with self.assertRaises(resilience.ProviderTimeout):
+                await resilience.acall("test", lambda timeout: asyncio.sleep(1))
+
+    def open_tts_breaker(self):
+        breaker = resilience.policies.get("gtts").breaker
+        for _ in range(3):
+            breaker.record_failure()
+
+    def test_tts_view_maps_provider_errors(self):
+        self.open_tts_breaker()
+        with FakeProviders(latency=0):
+            response = self.client.post(
+                "/api/text-to-speech/", {"text": "Hello there.", "lang": "en"}, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+
+    async def test_async_tts_view_maps_provider_errors(self):
+        self.open_tts_breaker()
+        request = AsyncRequestFactory().post(
+            "/", json.dumps({"text": "Hello there.", "lang": "en"}), content_type="application/json"
+        )
+        with FakeProviders(latency=0):
+            response = await async_views.AsyncTextToSpeechView.as_view()(request)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+
+
+@override_settings(CHAT_MODELS=["pro", "lite"], CHAT_ROUTER_SHORT_CHARS=20, PROVIDER_RETRIES=0)
+class ChatRouterTests(TestCase):
+    def setUp(self):
+        resilience.policies.reset()
+        registry.reset()
+        self.router = ChatRouter()
+
+    def answer(self, model, timeout):
+        return model
+
+    def test_latency_is_kept_per_call_shape(self):
+        self.router.observe("pro", "short", 0.5)
+        self.router.observe("lite", "short", 0.2)
+        # Streamed opens are quick and long answers slow; neither may affect short requests
+        self.router.observe("pro", "short-stream", 0.01)
+        self.router.observe("lite", "long", 5.0)
+
+        self.assertEqual(self.router.candidates("hi", False)[0], ("lite", "fastest"))
+        self.assertEqual(self.router.candidates("hi", False, stream=True)[0], ("lite", "fastest"))
+        self.router.observe("lite", "short-stream", 0.05)
+        self.assertEqual(self.router.candidates("hi", False, stream=True)[0], ("pro", "fastest"))
+
+    def test_calls_record_latency_under_their_shape(self):
+        self.router.call("hi", False, self.answer)
+        self.router.call("hi", False, self.answer, stream=True)
+        self.router.call("a much longer question than that", False, self.answer)
+        self.assertEqual(set(self.router.get_stats("pro").latency), {"short", "short-stream", "long"})
+        self.assertIn('darkai_chat_model_latency_seconds{model="pro",shape="short-stream"}', registry.render())
+
+    def test_uncounted_calls_are_not_routes(self):
+        result, route = self.router.call("a summary prompt that is long", False, self.answer, count=False)
+        self.assertEqual((result, route.model, route.reason), ("pro", "pro", "long"))
+        self.assertEqual(registry.chat_routes, {})
+        self.assertEqual(self.router.get_stats("pro").latency, {})
+
+        self.router.call("hi", False, self.answer)
+        self.assertEqual(registry.chat_routes, {("pro", "fastest"): 1})
+
+    def test_falls_back_to_the_next_model(self):
+        def fn(model, timeout):
+            if model == "pro":
+                raise FakeProviderError("503")
+            return model
+
+        result, route = self.router.call("a long question to the best model", False, fn)
+        self.assertEqual((result, route.reason), ("lite", "fallback"))
+        self.assertGreater(self.router.get_stats("pro").error_rate, 0)
+
+
+class StreamingMetricsTests(TestCase):
+    """Stages timed while a streaming body is sent belong to the request, not to "background"."""
+
+    def setUp(self):
+        registry.reset()
+
+    def recorded(self):
+        return {key for key in registry.stages if key[1] == "render"}
+
+    def test_sync_streaming_body(self):
+        def body():
+            for i in range(3):
+                with stage("render"):
+                    yield f"{i}\n"
+
+        response = metrics_middleware(lambda request: StreamingHttpResponse(body()))(RequestFactory().get("/"))
+        self.assertEqual(b"".join(response.streaming_content), b"0\n1\n2\n")
+        self.assertEqual(self.recorded(), {("unmatched", "render")})
+        self.assertEqual(registry.stages[("unmatched", "render")].count, 3)
+
+    async def test_async_streaming_body(self):
+        async def body():
+            for i in range(3):
+                with stage("render"):
+                    await asyncio.sleep(0)
+                yield f"{i}\n"
+
+        async def view(request):
+            return StreamingHttpResponse(body())
+
+        response = await metrics_middleware(view)(AsyncRequestFactory().get("/"))
+        self.assertEqual(b"".join([chunk async for chunk in response.streaming_content]), b"0\n1\n2\n")
+        self.assertEqual(self.recorded(), {("unmatched", "render")})
+
+
+@override_settings(CHAT_CONTEXT_CACHE=False)
+class ProviderManagerTests(TestCase):
+    """The real manager, with only the SDK constructors mocked."""
+
+    def setUp(self):
+        self.manager = ProviderManager()
+        for target in ("google.generativeai.configure", "google.generativeai.GenerativeModel", "google.genai.Client"):
+            patcher = mock.patch(target)
+            setattr(self, target.rsplit(".", 1)[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def run_in_thread(self, fn):
+        """``fn()`` in another thread; fails instead of hanging if it deadlocks."""
+        results = []
+        thread = threading.Thread(target=lambda: results.append(fn()), daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "deadlocked")
+        return results[0]
+
+    def test_first_chat_model_and_genai_client_build_without_deadlock(self):
+        model = self.run_in_thread(lambda: self.manager.get_chat_model("gemini-2.5-flash", "chat"))
+        self.assertIs(model, self.GenerativeModel.return_value)
+        self.assertFalse(self.manager.lock.locked())
+        self.assertIs(self.run_in_thread(self.manager.get_genai_client), self.Client.return_value)
+        self.configure.assert_called_once()
+
+    def test_chat_models_are_built_once_per_name_and_mode(self):
+        chat = self.manager.get_chat_model("gemini-2.5-flash", "chat")
+        self.assertIs(self.manager.get_chat_model("gemini-2.5-flash", "chat"), chat)
+        self.manager.get_chat_model("gemini-2.5-flash", "code")
+        self.manager.get_chat_model("gemini-2.5-flash-lite", "chat")
+        self.assertEqual(self.GenerativeModel.call_count, 3)
+        self.configure.assert_called_once()
+
+    def test_concurrent_first_use_builds_one_model(self):
+        def build(*args, **kwargs):
+            time.sleep(0.05)  # widen the race
+            return mock.Mock()
+
+        self.GenerativeModel.side_effect = build
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            models = list(pool.map(lambda _: self.manager.get_chat_model("gemini-2.5-flash", "chat"), range(4)))
+        self.assertEqual(self.GenerativeModel.call_count, 1)
+        self.assertTrue(all(model is models[0] for model in models))
+
+    def test_reset_drops_the_clients(self):
+        client = self.manager.get_genai_client()
+        self.assertIs(self.manager.get_genai_client(), client)
+        self.manager.get_chat_model("gemini-2.5-flash", "chat")
+
+        self.manager.reset()  # what the child runs after a fork
+        self.manager.get_genai_client()
+        self.manager.get_chat_model("gemini-2.5-flash", "chat")
+        self.assertEqual(self.Client.call_count, 2)
+        self.assertEqual(self.GenerativeModel.call_count, 2)
+        self.assertEqual(self.configure.call_count, 2)
+
+    @override_settings(PROVIDER_POOL_SIZE=7)
+    def test_cloudinary_is_configured_once_with_a_sized_upload_pool(self):
+        import cloudinary.uploader
+
+        with mock.patch("cloudinary.config") as cloudinary_config, \
+                mock.patch("cloudinary.utils.get_http_connector") as connector, \
+                mock.patch.object(cloudinary.uploader, "_http"):
+            self.manager.configure_cloudinary()
+            self.manager.configure_cloudinary()
+            self.assertIs(cloudinary.uploader._http, connector.return_value)
+        self.assertEqual(cloudinary_config.call_count, 2)  # configuring, then reading it back
+        connector.assert_called_once()
+        self.assertEqual(connector.call_args.args[1]["maxsize"], 7)
+
+
+@override_settings(CHAT_CONTEXT_CACHE=False)
+class SystemInstructionTests(TestCase):
+    def setUp(self):
+        limiter.buckets.clear()
+        chat_cache.backend.clear()
+        resilience.policies.reset()
+        patcher = mock.patch("google.generativeai.configure")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("google.generativeai.GenerativeModel", side_effect=self.build_model)
+        self.GenerativeModel = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(providers, "providers", ProviderManager())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sent = []  # (system instruction, content) of every request
+
+    def build_model(self, name, system_instruction=None):
+        model = mock.Mock()
+        model.generate_content.side_effect = lambda content, **kwargs: (
+            self.sent.append((system_instruction, content)) or SimpleNamespace(text="Answer"))
+        return model
+
+    def post(self, body):
+        request = RequestFactory().post("/", json.dumps(body), content_type="application/json")
+        return views.ChatAPIView.as_view()(request)
+
+    def test_instructions_are_set_once_and_only_the_message_is_sent(self):
+        for body in ({"message": "First question"}, {"message": "Second question"},
+                     {"message": "Write a sort", "code_mode": True}):
+            self.assertEqual(self.post(body).status_code, 200)
+
+        self.assertEqual(self.sent, [
+            (CHAT_INSTRUCTION, "First question"),
+            (CHAT_INSTRUCTION, "Second question"),
+            (CODE_INSTRUCTION, "Write a sort"),
+        ])
+        # Built once per (routed model, mode), never with the instruction in the content
+        built = [(call.args[0], call.kwargs["system_instruction"]) for call in self.GenerativeModel.call_args_list]
+        self.assertEqual(len(built), len(set(built)))
+        self.assertEqual({instruction for _, instruction in built}, {CHAT_INSTRUCTION, CODE_INSTRUCTION})
@@ -0,0 +1,180 @@
+# tts.py
+#
+# Text-to-speech with a content-addressed cache: the audio for a given
+# (language, normalized text) pair is synthesized and uploaded once, under a
+# Cloudinary public_id derived from its hash, and every repeat is answered
+# from an in-process LRU backed by the TTSAudio table.
+#
+# Long texts are split at sentence boundaries and the segments synthesized
+# concurrently on a bounded pool; MP3 frames concatenate cleanly, so the
+# segments are joined in memory (or streamed in order as they finish).
+
+import functools
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.db import IntegrityError, connection
+
+from . import providers, resilience
+from .metrics import submit
+from .models import TTSAudio
+
+logger = logging.getLogger(__name__)
+
+TTS_FOLDER = "darkai/tts"
+
+SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+")
+
+synth_pool = ThreadPoolExecutor(
+    max_workers=getattr(settings, "TTS_SYNTH_THREADS", 8),
+    thread_name_prefix="tts-synth",
+)
+
+
+@functools.lru_cache(maxsize=1)
+def supported_langs():
+    from gtts.lang import tts_langs
+
+    return tts_langs()
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+def audio_key(text, lang):
+    return hashlib.sha256(f"{lang}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class RecentAudio:
+    """Small in-process LRU of hash -> URL in front of the database index."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            url = self.entries.get(key)
+            if url is not None:
+                self.entries.move_to_end(key)
+            return url
+
+    def set(self, key, url):
+        with self.lock:
+            self.entries[key] = url
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+recent_audio = RecentAudio(getattr(settings, "TTS_CACHE_MEMORY_ENTRIES", 2048))
+
+
+def lookup_audio(key):
+    url = recent_audio.get(key)
+    if url is None:
+        url = TTSAudio.objects.filter(text_hash=key).values_list("audio_url", flat=True).first()
+        if url is not None:
+            recent_audio.set(key, url)
+    return url
+
+
+def split_segments(text, max_chars=None):
+    """Pack whole sentences into segments of at most ``max_chars`` (a longer sentence stays whole)."""
+    max_chars = max_chars or getattr(settings, "TTS_SEGMENT_CHARS", 300)
+    segments = []
+    current = ""
+    for sentence in SENTENCE_END.split(text):
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            segments.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        segments.append(current)
+    return segments
+
+
+def synthesize_segment(text, lang):
+    from gtts import gTTS
+
+    def attempt(timeout):
+        buffer = BytesIO()
+        gTTS(text=text, lang=lang, timeout=timeout).write_to_fp(buffer)
+        return buffer.getvalue()
+
+    return resilience.call("gtts", attempt)
+
+
+def submit_segments(text, lang):
+    """Start synthesizing every segment; the futures are in text order."""
+    return [submit(synth_pool, synthesize_segment, segment, lang) for segment in split_segments(text)]
+
+
+def synthesize_mp3(text, lang):
+    segments = split_segments(text)
+    if len(segments) == 1:
+        return BytesIO(synthesize_segment(segments[0], lang))
+    futures = [submit(synth_pool, synthesize_segment, segment, lang) for segment in segments]
+    return BytesIO(b"".join(future.result() for future in futures))
+
+
+def upload_audio(audio, key):
+    response = providers.upload(
+        audio,
+        resource_type="video",
+        public_id=f"{TTS_FOLDER}/{key}",
+        format="mp3",
+        overwrite=True
+    )
+    return response["secure_url"]
+
+
+def record_audio(key, lang, url):
+    try:
+        TTSAudio.objects.get_or_create(text_hash=key, defaults={"lang": lang, "audio_url": url})
+    except IntegrityError:
+        pass  # another worker recorded the same audio first
+    recent_audio.set(key, url)
+
+
+def store_audio_in_background(audio, key, lang):
+    try:
+        record_audio(key, lang, upload_audio(BytesIO(audio), key))
+    except Exception:
+        logger.exception("Background upload of TTS audio %s failed", key)
+    finally:
+        connection.close()
+
+
+def stream_audio(text, lang, key):
+    """
+    Yield the mp3 segment by segment as soon as each one (in order) is ready,
+    then upload the joined audio in the background so repeats hit the cache.
+    """
+    parts = []
+    for future in submit_segments(normalize_text(text), lang):
+        part = future.result()
+        parts.append(part)
+        yield part
+    submit(synth_pool, store_audio_in_background, b"".join(parts), key, lang)
+
+
+def get_audio_url(text, lang):
+    """Return ``(audio_url, cached)`` for the text, synthesizing it only once."""
+    key = audio_key(text, lang)
+    url = lookup_audio(key)
+    if url is not None:
+        return url, True
+
+    url = upload_audio(synthesize_mp3(normalize_text(text), lang), key)
+    record_audio(key, lang, url)
+    return url, False
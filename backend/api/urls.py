@@ -1,13 +1,37 @@
 from django.urls import path
-from api import views
+from api import metrics, views
 from django.conf.urls.static import static
 from django.conf import settings
 
+if settings.ASYNC_VIEWS:
+    # ASGI: native async views, provider calls don't hold a worker thread
+    from api import async_views
+    chat_view = async_views.AsyncChatView.as_view()
+    chat_stream_view = async_views.AsyncChatStreamView.as_view()
+    generate_image_view = async_views.AsyncGenerateImageView.as_view()
+    generate_image_batch_view = async_views.AsyncGenerateImageBatchView.as_view()
+    text_to_speech_view = async_views.AsyncTextToSpeechView.as_view()
+    image_job_view = async_views.async_image_job_view
+else:
+    chat_view = views.ChatAPIView.as_view()
+    chat_stream_view = views.ChatStreamAPIView.as_view()
+    generate_image_view = views.GenerateImageAPIView.as_view()
+    generate_image_batch_view = views.GenerateImageBatchAPIView.as_view()
+    text_to_speech_view = views.TextToSpeechView.as_view()
+    image_job_view = views.image_job_view
+
 urlpatterns = [
-    path('chat/', views.ChatAPIView.as_view(), name='chat-api'),
-    path('generate-image/', views.GenerateImageAPIView.as_view(), name='generate-image'),
-    path("text-to-speech/", views.TextToSpeechView.as_view(), name="text-to-speech"),
-    path("auth/", views.auth_view, name="auth"),   # signup, verify, signin in one
+    path('chat/', chat_view, name='chat-api'),
+    path('chat/stream/', chat_stream_view, name='chat-stream'),
+    path('generate-image/', generate_image_view, name='generate-image'),
+    path('generate-image/batch/', generate_image_batch_view, name='generate-image-batch'),
+    path('generate-image/jobs/<uuid:job_id>/', image_job_view, name='image-job'),
+    path("text-to-speech/", text_to_speech_view, name="text-to-speech"),
+    path("auth/", views.auth_view, name="auth"),   # signup, resend, verify, signin in one
     path("logout/", views.logout_view, name="logout"),
+    path("chat/cache-stats/", views.chat_cache_stats_view, name="chat-cache-stats"),
+    path("coalescing-stats/", views.coalescing_stats_view, name="coalescing-stats"),
+    path("gallery/", views.gallery_view, name="gallery"),
+    path("metrics/", metrics.metrics_view, name="metrics"),
     
 ]  
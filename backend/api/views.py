@@ -1,99 +1,43 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-import google.generativeai as genai
-import re
+from django.conf import settings
 import logging
 logger = logging.getLogger(__name__)
 
-# Configure Gemini API
-from decouple import config
-genai.configure(api_key=config("GOOGLE_API_KEY"))
-
-# Load the model
-model = genai.GenerativeModel('gemini-2.5-flash')
-
-custom_responses = {
-    "creator": {
-        "keywords": [
-            "who made you", "who create you", "who created you", "who develop you", "who developed you",
-            "who build you", "who built you", "who generated you", "who generate you",
-            "who genrated you", "who genrate you", "who genarated you", "who genarate you",
-            "who creater you", "who creted you", "who desined you", "who desinged you",
-            "who programmed you", "who program you", "who founded you", "who founder you",
-            "who is your creator", "who is your ceo", "who is your founder", "who is your owner",
-            "who is your boss", "who is your developer"
-        ],
-        "response": "I was created by Bhavya, the visionary CEO of Dark AI. I'm here to assist you with whatever you need!"
-    },
-    "identity": {
-        "keywords": [
-            "what's your name", "what is your name", "who are you", "what can i call you",
-            "what is your identity", "what is your chatbot name", "do you have a name",
-            "whats your name", "whats ur name", "what's ur name", "tell me your name",
-            "your name please", "name please", "ur name"
-        ],
-        "response": "I am Dark AI, your personal AI assistant created by Bhavya. Feel free to call me Dark AI!"
-    },
-    "model": {
-        "keywords": [
-            "what's your model", "what is your model", "which ai model are you", "what version are you",
-            "tell me your version", "are you gpt", "are you gemini", "which model you are",
-            "what is your ai model", "what type of ai you are", "what model ai you are"
-        ],
-        "response": "I am a unique AI model known as Dark AI, custom-built by Bhavya. I’m not GPT or Gemini — I’m something special!"
-    },
-    "training": {
-        "keywords": [
-            "who trained you", "what trained you", "where does your knowledge come from",
-            "what data were you trained on", "who taught you", "how do you know things",
-            "who learn you", "who teached you", "who gives you knowledge", "how you learn"
-        ],
-        "response": "I was trained with carefully selected knowledge and data, curated by Bhavya. My responses are designed to serve you better every day."
-    },
-    "purpose": {
-        "keywords": [
-            "why were you made", "what is your purpose", "what can you do", "why do you exist",
-            "what's your job", "what are you capable of", "what you can do", "what you are made for",
-            "what is your work", "what you are used for"
-        ],
-        "response": "I was created by Bhavya to assist, inform, and engage you. My purpose is to make your experience smoother and smarter!"
-    },
-    "owner": {
-        "keywords": [
-            "who owns you", "who is your boss", "who controls you", "who is your company",
-            "who is your owner", "who have you", "who is your handler", "who is your parent company",
-            "who manage you", "who is the owner of dark ai"
-        ],
-        "response": "I am fully owned and managed by Bhavya, the CEO of Dark AI. There’s no big tech company behind me — just Bhavya’s brilliant vision."
-    }
-}
-
-def detect_custom_response(user_message):
-    user_message_lower = user_message.lower()
-
-    for category, data in custom_responses.items():
-        for keyword in data['keywords']:
-            if re.search(rf'\b{re.escape(keyword)}\b', user_message_lower):
-                return data['response']
-    return None
-
-def clean_gemini_response(text):
-    if not isinstance(text, str):
-        return text
-
-    # Remove bold markdown: **text**
-    cleaned = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-
-    # Remove italic markdown: *text*
-    cleaned = re.sub(r'\*(.*?)\*', r'\1', cleaned)
-
-    # Optional: Remove extra spaces at the beginning of lines
-    cleaned = re.sub(r'^\s+', '', cleaned, flags=re.MULTILINE)
-
-    return cleaned.strip()
+# Gemini and Cloudinary clients are shared process-wide (api/providers.py)
+from . import conversations, providers, resilience
+
+# Identity/creator questions are answered from api/data/custom_responses.json
+from .custom_responses import detect_custom_response
+from .chat_cache import cache_key, chat_cache
+from .markdown import clean_gemini_response, clean_gemini_stream
+from .prompts import chat_mode
+from .quotas import enforce_quota, quota_cost, refund_quota
+from .routing import router
+from .singleflight import chat_flight, image_flight
+
+
+def chat_model(is_code_mode, name=providers.CHAT_MODEL):
+    # The mode's instructions live in the model's system instruction (api/prompts.py),
+    # so only the user's message is sent with each request
+    return providers.get_chat_model(name, mode=chat_mode(is_code_mode))
+
+
+def generate_chat_reply(user_message, is_code_mode):
+    """Returns ``(reply, route)``; the model is picked by api/routing.py."""
+    response, route = router.call(user_message, is_code_mode, lambda name, timeout: chat_model(
+        is_code_mode, name).generate_content(user_message, request_options={"timeout": timeout}))
+    ai_response = response.text if hasattr(response, 'text') else "I couldn't generate a response."
+
+    if not is_code_mode:
+        ai_response = clean_gemini_response(ai_response)
+    chat_cache.set(user_message, is_code_mode, ai_response)
+    return ai_response, route
+
 
 class ChatAPIView(APIView):
+    @enforce_quota("chat")
     def post(self, request):
         user_message = request.data.get('message')
         is_code_mode = request.data.get('code_mode', False)  # ✅ NEW FIELD FROM FRONTEND
@@ -101,138 +45,338 @@ class ChatAPIView(APIView):
         if not user_message:
             return Response({"error": "Message is required."}, status=status.HTTP_400_BAD_REQUEST)
 
+        conversation_id = request.data.get('conversation_id')
+        if conversation_id or request.data.get('conversation'):
+            return self.post_in_conversation(request, user_message, is_code_mode, conversation_id)
+
         try:
             # Check for custom responses first
             custom_reply = detect_custom_response(user_message)
             if custom_reply:
                 return Response({"bot_response": custom_reply}, status=status.HTTP_200_OK)
 
-            if is_code_mode:  # ✅ Force code mode
-                prompt = f"""
-                You are a coding assistant.
+            cached = chat_cache.get(user_message, is_code_mode)
+            if cached is not None:
+                return Response({"bot_response": cached}, status=status.HTTP_200_OK, headers={"X-Cache": "HIT"})
 
-                Please generate a COMPLETE code solution for the following request:
+            if settings.COALESCE_CHAT:
+                # Identical in-flight messages share one Gemini call
+                ai_response, route = chat_flight.do(
+                    cache_key(user_message, is_code_mode),
+                    lambda: generate_chat_reply(user_message, is_code_mode),
+                )
+            else:
+                ai_response, route = generate_chat_reply(user_message, is_code_mode)
 
-                Request: {user_message}
+            return Response({"bot_response": ai_response}, status=status.HTTP_200_OK,
+                            headers={"X-Cache": "MISS", **route.headers()})
 
-                🚨 STRICT Instructions:
-                ✅ Return the entire code in ONE markdown block like ```python ... ```
-                ✅ Proper indentation is MANDATORY.
-                ✅ NO emojis, NO step-by-step lists, NO headings, NO explanations.
-                ✅ ONLY include code, no text outside the code block.
-                Also an additional instruction:
-                If anybody asks about your creator, origin or anything related to your identity, just say:
-                "I was created by Bhavya, the CEO of Dark AI. I'm here to assist you with whatever you need!"
-                """
+        except resilience.ProviderError as e:
+            status_code, headers = resilience.error_status(e)
+            return Response({"error": str(e)}, status=status_code, headers=headers)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def post_in_conversation(self, request, user_message, is_code_mode, conversation_id):
+        # Follow-ups depend on earlier turns, so no response cache or coalescing here
+        user = request.user if request.user.is_authenticated else None
+        if conversation_id:
+            conversation = conversations.get_conversation(conversation_id, user)
+            if conversation is None:
+                return Response({"error": "Conversation not found."}, status=status.HTTP_404_NOT_FOUND)
+        else:
+            conversation = conversations.start_conversation(user)
+
+        try:
+            input_tokens = None
+            headers = {}
+            ai_response = detect_custom_response(user_message)
+            if ai_response:
+                conversations.record_exchange(conversation, user_message, ai_response)
             else:
-                prompt = f"""
-                You are Dark AI, an advanced assistant.
-                ⚡ Always respond in GitHub-flavored Markdown (GFM).
+                ai_response, input_tokens, route = conversations.reply(conversation, user_message, is_code_mode)
+                headers = route.headers()
+
+            return Response({
+                "bot_response": ai_response,
+                "conversation_id": str(conversation.id),
+                "input_tokens": input_tokens,
+            }, status=status.HTTP_200_OK, headers=headers)
+
+        except resilience.ProviderError as e:
+            status_code, headers = resilience.error_status(e)
+            return Response({"error": str(e)}, status=status_code, headers=headers)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-                Formatting rules:
-                - Use #, ##, ### for headings
-                - Use **bold** for emphasis
-                - Use - or 1. for lists
-                - Use > for blockquotes
-                - Use fenced code blocks ``` for code
-                - Add line breaks between sections
-                - Keep responses elegant, structured, and easy to scan
 
-                User Query:
-                {user_message}
-                """
+# --- STREAMING CHAT VIEW (SSE) ---
+import json
+import time
+from django.http import StreamingHttpResponse
 
 
-            response = model.generate_content(prompt)
-            ai_response = response.text if hasattr(response, 'text') else "I couldn't generate a response."
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-            if not is_code_mode:
-                ai_response = clean_gemini_response(ai_response)
 
-            return Response({"bot_response": ai_response}, status=status.HTTP_200_OK)
+def iter_gemini_text(response):
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. safety metadata) have no .text
+            continue
+        if text:
+            yield text
+
+
+class ChatStreamAPIView(APIView):
+    """
+    Same contract as ChatAPIView, but the answer is streamed as Server-Sent
+    Events: one ``chunk`` event per piece of text, then a ``done`` event with
+    the full response and timings (or an ``error`` event).
+    """
+
+    @enforce_quota("chat")
+    def post(self, request):
+        user_message = request.data.get('message')
+        is_code_mode = request.data.get('code_mode', False)
+
+        if not user_message:
+            return Response({"error": "Message is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(
+            self.stream(user_message, is_code_mode),
+            content_type="text/event-stream",
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"  # don't let proxies buffer the stream
+        return response
+
+    def stream(self, user_message, is_code_mode):
+        started = time.monotonic()
+        first_chunk_ms = None
+        parts = []
+        cacheable = False
+        route = None
+
+        try:
+            custom_reply = detect_custom_response(user_message)
+            cached = None if custom_reply else chat_cache.get(user_message, is_code_mode)
+            if custom_reply or cached is not None:
+                chunks = iter([custom_reply or cached])
+            else:
+                cacheable = True
+                # Retries and fallback cover opening the stream; a hedge would leave one stream unread
+                response, route = router.call(user_message, is_code_mode, lambda name, timeout: chat_model(
+                    is_code_mode, name).generate_content(user_message, stream=True,
+                                                         request_options={"timeout": timeout}),
+                    stream=True, hedge=False)
+                chunks = iter_gemini_text(response)
+                if not is_code_mode:
+                    chunks = clean_gemini_stream(chunks)
+
+            for text in chunks:
+                if first_chunk_ms is None:
+                    first_chunk_ms = round((time.monotonic() - started) * 1000)
+                parts.append(text)
+                yield sse_event("chunk", {"text": text})
 
         except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            logger.exception("Streaming chat failed")
+            yield sse_event("error", {"error": str(e)})
+            return
+
+        bot_response = "".join(parts) or "I couldn't generate a response."
+        if cacheable and parts:
+            chat_cache.set(user_message, is_code_mode, bot_response)
+        yield sse_event("done", {
+            "bot_response": bot_response,
+            "chunks": len(parts),
+            "first_chunk_ms": first_chunk_ms,
+            "elapsed_ms": round((time.monotonic() - started) * 1000),
+            "model": route.model if route else None,
+            "route": route.reason if route else None,
+        })
 
 
 # --- IMAGE GENERATION VIEW ---
-import os
-import mimetypes
-from google import genai
-from google.genai import types
-import cloudinary
-import cloudinary.uploader
-
-# Cloudinary configuration
-cloudinary.config(
-    cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
-    api_key=os.getenv("CLOUDINARY_API_KEY"),
-    api_secret=os.getenv("CLOUDINARY_API_SECRET"),
-    secure=True
-)
+from django.http import Http404, JsonResponse
+from django.urls import reverse
+from . import images
+from .jobs import QueueFull, image_jobs, job_payload
+from .models import ImageJob
+
+
+def queue_image_job(request, prompt, user_id=None):
+    job = image_jobs.enqueue(prompt, user_id)
+    payload = job_payload(job)
+    payload["status_url"] = request.build_absolute_uri(reverse("image-job", args=[job.id]))
+    return payload
+
 
 class GenerateImageAPIView(APIView):
+    @enforce_quota("image")
     def post(self, request):
         prompt = request.data.get("prompt")
         print(f"Received prompt: {prompt}")
         if not prompt:
             return Response({"error": "Prompt is required."}, status=status.HTTP_400_BAD_REQUEST)
 
+        # "fresh": true skips reuse of a recent image for the same prompt
+        if not request.data.get("fresh"):
+            reused = images.find_reusable_image(prompt)
+            if reused:
+                return Response({"file_name": reused, "reused": True}, status=200)
+
+        user_id = request.user.pk if request.user.is_authenticated else None
+        if request.data.get("async"):
+            # Queue it and let the client poll (or subscribe to) the job status
+            try:
+                return Response(queue_image_job(request, prompt, user_id), status=status.HTTP_202_ACCEPTED)
+            except QueueFull as e:
+                return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
         try:
-            client = genai.Client(api_key=os.environ.get("GOOGLE_API_KEY"))
-            model = "gemini-2.0-flash-preview-image-generation"
-
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[types.Part.from_text(text=prompt)],
-                ),
-            ]
-
-            config = types.GenerateContentConfig(
-                temperature=1,
-                response_modalities=["IMAGE", "TEXT"],
-            )
-
-            file_index = 0
-            for chunk in client.models.generate_content_stream(
-                model=model,
-                contents=contents,
-                config=config,
-            ):
-                candidate = chunk.candidates[0]
-                if not candidate or not candidate.content or not candidate.content.parts:
-                    continue
-
-                parts = candidate.content.parts
-                inline_data = parts[0].inline_data if parts[0] else None
-
-                if inline_data and inline_data.data:
-                    file_extension = mimetypes.guess_extension(inline_data.mime_type)
-                    file_name = f"generated_image_{file_index}{file_extension}"
-                    file_index += 1
-
-                    with open(file_name, "wb") as f:
-                        f.write(inline_data.data)
-
-                    response = cloudinary.uploader.upload(file_name, folder="darkai/generated/")
-                    os.remove(file_name)
-
-                    return Response({"file_name": response["secure_url"]}, status=200)
+            if settings.COALESCE_IMAGES:
+                file_name = image_flight.do(images.prompt_key(prompt), lambda: images.create_image(prompt, user_id))
+            else:
+                file_name = images.create_image(prompt, user_id)
+            if not file_name:
+                return Response({"error": "Image generation failed."}, status=status.HTTP_400_BAD_REQUEST)
+
+            return Response({"file_name": file_name}, status=200)
 
+        except resilience.ProviderError as e:
+            status_code, headers = resilience.error_status(e)
+            return Response({"error": str(e)}, status=status_code, headers=headers)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def batch_prompts(data):
+    """The prompts of a batch request (a list, or one prompt and a count); raises ValueError."""
+    prompts = data.get("prompts")
+    if prompts is None:
+        if not data.get("prompt"):
+            raise ValueError("Send a list of 'prompts', or a 'prompt' and a 'count'.")
+        try:
+            prompts = [data["prompt"]] * int(data.get("count", 1))
+        except (TypeError, ValueError):
+            raise ValueError("count must be a number.")
+
+    if not isinstance(prompts, list) or not all(isinstance(p, str) and p.strip() for p in prompts):
+        raise ValueError("prompts must be a list of non-empty strings.")
+    max_items = getattr(settings, "IMAGE_BATCH_MAX", 8)
+    if not 1 <= len(prompts) <= max_items:
+        raise ValueError(f"A batch takes 1 to {max_items} prompts.")
+    return prompts
+
+
+def batch_size(request):
+    try:
+        return len(batch_prompts(request.data))
+    except ValueError:
+        return 1
+
+
+class GenerateImageBatchAPIView(APIView):
+    """
+    Several images in one request, generated concurrently (at most
+    IMAGE_BATCH_CONCURRENCY at a time) and streamed as Server-Sent Events:
+    one ``result`` event per item as it finishes, with its ``file_name`` or
+    its ``error``, then a ``done`` event with the totals. The daily quota is
+    charged per image (failed items are refunded), the rate limit once per
+    request.
+    """
+
+    @enforce_quota("image", units=batch_size)
+    def post(self, request):
+        try:
+            prompts = batch_prompts(request.data)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        user = request.user if request.user.is_authenticated else None
+        response = StreamingHttpResponse(self.stream(prompts, user), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    def stream(self, prompts, user):
+        started = time.monotonic()
+        failed = 0
+        for index, url, error in images.generate_batch(prompts, user.pk if user else None):
+            failed += error is not None
+            yield sse_event("result", {"index": index, "prompt": prompts[index], "file_name": url, "error": error})
+
+        if failed and user is not None:
+            refund_quota(user, quota_cost("image") * failed)
+        yield sse_event("done", {
+            "total": len(prompts),
+            "succeeded": len(prompts) - failed,
+            "failed": failed,
+            "elapsed_ms": round((time.monotonic() - started) * 1000),
+        })
+
+
+def job_finished(job, deadline):
+    return job.status in (ImageJob.DONE, ImageJob.FAILED) or time.monotonic() > deadline
+
+
+def image_job_events(job_id):
+    # Sync for WSGI, which sends each event as it is yielded; the ASGI view
+    # uses async_views.aimage_job_events instead
+    last = None
+    deadline = time.monotonic() + getattr(settings, "IMAGE_JOB_SSE_TIMEOUT", 120)
+    while True:
+        job = ImageJob.objects.filter(id=job_id).first()
+        if job is None:
+            return
+        payload = job_payload(job)
+        if payload != last:
+            yield sse_event("status", payload)
+            last = payload
+        if job_finished(job, deadline):
+            return
+        time.sleep(1)
+
+
+def wants_job_stream(request):
+    return bool(request.GET.get("stream")) or "text/event-stream" in request.headers.get("Accept", "")
+
+
+def image_job_view(request, job_id):
+    """
+    Status of a queued image job. Plain JSON for polling; with ?stream=1 (or
+    an EventSource's Accept header) status changes are pushed as SSE until
+    the job is done or failed. Under WSGI an open stream occupies a worker
+    thread; the ASGI version is async_views.async_image_job_view.
+    """
+    job = ImageJob.objects.filter(id=job_id).first()
+    if job is None:
+        raise Http404("Job not found")
+    image_jobs.start()
+
+    if wants_job_stream(request):
+        response = StreamingHttpResponse(image_job_events(job_id), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    return JsonResponse(job_payload(job))
+
+
 # --- TEXT TO SPEECH VIEW ---
-from gtts import gTTS
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-import uuid
-from gtts.lang import tts_langs
+from django.http import HttpResponseRedirect
+from . import tts
 
 @method_decorator(csrf_exempt, name='dispatch')
 class TextToSpeechView(APIView):
+    @enforce_quota("tts")
     def post(self, request):
         text = request.data.get("text")
         lang = request.data.get("lang", "en")
@@ -240,33 +384,27 @@ class TextToSpeechView(APIView):
         if not text:
             return Response({"error": "No text provided"}, status=400)
 
-        supported_langs = tts_langs()
+        supported_langs = tts.supported_langs()
         if lang not in supported_langs:
             return Response({"error": f"Language '{lang}' not supported."}, status=400)
 
-        filename = f"{uuid.uuid4()}.mp3"
-        filepath = os.path.join("temp", filename)
-        os.makedirs("temp", exist_ok=True)
-
-        tts = gTTS(text=text, lang=lang)
-        tts.save(filepath)
+        if request.data.get("stream"):
+            # Stream the mp3 while later segments are still being synthesized
+            key = tts.audio_key(text, lang)
+            cached_url = tts.lookup_audio(key)
+            if cached_url:
+                return HttpResponseRedirect(cached_url)
+            return StreamingHttpResponse(tts.stream_audio(text, lang, key), content_type="audio/mpeg")
 
         try:
-            response = cloudinary.uploader.upload(
-                filepath,
-                resource_type="video",
-                folder="darkai/tts/",
-                public_id=filename.split(".")[0],
-                format="mp3",
-                overwrite=True
-            )
-            cloud_url = response["secure_url"]
+            cloud_url, cached = tts.get_audio_url(text, lang)
+        except resilience.ProviderError as e:
+            status_code, headers = resilience.error_status(e)
+            return Response({"error": str(e)}, status=status_code, headers=headers)
         except Exception as e:
-            return Response({"error": f"Cloudinary upload failed: {str(e)}"}, status=500)
-        finally:
-            os.remove(filepath)
+            return Response({"error": f"Text-to-speech failed: {str(e)}"}, status=500)
 
-        return Response({"audio_url": cloud_url})
+        return Response({"audio_url": cloud_url, "cached": cached})
 
 
 # --- AUTH VIEWS (SIGNUP/LOGIN/LOGOUT) ---
@@ -274,15 +412,37 @@ from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login, logout
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
-from django.core.mail import send_mail
 from rest_framework_simplejwt.tokens import RefreshToken
 import random
-
-otp_storage = {}
+from .otp import OTP_LOCKED, OTP_OK, otp_store
+from .outbox import email_outbox
 
 def generate_otp():
     return str(random.randint(100000, 999999))
 
+
+def send_signup_otp(email):
+    """Issue and mail a new OTP; False if the previous one was sent too recently."""
+    otp = generate_otp()
+    if not otp_store.issue(email, otp):
+        return False
+    # Queued; the outbox sender delivers it in the background
+    email_outbox.enqueue(
+        "Dark AI - Email Verification",
+        f"Your OTP is {otp}",
+        "noreply@darkai.com",
+        [email],
+    )
+    return True
+
+
+def otp_too_soon():
+    return Response(
+        {"error": "An OTP was sent recently. Please wait a minute before requesting another."},
+        status=429,
+        headers={"Retry-After": str(getattr(settings, "OTP_RESEND_INTERVAL", 60))},
+    )
+
 @api_view(["POST"])
 @permission_classes([AllowAny])
 def auth_view(request):
@@ -297,33 +457,38 @@ def auth_view(request):
             return Response({"error": "All fields are required"}, status=400)
 
         if User.objects.filter(email=email).exists():
+            # Also for accounts still awaiting verification: a new OTP comes from "resend"
             return Response({"error": "Email already registered"}, status=400)
 
-        user = User.objects.create_user(username=username, email=email, password=password, is_active=False)
-        otp = generate_otp()
-        otp_storage[email] = otp
-
-        send_mail(
-            "Dark AI - Email Verification",
-            f"Your OTP is {otp}",
-            "noreply@darkai.com",
-            [email],
-            fail_silently=False,
-        )
+        User.objects.create_user(username=username, email=email, password=password, is_active=False)
+        if not send_signup_otp(email):
+            return otp_too_soon()
         return Response({"message": "Signup successful. Verify with OTP."}, status=201)
 
+    elif action == "resend":
+        email = request.data.get("email")
+        if not email:
+            return Response({"error": "Email is required"}, status=400)
+
+        # Same answer whether or not the email is awaiting verification
+        if User.objects.filter(email=email, is_active=False).exists() and not send_signup_otp(email):
+            return otp_too_soon()
+        return Response({"message": "If this email is awaiting verification, a new OTP has been sent."}, status=200)
+
     elif action == "verify":
         email = request.data.get("email")
         otp = request.data.get("otp")
 
-        if otp_storage.get(email) != otp:
-            return Response({"error": "Invalid OTP"}, status=400)
+        result = otp_store.verify(email, otp)
+        if result == OTP_LOCKED:
+            return Response({"error": "Too many attempts. Please request a new OTP (action \"resend\")."}, status=429)
+        if result != OTP_OK:
+            return Response({"error": "Invalid or expired OTP"}, status=400)
 
         try:
             user = User.objects.get(email=email)
             user.is_active = True
             user.save()
-            del otp_storage[email]
             return Response({"message": "Email verified successfully"}, status=200)
         except User.DoesNotExist:
             return Response({"error": "User not found"}, status=404)
@@ -367,3 +532,47 @@ def logout_view(request):
 @permission_classes([AllowAny])
 def ping_view(request):
     return Response({"status": "ok"})
+
+
+# --- CHAT CACHE STATS VIEW ---
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def chat_cache_stats_view(request):
+    return Response(chat_cache.stats())
+
+
+# --- REQUEST COALESCING STATS VIEW ---
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def coalescing_stats_view(request):
+    return Response({
+        "chat": dict(chat_flight.stats(), enabled=settings.COALESCE_CHAT),
+        "image": dict(image_flight.stats(), enabled=settings.COALESCE_IMAGES),
+    })
+
+
+# --- GALLERY VIEW ---
+from . import gallery
+
+
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def gallery_view(request):
+    """Past generations, newest first; ``?mine=1`` lists only the signed-in user's."""
+    user_id = None
+    if request.query_params.get("mine"):
+        if not request.user.is_authenticated:
+            return Response({"error": "Sign in to see your images."}, status=status.HTTP_401_UNAUTHORIZED)
+        user_id = request.user.pk
+
+    try:
+        limit = int(request.query_params.get("limit", gallery.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return Response({"error": "limit must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        rows, next_cursor = gallery.gallery_page(request.query_params.get("cursor"), limit, user_id)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({"results": rows, "next_cursor": next_cursor})
@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 from datetime import timedelta
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -95,6 +95,8 @@ ACCOUNT_EMAIL_VERIFICATION = "none"
 
 
 MIDDLEWARE = [
+    'api.metrics.metrics_middleware',  # first, so it times the whole stack
+    'api.resilience.deadline_middleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -184,6 +186,8 @@ CORS_ALLOWED_ORIGINS = [
     "https://darkai-by-bhavya.vercel.app",
     "http://localhost:5173",
 ]
+# Let the frontend read the cache and chat routing headers
+CORS_EXPOSE_HEADERS = ["X-Cache", "X-Chat-Model", "X-Chat-Route"]
 
 
 
@@ -203,8 +207,6 @@ DATABASES = {
 
 
 import cloudinary
-import cloudinary.uploader
-import cloudinary.api
 
 cloudinary.config(
     cloud_name=config("CLOUDINARY_CLOUD_NAME"),
@@ -234,4 +236,164 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = config("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = config("EMAIL_HOST_PASSWORD")  # ✅ App password, not your real Gmail password
-DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
\ No newline at end of file
+DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+
+# Custom chat responses (identity/creator questions). The JSON file is
+# re-read when it changes, checked at most every N seconds.
+CUSTOM_RESPONSES_FILE = config("CUSTOM_RESPONSES_FILE", default=os.path.join(BASE_DIR, "api", "data", "custom_responses.json"))
+CUSTOM_RESPONSES_RELOAD_INTERVAL = config("CUSTOM_RESPONSES_RELOAD_INTERVAL", default=5, cast=int)
+
+# Use the native async API views (set automatically by backend/asgi.py).
+# Run with: gunicorn backend.asgi:application -k uvicorn.workers.UvicornWorker
+ASYNC_VIEWS = config("ASYNC_VIEWS", default=False, cast=bool)
+ASYNC_BLOCKING_THREADS = config("ASYNC_BLOCKING_THREADS", default=64, cast=int)
+
+# Chat response cache: "memory" (per-process LRU), "django" (CACHES[CHAT_CACHE_ALIAS]) or "none"
+CHAT_CACHE_BACKEND = config("CHAT_CACHE_BACKEND", default="memory")
+CHAT_CACHE_ALIAS = config("CHAT_CACHE_ALIAS", default="default")
+CHAT_CACHE_MAX_ENTRIES = config("CHAT_CACHE_MAX_ENTRIES", default=1024, cast=int)
+CHAT_CACHE_TTL = config("CHAT_CACHE_TTL", default=3600, cast=int)
+
+# Shared provider clients (api/providers.py): connection pool size per
+# process and how long idle keep-alive connections are kept open (seconds).
+PROVIDER_POOL_SIZE = config("PROVIDER_POOL_SIZE", default=20, cast=int)
+PROVIDER_KEEPALIVE_EXPIRY = config("PROVIDER_KEEPALIVE_EXPIRY", default=60, cast=int)
+
+# Generated images: upload to Cloudinary on a background pool and answer with
+# the (deterministic) delivery URL straight away. The URL serves the image
+# once the upload finishes, usually within a second or two.
+IMAGE_UPLOAD_IN_BACKGROUND = config("IMAGE_UPLOAD_IN_BACKGROUND", default=True, cast=bool)
+IMAGE_UPLOAD_THREADS = config("IMAGE_UPLOAD_THREADS", default=4, cast=int)
+
+# Text-to-speech audio cache: hash -> URL entries kept in memory per process
+# (the TTSAudio table is the persistent index).
+TTS_CACHE_MEMORY_ENTRIES = config("TTS_CACHE_MEMORY_ENTRIES", default=2048, cast=int)
+# Long texts are split into segments of about this many characters at
+# sentence boundaries and synthesized in parallel.
+TTS_SEGMENT_CHARS = config("TTS_SEGMENT_CHARS", default=300, cast=int)
+TTS_SYNTH_THREADS = config("TTS_SYNTH_THREADS", default=8, cast=int)
+
+# Image job queue (api/jobs.py): worker threads per server process, how many
+# jobs may wait before new ones are refused, and when a "running" job whose
+# process died is considered stale and re-queued (checked every
+# IMAGE_JOB_REQUEUE_INTERVAL seconds).
+IMAGE_JOB_WORKERS = config("IMAGE_JOB_WORKERS", default=2, cast=int)
+IMAGE_JOB_WORKERS_AUTOSTART = config("IMAGE_JOB_WORKERS_AUTOSTART", default=True, cast=bool)
+IMAGE_JOB_MAX_QUEUED = config("IMAGE_JOB_MAX_QUEUED", default=100, cast=int)
+IMAGE_JOB_POLL_INTERVAL = config("IMAGE_JOB_POLL_INTERVAL", default=2, cast=int)
+IMAGE_JOB_STALE_AFTER = config("IMAGE_JOB_STALE_AFTER", default=300, cast=int)
+IMAGE_JOB_REQUEUE_INTERVAL = config("IMAGE_JOB_REQUEUE_INTERVAL", default=60, cast=int)
+IMAGE_JOB_SSE_TIMEOUT = config("IMAGE_JOB_SSE_TIMEOUT", default=120, cast=int)
+
+# Signup OTPs (api/otp.py): "database" (shared by all workers), "cache" (a
+# shared CACHES entry such as Redis) or "memory" (one process only). A new OTP
+# can be requested OTP_RESEND_INTERVAL seconds after the previous one.
+OTP_STORE_BACKEND = config("OTP_STORE_BACKEND", default="database")
+OTP_CACHE_ALIAS = config("OTP_CACHE_ALIAS", default="default")
+OTP_TTL = config("OTP_TTL", default=600, cast=int)
+OTP_MAX_ATTEMPTS = config("OTP_MAX_ATTEMPTS", default=5, cast=int)
+OTP_RESEND_INTERVAL = config("OTP_RESEND_INTERVAL", default=60, cast=int)
+
+# Email outbox (api/outbox.py): signup mail is queued and sent by a background
+# thread in batches over one SMTP connection. Set EMAIL_OUTBOX_IN_BACKGROUND
+# to False to send inline (e.g. in tests with the locmem email backend).
+EMAIL_OUTBOX_IN_BACKGROUND = config("EMAIL_OUTBOX_IN_BACKGROUND", default=True, cast=bool)
+EMAIL_OUTBOX_BATCH_SIZE = config("EMAIL_OUTBOX_BATCH_SIZE", default=50, cast=int)
+EMAIL_OUTBOX_MAX_ATTEMPTS = config("EMAIL_OUTBOX_MAX_ATTEMPTS", default=5, cast=int)
+EMAIL_OUTBOX_RETRY_BACKOFF = config("EMAIL_OUTBOX_RETRY_BACKOFF", default=30, cast=int)
+EMAIL_OUTBOX_POLL_INTERVAL = config("EMAIL_OUTBOX_POLL_INTERVAL", default=5, cast=int)
+EMAIL_OUTBOX_STALE_AFTER = config("EMAIL_OUTBOX_STALE_AFTER", default=300, cast=int)
+
+# Generation quotas (api/quotas.py). The token bucket refills QUOTA_BUCKET_RATE
+# tokens per second up to QUOTA_BUCKET_BURST, per user or per IP; signed-in
+# users also get QUOTA_DAILY_LIMIT units a day. Costs are per endpoint.
+QUOTA_BUCKET_RATE = config("QUOTA_BUCKET_RATE", default=0.5, cast=float)
+QUOTA_BUCKET_BURST = config("QUOTA_BUCKET_BURST", default=10, cast=int)
+QUOTA_DAILY_LIMIT = config("QUOTA_DAILY_LIMIT", default=100, cast=int)
+QUOTA_COSTS = {"chat": 1, "image": 5, "tts": 1}
+# Anonymous requests are limited per REMOTE_ADDR. Behind n reverse proxies
+# that append to X-Forwarded-For, set this to n to use the client address the
+# outermost proxy saw instead.
+QUOTA_TRUSTED_PROXY_HOPS = config("QUOTA_TRUSTED_PROXY_HOPS", default=0, cast=int)
+
+# Request coalescing (api/singleflight.py): identical in-flight requests share
+# one upstream call. Off for images by default since generation is random.
+COALESCE_CHAT = config("COALESCE_CHAT", default=True, cast=bool)
+COALESCE_IMAGES = config("COALESCE_IMAGES", default=False, cast=bool)
+
+# Multi-turn chat (api/conversations.py): verbatim history sent per turn is
+# capped at about CONVERSATION_TOKEN_BUDGET tokens; older turns are folded
+# into a rolling summary of at most CONVERSATION_SUMMARY_WORDS words.
+CONVERSATION_TOKEN_BUDGET = config("CONVERSATION_TOKEN_BUDGET", default=2000, cast=int)
+CONVERSATION_MIN_RECENT_TURNS = config("CONVERSATION_MIN_RECENT_TURNS", default=4, cast=int)
+CONVERSATION_SUMMARY_WORDS = config("CONVERSATION_SUMMARY_WORDS", default=250, cast=int)
+
+# Chat-mode instructions are sent as each model's system instruction
+# (api/prompts.py). With CHAT_CONTEXT_CACHE they are also stored as Gemini
+# cached content, refreshed every CHAT_CONTEXT_CACHE_TTL seconds; the API
+# only caches prefixes above a minimum size and falls back otherwise.
+CHAT_CONTEXT_CACHE = config("CHAT_CONTEXT_CACHE", default=False, cast=bool)
+CHAT_CONTEXT_CACHE_TTL = config("CHAT_CONTEXT_CACHE_TTL", default=3600, cast=int)
+
+# Prometheus metrics on /api/metrics/ (api/metrics.py). When METRICS_TOKEN is
+# set, scrapes must send "Authorization: Bearer <token>".
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+
+# Provider SDKs (Gemini, Cloudinary uploader, gTTS) are imported on first use.
+# With PROVIDER_WARMUP the WSGI/ASGI entry points load them on a background
+# thread right after startup, so the first real request doesn't pay for it.
+PROVIDER_WARMUP = config("PROVIDER_WARMUP", default=True, cast=bool)
+
+# Reuse a stored image when the same prompt (case and whitespace normalized)
+# was generated within IMAGE_REUSE_WINDOW seconds; clients can send
+# "fresh": true to force a new generation.
+IMAGE_REUSE = config("IMAGE_REUSE", default=False, cast=bool)
+IMAGE_REUSE_WINDOW = config("IMAGE_REUSE_WINDOW", default=86400, cast=int)
+
+# Image derivatives (api/derivatives.py): a WebP thumbnail and a full-size WebP
+# (plus AVIF with IMAGE_DERIVATIVE_AVIF, if Pillow supports it) are rendered
+# in IMAGE_DERIVATIVE_PROCESSES worker processes after each upload.
+IMAGE_DERIVATIVES = config("IMAGE_DERIVATIVES", default=True, cast=bool)
+IMAGE_DERIVATIVE_PROCESSES = config("IMAGE_DERIVATIVE_PROCESSES", default=2, cast=int)
+IMAGE_DERIVATIVE_QUALITY = config("IMAGE_DERIVATIVE_QUALITY", default=80, cast=int)
+IMAGE_DERIVATIVE_AVIF = config("IMAGE_DERIVATIVE_AVIF", default=False, cast=bool)
+IMAGE_THUMBNAIL_SIZE = config("IMAGE_THUMBNAIL_SIZE", default=320, cast=int)
+
+# Batch image generation (/api/generate-image/batch/): at most IMAGE_BATCH_MAX
+# prompts per request, IMAGE_BATCH_CONCURRENCY of them in flight per batch,
+# on a pool of IMAGE_BATCH_THREADS shared by all batches.
+IMAGE_BATCH_MAX = config("IMAGE_BATCH_MAX", default=8, cast=int)
+IMAGE_BATCH_CONCURRENCY = config("IMAGE_BATCH_CONCURRENCY", default=3, cast=int)
+IMAGE_BATCH_THREADS = config("IMAGE_BATCH_THREADS", default=8, cast=int)
+
+# Provider calls (api/resilience.py). A request gets REQUEST_DEADLINE seconds
+# in total and each provider attempt at most PROVIDER_TIMEOUT of them.
+# Transient failures are retried PROVIDER_RETRIES times with jittered
+# exponential backoff (PROVIDER_BACKOFF_BASE doubling up to
+# PROVIDER_BACKOFF_MAX seconds). With PROVIDER_HEDGE, a call slower than the
+# provider's recent PROVIDER_HEDGE_PERCENTILE latency is sent a second time.
+# PROVIDER_BREAKER_FAILURES failures in a row stop calls to a provider for
+# PROVIDER_BREAKER_RESET seconds (503 with Retry-After meanwhile). Hedged
+# sync calls run on a pool of PROVIDER_HEDGE_THREADS.
+REQUEST_DEADLINE = config("REQUEST_DEADLINE", default=60, cast=float)
+PROVIDER_TIMEOUT = config("PROVIDER_TIMEOUT", default=30, cast=float)
+PROVIDER_RETRIES = config("PROVIDER_RETRIES", default=2, cast=int)
+PROVIDER_BACKOFF_BASE = config("PROVIDER_BACKOFF_BASE", default=0.25, cast=float)
+PROVIDER_BACKOFF_MAX = config("PROVIDER_BACKOFF_MAX", default=4, cast=float)
+PROVIDER_HEDGE = config("PROVIDER_HEDGE", default=False, cast=bool)
+PROVIDER_HEDGE_THREADS = config("PROVIDER_HEDGE_THREADS", default=64, cast=int)
+PROVIDER_HEDGE_PERCENTILE = config("PROVIDER_HEDGE_PERCENTILE", default=95, cast=float)
+PROVIDER_BREAKER_FAILURES = config("PROVIDER_BREAKER_FAILURES", default=5, cast=int)
+PROVIDER_BREAKER_RESET = config("PROVIDER_BREAKER_RESET", default=30, cast=float)
+
+# Chat model routing (api/routing.py). CHAT_MODELS is listed best first: code
+# mode and messages longer than CHAT_ROUTER_SHORT_CHARS go to the first
+# healthy one, shorter messages to the one with the lowest latency EWMA for
+# that call shape (smoothing CHAT_ROUTER_ALPHA). A model whose error rate EWMA is above
+# CHAT_ROUTER_MAX_ERROR_RATE is skipped until CHAT_ROUTER_RECOVERY seconds
+# after its last call.
+CHAT_MODELS = config("CHAT_MODELS", default="gemini-2.5-flash,gemini-2.5-flash-lite", cast=Csv())
+CHAT_ROUTER_SHORT_CHARS = config("CHAT_ROUTER_SHORT_CHARS", default=120, cast=int)
+CHAT_ROUTER_ALPHA = config("CHAT_ROUTER_ALPHA", default=0.2, cast=float)
+CHAT_ROUTER_MAX_ERROR_RATE = config("CHAT_ROUTER_MAX_ERROR_RATE", default=0.3, cast=float)
+CHAT_ROUTER_RECOVERY = config("CHAT_ROUTER_RECOVERY", default=60, cast=float)
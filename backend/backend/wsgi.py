@@ -14,3 +14,20 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# Resume queued image jobs (api/jobs.py) and unsent mail (api/outbox.py)
+# in this server process
+from django.conf import settings
+
+if settings.IMAGE_JOB_WORKERS_AUTOSTART:
+    from api.jobs import image_jobs
+    image_jobs.start()
+
+if settings.EMAIL_OUTBOX_IN_BACKGROUND:
+    from api.outbox import email_outbox
+    email_outbox.start()
+
+# Load the provider SDKs now that the app can already answer pings
+if settings.PROVIDER_WARMUP:
+    from api.providers import warm_up_in_background
+    warm_up_in_background()